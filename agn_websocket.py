@@ -6,9 +6,27 @@ import sys
 import getopt
 import time
 import logging
+import logging.handlers
+import queue
+import atexit
+import re
+import gzip
+import shutil
+import random
 from datetime import datetime
+from collections import Counter, deque, namedtuple
 import os
 import json
+import signal
+import subprocess
+import itertools
+import ipaddress
+import bisect
+import heapq
+import traceback
+import tracemalloc
+import struct
+import http.server
 
 # =============================================
 # 🚀 AGN WEBSOCKET PROXY - ENHANCED VERSION
@@ -23,15 +41,103 @@ TIMEOUT = 60
 DEFAULT_HOST = '127.0.0.1:22'
 RESPONSE = 'HTTP/1.1 101 Switching Protocols\r\n\r\nContent-Length: 104857600000\r\n\r\n'
 
+# Access control lists (one CIDR per line, IPv4 or IPv6)
+CIDR_ALLOW_FILE = "/opt/agn_websocket/cidr_allow.txt"
+CIDR_DENY_FILE = "/opt/agn_websocket/cidr_deny.txt"
+CIDR_RELOAD_INTERVAL = 5  # seconds
+
+# Graceful restart: SIGUSR2 (systemctl reload) starts a new process, hands it
+# the listening socket and lets existing tunnels drain
+LISTEN_BACKLOG = 512
+HANDOFF_SOCKET = "/run/agn_websocket/handoff.sock"
+HANDOFF_TIMEOUT = 15  # seconds for the new process to take over
+DRAIN_TIMEOUT = 300   # seconds old tunnels may keep running after a handoff
+
+# Runtime configuration file (KEY=value lines, '#' comments). Overrides the
+# defaults above; reloaded on SIGHUP without dropping open tunnels.
+CONFIG_FILE = "/opt/agn_websocket/agn_websocket.conf"
+CONFIG_KEYS = {
+    'LISTENING_ADDR': ('listening_addr', str),
+    'LISTENING_PORT': ('listening_port', int),
+    'PASS': ('password', str),
+    'BUFLEN': ('buflen', int),
+    'TIMEOUT': ('timeout', int),
+    'DEFAULT_HOST': ('default_host', str),
+    'HANDSHAKE_TIMEOUT': ('handshake_timeout', float),
+    'MAX_HEADER_SIZE': ('max_header_size', int),
+    'LOG_SAMPLE_RATE': ('log_sample_rate', float),
+    'TRACE_SAMPLE_RATE': ('trace_sample_rate', float),
+}
+CLI_OVERRIDES = {}
+
+# Logging: 'auto' colours the console only when it is a terminal
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+COLOR_OUTPUT = 'auto'
+LOG_SAMPLE_RATE = 1.0  # share of connections whose per-event info lines are logged
+TRACE_SAMPLE_RATE = 0.0  # share of handshakes whose per-phase timings are logged
+log_listener = None
+
+# Structured access log: one JSON object per closed tunnel
+ACCESS_LOG = "/var/log/agn_websocket_access.jsonl"
+ACCESS_LOG_ROTATE = 'size'  # 'size', or a time interval such as 'midnight' or 'H'
+ACCESS_LOG_MAX_BYTES = 50 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 7
+ACCESS_LOG_COMPRESS = True  # gzip rotated files
+access_log = logging.getLogger('agn.access')
+access_listener = None
+
+# Number of recent open/close events kept in memory
+EVENT_RING_SIZE = 1000
+
+# Slowest completed handshakes kept with their per-phase breakdown
+SLOW_TRACE_SIZE = 50
+
+# On-demand profiling (SIGUSR1): a thread
+# dump, a sampling profile and a tracemalloc diff over a short window.
+# Nothing runs or is traced until a capture is requested.
+PROFILE_DIR = "/var/log/agn_websocket_profiles"
+PROFILE_DURATION = 30           # seconds per capture
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TRACE_FRAMES = 10       # stack depth kept per allocation
+PROFILE_TOP = 50                # lines in the summaries
+
+# Handshake limits
+HANDSHAKE_TIMEOUT = 10  # seconds to receive the complete request headers
+MAX_HEADER_SIZE = 8192
+
+# TCP_INFO sampling of client sockets (Linux): RTT, cwnd, retransmits and
+# delivery rate per tunnel, to tell a slow proxy from a slow network path
+TCP_INFO_INTERVAL = 10  # seconds between samples, 0 disables
+TCP_INFO_LENGTH = 168   # struct tcp_info up to tcpi_delivery_rate
+
+# Prometheus metrics endpoint, off unless METRICS_PORT is set
+METRICS_ADDR = '127.0.0.1'
+METRICS_PORT = 0
+METRICS_NAMESPACE = 'agn_websocket'
+HANDSHAKE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONNECT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 14400, 86400)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912, 4294967296)
+
 # Statistics
 connection_stats = {
     'total_connections': 0,
     'active_connections': 0,
     'connections_per_minute': 0,
+    'blocked_connections': 0,
+    'handshaking': 0,
+    'handshake_timeouts': 0,
+    'oversized_headers': 0,
+    'auth_failures': 0,
+    'connect_failures': 0,
+    'download_bytes': 0,
+    'upload_bytes': 0,
     'last_reset': time.time(),
     'start_time': time.time()
 }
 
+stats_lock = threading.Lock()
+
 # Color codes for pretty output
 class Colors:
     RED = '\033[91m'
@@ -44,6 +150,11 @@ class Colors:
     RESET = '\033[0m'
     BOLD = '\033[1m'
 
+    @classmethod
+    def disable(cls):
+        for name in ('RED', 'GREEN', 'YELLOW', 'BLUE', 'MAGENTA', 'CYAN', 'WHITE', 'RESET', 'BOLD'):
+            setattr(cls, name, '')
+
 # Setup logging with colors and enhanced format
 class ColorFormatter(logging.Formatter):
     FORMATS = {
@@ -54,10 +165,61 @@ class ColorFormatter(logging.Formatter):
         logging.CRITICAL: Colors.RED + Colors.BOLD + "%(asctime)s - %(levelname)s - %(message)s" + Colors.RESET
     }
 
+    def __init__(self):
+        logging.Formatter.__init__(self, LOG_FORMAT)
+        # One formatter per level, built once instead of on every record
+        self.formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
+    def format(self, record):
+        formatter = self.formatters.get(record.levelno)
+        return formatter.format(record) if formatter else logging.Formatter.format(self, record)
+
+class PlainFormatter(logging.Formatter):
+    # Log files get the messages without the ANSI colour codes embedded in them
+    ANSI_CODES = re.compile(r'\x1b\[[0-9;]*m')
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.ANSI_CODES.sub('', logging.Formatter.format(self, record))
+
+class AccessFormatter(logging.Formatter):
+    # Serialised on the listener thread, not in the connection thread
+    def format(self, record):
+        return json.dumps(record.access, separators=(',', ':'))
+
+def gzip_namer(name):
+    return name + '.gz'
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def setup_access_log():
+    global access_listener
+    if ACCESS_LOG_ROTATE == 'size':
+        handler = logging.handlers.RotatingFileHandler(ACCESS_LOG, maxBytes=ACCESS_LOG_MAX_BYTES,
+                                                       backupCount=ACCESS_LOG_BACKUPS)
+    else:
+        handler = logging.handlers.TimedRotatingFileHandler(ACCESS_LOG, when=ACCESS_LOG_ROTATE,
+                                                            backupCount=ACCESS_LOG_BACKUPS)
+    if ACCESS_LOG_COMPRESS:
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+    handler.setFormatter(AccessFormatter())
+
+    access_queue = queue.SimpleQueue()
+    access_listener = logging.handlers.QueueListener(access_queue, handler)
+    access_listener.start()
+    atexit.register(access_listener.stop)
+    access_log.propagate = False
+    access_log.setLevel(logging.INFO)
+    access_log.addHandler(logging.handlers.QueueHandler(access_queue))
+
+def use_color():
+    # Colour only on an interactive terminal; never under journald
+    if COLOR_OUTPUT != 'auto':
+        return COLOR_OUTPUT == 'always'
+    return 'JOURNAL_STREAM' not in os.environ and sys.stderr.isatty()
 
 # Setup logging
 def setup_logging():
@@ -70,132 +232,833 @@ def setup_logging():
     
     # File handler (no colors)
     file_handler = logging.FileHandler('/var/log/agn_websocket.log')
-    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(file_formatter)
+    file_handler.setFormatter(PlainFormatter(LOG_FORMAT))
     
-    # Console handler (with colors)
+    # Console handler (with colors unless disabled)
     console_handler = logging.StreamHandler()
-    console_handler.setFormatter(ColorFormatter())
+    if use_color():
+        console_handler.setFormatter(ColorFormatter())
+    else:
+        Colors.disable()
+        console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
     
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Connection threads only enqueue records; formatting and disk/console
+    # writes happen on the listener thread
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
-class Server(threading.Thread):
-    def __init__(self, host, port):
-        threading.Thread.__init__(self)
+    setup_access_log()
+
+class Housekeeper(threading.Thread):
+    # Runs periodic maintenance tasks away from the accept and relay paths
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.tasks = []
+        self.running = True
+        self.wakeup = threading.Event()
+
+    def add_task(self, interval, func):
+        self.tasks.append([interval, time.monotonic() + interval, func])
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            next_due = now + 1
+            for task in self.tasks:
+                interval, due, func = task
+                if now >= due:
+                    try:
+                        func()
+                    except Exception as e:
+                        logging.error(f"❌ {Colors.RED}Maintenance task {func.__name__} failed: {e}{Colors.RESET}")
+                    due = task[1] = now + interval
+                next_due = min(next_due, due)
+            self.wakeup.wait(max(0, next_due - time.monotonic()))
+
+    def stop(self):
         self.running = False
+        self.wakeup.set()
+
+def read_tcp_info(sock):
+    # Offsets follow struct tcp_info in linux/tcp.h; kernels before 4.9
+    # return a shorter struct without the delivery rate
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_LENGTH)
+    except (AttributeError, OSError):
+        return None
+    if len(data) < 104:
+        return None
+    rtt, rttvar, _, cwnd = struct.unpack_from('<4I', data, 68)
+    return {
+        'rtt_ms': rtt / 1000,
+        'rttvar_ms': rttvar / 1000,
+        'cwnd': cwnd,
+        'retrans': struct.unpack_from('<I', data, 100)[0],
+        'delivery_rate': struct.unpack_from('<Q', data, 160)[0] if len(data) >= 168 else None
+    }
+
+def summarize_tcp_info(samples):
+    if not samples:
+        return {'tunnels': 0}
+    rates = [s['delivery_rate'] for s in samples if s['delivery_rate'] is not None]
+    return {
+        'tunnels': len(samples),
+        'avg_rtt_ms': round(sum(s['rtt_ms'] for s in samples) / len(samples), 2),
+        'max_rtt_ms': max(s['rtt_ms'] for s in samples),
+        'avg_cwnd': round(sum(s['cwnd'] for s in samples) / len(samples), 1),
+        'retrans': sum(s['retrans'] for s in samples),
+        'avg_delivery_rate': int(sum(rates) / len(rates)) if rates else None
+    }
+
+class Histogram:
+    # Fixed-bucket histogram; observe() is a bisect and two additions
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f'{self.name}_sum {total}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+handshake_histogram = Histogram(f'{METRICS_NAMESPACE}_handshake_seconds',
+                                'Time from accept until the tunnel is established', HANDSHAKE_BUCKETS)
+connect_histogram = Histogram(f'{METRICS_NAMESPACE}_upstream_connect_seconds',
+                              'Time to resolve and connect to the target', CONNECT_BUCKETS)
+duration_histogram = Histogram(f'{METRICS_NAMESPACE}_tunnel_duration_seconds',
+                               'Lifetime of established tunnels', DURATION_BUCKETS)
+size_histogram = Histogram(f'{METRICS_NAMESPACE}_tunnel_bytes',
+                           'Bytes relayed per tunnel in both directions', SIZE_BUCKETS)
+
+class MetricsServer(threading.Thread):
+    # Serves /metrics in the Prometheus text format. Binding is retried, so a
+    # process started by a handoff picks the port up once the old one drains.
+    def __init__(self, host, port, render):
+        threading.Thread.__init__(self, daemon=True)
         self.host = host
         self.port = port
-        self.threads = []
+        self.render = render
+        self.running = True
+        self.wakeup = threading.Event()
+
+    def run(self):
+        render = self.render
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = None
+        while self.running and httpd is None:
+            try:
+                httpd = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+            except OSError as e:
+                logging.debug(f"Metrics port {self.port} not available yet: {e}")
+                self.wakeup.wait(1)
+        if httpd is None:
+            return
+
+        httpd.daemon_threads = True
+        httpd.timeout = 0.5
+        logging.info(f"📈 {Colors.CYAN}Metrics available on http://{self.host}:{self.port}/metrics{Colors.RESET}")
+        try:
+            while self.running:
+                httpd.handle_request()
+        finally:
+            httpd.server_close()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+
+class Profiler:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.active = None
+
+    def capture(self, seconds=PROFILE_DURATION):
+        seconds = float(seconds)
+        with self.lock:
+            if self.active and self.active.is_alive():
+                return {'error': 'a capture is already running'}
+            os.makedirs(self.directory, exist_ok=True)
+            prefix = os.path.join(self.directory, datetime.now().strftime('%Y%m%d-%H%M%S'))
+            self.dump_threads(f'{prefix}-threads.txt')
+            self.active = threading.Thread(target=self.sample, args=(prefix, seconds),
+                                           name='profiler', daemon=True)
+            self.active.start()
+        logging.info(f"🔬 {Colors.CYAN}Profiling for {seconds:g}s into {prefix}-*{Colors.RESET}")
+        return {
+            'seconds': seconds,
+            'threads': f'{prefix}-threads.txt',
+            'profile': f'{prefix}-profile.txt',
+            'folded': f'{prefix}-profile.folded',
+            'memory': f'{prefix}-memory.txt'
+        }
+
+    def dump_threads(self, path):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with open(path, 'w') as f:
+            for ident, frame in sys._current_frames().items():
+                f.write(f'Thread {names.get(ident, ident)} ({ident}):\n')
+                f.writelines(traceback.format_stack(frame))
+                f.write('\n')
+
+    def sample(self, prefix, seconds):
+        # Wall-clock sampler over every thread, so blocked threads show
+        # where they wait as well as where CPU goes
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+        baseline = tracemalloc.take_snapshot()
+        own = threading.get_ident()
+        stacks = Counter()
+        leaves = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    if stack:
+                        leaves[stack[0]] += 1
+                        stacks[(names.get(ident, 'thread'), tuple(reversed(stack)))] += 1
+                samples += 1
+                time.sleep(PROFILE_SAMPLE_INTERVAL)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        describe = lambda code: f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        # Thread names are folded into the first frame so pooled workers group together
+        with open(f'{prefix}-profile.folded', 'w') as f:
+            for (name, stack), count in stacks.most_common():
+                f.write(';'.join([name.rstrip('0123456789-_')] + [describe(code) for code in stack]) + f' {count}\n')
+        with open(f'{prefix}-profile.txt', 'w') as f:
+            f.write(f'{samples} samples over {seconds:g}s, innermost frames:\n')
+            total = sum(leaves.values()) or 1
+            for code, count in leaves.most_common(PROFILE_TOP):
+                f.write(f'{count * 100 / total:6.2f}% {count:8d}  {describe(code)}\n')
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        diff = snapshot.filter_traces(ignore).compare_to(baseline.filter_traces(ignore), 'lineno')
+        with open(f'{prefix}-memory.txt', 'w') as f:
+            f.write(f'Allocation changes over {seconds:g}s:\n')
+            for stat in diff[:PROFILE_TOP]:
+                f.write(f'{stat}\n')
+        logging.info(f"🔬 {Colors.GREEN}Profile written to {prefix}-*{Colors.RESET}")
+
+class PrefixNode:
+    __slots__ = ('key', 'length', 'action', 'children')
+
+    def __init__(self, key, length, action=None):
+        self.key = key
+        self.length = length
+        self.action = action
+        self.children = [None, None]
+
+class PrefixTree:
+    # Path-compressed binary radix tree with longest-prefix matching.
+    # Inserts and lookups walk at most `width` bits regardless of entry count.
+    def __init__(self, width):
+        self.width = width
+        self.root = PrefixNode(0, 0)
+
+    def insert(self, key, length, action):
+        width = self.width
+        node = self.root
+        while True:
+            if node.length == length:
+                node.action = action
+                return
+            bit = (key >> (width - 1 - node.length)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = PrefixNode(key, length, action)
+                return
+
+            common = width - (child.key ^ key).bit_length()
+            if common >= min(child.length, length):
+                if child.length <= length:
+                    node = child
+                    continue
+                # New prefix covers the existing child
+                new = PrefixNode(key, length, action)
+                new.children[(child.key >> (width - 1 - length)) & 1] = child
+                node.children[bit] = new
+                return
+
+            # Prefixes diverge: add a branch node at the first differing bit
+            shift = width - common
+            branch = PrefixNode((key >> shift) << shift, common)
+            branch.children[(child.key >> (shift - 1)) & 1] = child
+            branch.children[(key >> (shift - 1)) & 1] = PrefixNode(key, length, action)
+            node.children[bit] = branch
+            return
+
+    def lookup(self, key):
+        width = self.width
+        node = self.root
+        found = node.action
+        while True:
+            node = node.children[(key >> (width - 1 - node.length)) & 1]
+            if node is None or (key ^ node.key) >> (width - node.length):
+                return found
+            if node.action is not None:
+                found = node.action
+            if node.length == width:
+                return found
+
+class CIDRFilter:
+    # Allow/deny lists checked right after accept(). The most specific
+    # matching prefix wins, so denying 0.0.0.0/0 and allowing a few ranges
+    # turns the lists into a strict allowlist.
+    def __init__(self, allow_file, deny_file):
+        self.allow_file = allow_file
+        self.deny_file = deny_file
+        self.signature = None
+        self.trees = (PrefixTree(32), PrefixTree(128))
+        self.entries = 0
+        self.reload()
+
+    def file_signature(self):
+        signature = []
+        for path in (self.allow_file, self.deny_file):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def reload(self):
+        signature = self.file_signature()
+        if signature == self.signature:
+            return False
+
+        v4, v6 = PrefixTree(32), PrefixTree(128)
+        entries = 0
+        # Deny first so that an identical allow entry takes precedence
+        for path, action in ((self.deny_file, False), (self.allow_file, True)):
+            try:
+                f = open(path, 'r')
+            except OSError:
+                continue
+            with f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if not line:
+                        continue
+                    try:
+                        net = ipaddress.ip_network(line, strict=False)
+                    except ValueError:
+                        logging.warning(f"⚠️ {Colors.YELLOW}Ignoring invalid CIDR '{line}' in {path}{Colors.RESET}")
+                        continue
+                    tree = v4 if net.version == 4 else v6
+                    tree.insert(int(net.network_address), net.prefixlen, action)
+                    entries += 1
+
+        # Swap in the new trees in one assignment so lookups never see a partial list
+        self.trees = (v4, v6)
+        self.entries = entries
+        self.signature = signature
+        logging.info(f"🛡️ {Colors.CYAN}Loaded {entries} CIDR rules{Colors.RESET}")
+        return True
+
+    def allowed(self, ip):
+        if not self.entries:
+            return True
+        v4, v6 = self.trees
+        try:
+            if ':' in ip:
+                key = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+                if key >> 32 == 0xffff:
+                    action = v4.lookup(key & 0xffffffff)
+                else:
+                    action = v6.lookup(key)
+            else:
+                action = v4.lookup(int.from_bytes(socket.inet_aton(ip), 'big'))
+        except OSError:
+            return True
+        return action is not False
+
+class ConnectionEvent:
+    __slots__ = ('time', 'type', 'conn_id', 'client', 'target', 'duration')
+
+    def __init__(self, event_type, conn, duration=None):
+        self.time = time.time()
+        self.type = event_type
+        self.conn_id = conn.conn_id
+        self.client = conn.client_addr
+        self.target = conn.target_info
+        self.duration = duration
+
+    def as_dict(self):
+        event = {
+            'time': datetime.fromtimestamp(self.time).strftime('%H:%M:%S'),
+            'type': self.type,
+            'conn_id': self.conn_id,
+            'client': self.client,
+            'target': self.target
+        }
+        if self.duration is not None:
+            event['duration'] = self.duration
+        return event
+
+class SlowTraceStore:
+    # Min-heap of the slowest handshakes, so the fastest kept entry is the
+    # one replaced; faster handshakes are rejected without taking the lock
+    def __init__(self, size):
+        self.size = size
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def add(self, total_ms, trace):
+        if len(self.heap) >= self.size and total_ms <= self.heap[0][0]:
+            return
+        item = (total_ms, next(self.counter), trace)
+        with self.lock:
+            if len(self.heap) < self.size:
+                heapq.heappush(self.heap, item)
+            elif total_ms > self.heap[0][0]:
+                heapq.heapreplace(self.heap, item)
+
+    def get(self, count=None):
+        with self.lock:
+            items = sorted(self.heap, reverse=True)
+        traces = [trace for _, _, trace in items]
+        return traces[:int(count)] if count else traces
+
+class TunnelConfig(namedtuple('TunnelConfig', ['generation'] + [field for field, _ in CONFIG_KEYS.values()])):
+    # Immutable settings snapshot. Reloads build a new one and swap the
+    # reference; a connection keeps the snapshot it was accepted with.
+    __slots__ = ()
+
+def load_config(path, generation=1):
+    # Built-in defaults, then the config file, then command line options
+    values = {field: globals()[key] for key, (field, _) in CONFIG_KEYS.items()}
+    if os.path.exists(path):
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, sep, value = line.partition('=')
+                key = key.strip()
+                if not sep or key not in CONFIG_KEYS:
+                    logging.warning(f"⚠️ {Colors.YELLOW}{path}:{lineno}: ignoring unknown setting '{key}'{Colors.RESET}")
+                    continue
+                field, cast = CONFIG_KEYS[key]
+                try:
+                    values[field] = cast(value.strip().strip('"\''))
+                except ValueError:
+                    raise ValueError(f"{path}:{lineno}: invalid value for {key}")
+    values.update(CLI_OVERRIDES)
+
+    if not 0 < values['listening_port'] < 65536:
+        raise ValueError(f"invalid LISTENING_PORT {values['listening_port']}")
+    for key in ('BUFLEN', 'TIMEOUT', 'HANDSHAKE_TIMEOUT', 'MAX_HEADER_SIZE'):
+        if values[CONFIG_KEYS[key][0]] <= 0:
+            raise ValueError(f"{key} must be positive")
+    if not 0 <= values['log_sample_rate'] <= 1:
+        raise ValueError("LOG_SAMPLE_RATE must be between 0 and 1")
+    if not 0 <= values['trace_sample_rate'] <= 1:
+        raise ValueError("TRACE_SAMPLE_RATE must be between 0 and 1")
+    return TunnelConfig(generation=generation, **values)
+
+def sd_notify(message):
+    # Minimal client for the systemd notify protocol; a no-op outside systemd
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return
+    if path.startswith('@'):
+        path = '\0' + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as soc:
+            soc.connect(path)
+            soc.sendall(message.encode('utf-8'))
+    except OSError:
+        pass
+
+def inherit_listener():
+    # systemd socket activation passes the listening socket as fd 3
+    if os.environ.get('LISTEN_PID') == str(os.getpid()) and int(os.environ.get('LISTEN_FDS', '0')) >= 1:
+        for key in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(key, None)
+        return socket.socket(fileno=3), None
+
+    # A running instance handing over its socket with SCM_RIGHTS
+    path = os.environ.pop('AGN_HANDOFF_SOCKET', None)
+    if not path:
+        return None
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.settimeout(HANDOFF_TIMEOUT)
+        channel.connect(path)
+        _, fds, _, _ = socket.recv_fds(channel, 16, 1)
+        if not fds:
+            raise OSError('no socket received')
+    except OSError as e:
+        channel.close()
+        logging.error(f"❌ {Colors.RED}Listening socket handoff failed: {e}{Colors.RESET}")
+        return None
+    return socket.socket(fileno=fds[0]), channel
+
+class Server(threading.Thread):
+    def __init__(self, config):
+        threading.Thread.__init__(self)
+        self.running = False
+        self.config = config
+        self.host = config.listening_addr
+        self.port = config.listening_port
+        self.reload_lock = threading.Lock()
+        self.pending_soc = None
+        self.last_reload_ms = 0
+        self.conns = {}
+        self.conn_ids = itertools.count(1)
         self.threadsLock = threading.Lock()
         self.logLock = threading.Lock()
-        self.connection_events = []
+        self.connection_events = deque(maxlen=EVENT_RING_SIZE)
+        self.slow_traces = SlowTraceStore(SLOW_TRACE_SIZE)
+        self.profiler = Profiler(PROFILE_DIR)
+        self.handoff_channel = None
+        self.draining = False
+        self.drain_deadline = 0
+        self.ip_filter = CIDRFilter(CIDR_ALLOW_FILE, CIDR_DENY_FILE)
+        self.housekeeper = Housekeeper()
+        self.housekeeper.add_task(CIDR_RELOAD_INTERVAL, self.ip_filter.reload)
+        self.tcp_summary = {'tunnels': 0}
+        if TCP_INFO_INTERVAL > 0:
+            self.housekeeper.add_task(TCP_INFO_INTERVAL, self.sample_tcp_info)
+        self.metrics_server = None
 
     def run(self):
-        self.soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.soc.settimeout(2)
-        intport = int(self.port)
-        
+        inherited = inherit_listener()
         try:
-            self.soc.bind((self.host, intport))
-            self.soc.listen(0)
+            if inherited:
+                self.soc, self.handoff_channel = inherited
+                self.soc.settimeout(2)
+                logging.info(f"♻️ {Colors.CYAN}Inherited listening socket {self.soc.getsockname()}{Colors.RESET}")
+                if self.soc.getsockname()[1] != self.port:
+                    # The config changed the port before this restart
+                    self.pending_soc = self.open_listener(self.host, self.port)
+            else:
+                self.soc = self.open_listener(self.host, self.port)
             self.running = True
+            self.housekeeper.start()
+            if METRICS_PORT:
+                self.metrics_server = MetricsServer(METRICS_ADDR, METRICS_PORT, self.render_metrics)
+                self.metrics_server.start()
 
             logging.info(f"🚀 {Colors.GREEN}AGN WebSocket Proxy started on {self.host}:{self.port}{Colors.RESET}")
-            logging.info(f"🔐 {Colors.YELLOW}Password protection: {'Enabled' if PASS else 'Disabled'}{Colors.RESET}")
+            logging.info(f"🔐 {Colors.YELLOW}Password protection: {'Enabled' if self.config.password else 'Disabled'}{Colors.RESET}")
             logging.info(f"📊 {Colors.CYAN}Real-time logging: Active{Colors.RESET}")
 
+            self.announce_ready()
+
             while self.running:
+                if self.pending_soc:
+                    self.swap_listener()
                 try:
                     c, addr = self.soc.accept()
                     c.setblocking(1)
-                    
-                    # Log new connection attempt
                     client_ip = addr[0]
-                    logging.info(f"🔗 {Colors.BLUE}New connection from {client_ip}{Colors.RESET}")
-                    
                 except socket.timeout:
                     continue
 
+                if not self.ip_filter.allowed(client_ip):
+                    with stats_lock:
+                        connection_stats['blocked_connections'] += 1
+                    c.close()
+                    continue
+
                 conn = ConnectionHandler(c, self, addr)
-                conn.start()
                 self.addConn(conn)
+                conn.start()
                 
         except Exception as e:
             logging.error(f"❌ {Colors.RED}Server error: {e}{Colors.RESET}")
         finally:
             self.running = False
+            if self.draining:
+                self.wait_drained()
+            self.housekeeper.stop()
+            if self.metrics_server:
+                self.metrics_server.close()
             self.soc.close()
+            if self.pending_soc:
+                self.pending_soc.close()
             logging.info(f"🛑 {Colors.YELLOW}Server stopped{Colors.RESET}")
 
+    def open_listener(self, host, port):
+        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            soc.bind((host, int(port)))
+            soc.listen(LISTEN_BACKLOG)
+        except OSError:
+            soc.close()
+            raise
+        soc.settimeout(2)
+        return soc
+
+    def swap_listener(self):
+        # Called from the accept loop so the socket is never replaced under accept()
+        with self.reload_lock:
+            old, self.soc, self.pending_soc = self.soc, self.pending_soc, None
+        old.close()
+        logging.info(f"🔀 {Colors.CYAN}Now listening on {self.host}:{self.port}{Colors.RESET}")
+
+    def reload_config(self):
+        # Swap in a new config snapshot. Open tunnels keep the one they were
+        # accepted with; new connections use the new one.
+        with self.reload_lock:
+            started = time.perf_counter()
+            try:
+                config = load_config(CONFIG_FILE, self.config.generation + 1)
+            except (OSError, ValueError) as e:
+                logging.error(f"❌ {Colors.RED}Config reload failed, keeping generation {self.config.generation}: {e}{Colors.RESET}")
+                return {'error': str(e)}
+
+            if (config.listening_addr, config.listening_port) != (self.host, self.port):
+                try:
+                    soc = self.open_listener(config.listening_addr, config.listening_port)
+                except OSError as e:
+                    logging.error(f"❌ {Colors.RED}Cannot listen on {config.listening_addr}:{config.listening_port}, reload aborted: {e}{Colors.RESET}")
+                    return {'error': str(e)}
+                if self.pending_soc:
+                    self.pending_soc.close()
+                self.pending_soc = soc
+
+            self.config = config
+            self.host, self.port = config.listening_addr, config.listening_port
+            self.ip_filter.reload()
+            self.last_reload_ms = (time.perf_counter() - started) * 1000
+
+        logging.info(f"🔄 {Colors.GREEN}Configuration generation {config.generation} loaded in {self.last_reload_ms:.1f}ms{Colors.RESET}")
+        return {'generation': config.generation, 'reload_ms': round(self.last_reload_ms, 2)}
+
+    def announce_ready(self):
+        if self.handoff_channel:
+            try:
+                self.handoff_channel.sendall(b'READY')
+            except OSError:
+                pass
+            self.handoff_channel.close()
+            self.handoff_channel = None
+        sd_notify('READY=1')
+
+    def handoff(self):
+        # Start a replacement process, pass it the listening socket, then drain
+        if self.draining or not self.running:
+            return {'error': 'server is not accepting connections'}
+
+        os.makedirs(os.path.dirname(HANDOFF_SOCKET), exist_ok=True)
+        if os.path.exists(HANDOFF_SOCKET):
+            os.unlink(HANDOFF_SOCKET)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        child = None
+        try:
+            listener.bind(HANDOFF_SOCKET)
+            os.chmod(HANDOFF_SOCKET, 0o600)
+            listener.listen(1)
+            listener.settimeout(HANDOFF_TIMEOUT)
+            env = dict(os.environ, AGN_HANDOFF_SOCKET=HANDOFF_SOCKET)
+            child = subprocess.Popen([sys.executable] + sys.argv, env=env)
+            channel, _ = listener.accept()
+            with channel:
+                channel.settimeout(HANDOFF_TIMEOUT)
+                socket.send_fds(channel, [b'LISTEN'], [self.soc.fileno()])
+                if channel.recv(16) != b'READY':
+                    raise OSError('replacement process did not become ready')
+        except OSError as e:
+            logging.error(f"❌ {Colors.RED}Graceful restart failed, keeping current process: {e}{Colors.RESET}")
+            if child and child.poll() is None:
+                child.terminate()
+            return {'error': str(e)}
+        finally:
+            listener.close()
+            try:
+                os.unlink(HANDOFF_SOCKET)
+            except OSError:
+                pass
+
+        sd_notify(f'MAINPID={child.pid}')
+        logging.info(f"♻️ {Colors.GREEN}Handed listening socket to PID {child.pid}{Colors.RESET}")
+        self.drain()
+        return {'handoff_pid': child.pid, 'draining': len(self.conns)}
+
+    def drain(self):
+        # Stop accepting; existing tunnels keep running until DRAIN_TIMEOUT
+        self.drain_deadline = time.time() + DRAIN_TIMEOUT
+        self.draining = True
+        self.running = False
+        # Let the new process take over the metrics port
+        if self.metrics_server:
+            self.metrics_server.close()
+        logging.info(f"🌊 {Colors.YELLOW}Draining {len(self.conns)} tunnels (deadline {DRAIN_TIMEOUT}s){Colors.RESET}")
+
+    def wait_drained(self):
+        while self.conns and time.time() < self.drain_deadline:
+            time.sleep(1)
+        if self.conns:
+            logging.warning(f"⚠️ {Colors.YELLOW}Drain deadline reached, closing {len(self.conns)} tunnels{Colors.RESET}")
+            self.close()
+            deadline = time.time() + 5
+            while self.conns and time.time() < deadline:
+                time.sleep(0.1)
+        logging.info(f"✅ {Colors.GREEN}Drain complete{Colors.RESET}")
+
     def printLog(self, log):
         logging.info(log)
 
     def addConn(self, conn):
-        try:
-            self.threadsLock.acquire()
-            if self.running:
-                self.threads.append(conn)
+        with self.threadsLock:
+            # Sockets accepted just before a drain started are still tracked
+            if self.running or self.draining:
+                self.conns[conn.conn_id] = conn
                 connection_stats['total_connections'] += 1
-                connection_stats['active_connections'] = len(self.threads)
-                
-                # Log connection event
-                event = {
-                    'time': datetime.now().strftime('%H:%M:%S'),
-                    'client': conn.log.split(' ')[1],
-                    'target': conn.log.split('CONNECT ')[1] if 'CONNECT' in conn.log else 'Unknown',
-                    'type': 'NEW'
-                }
-                self.connection_events.append(event)
-                
-        finally:
-            self.threadsLock.release()
+                connection_stats['active_connections'] = len(self.conns)
+                self.connection_events.append(ConnectionEvent('NEW', conn))
 
     def removeConn(self, conn):
-        try:
-            self.threadsLock.acquire()
-            if conn in self.threads:
-                self.threads.remove(conn)
-                connection_stats['active_connections'] = len(self.threads)
-                
-                # Log disconnection event
-                event = {
-                    'time': datetime.now().strftime('%H:%M:%S'),
-                    'client': conn.log.split(' ')[1],
-                    'target': conn.log.split('CONNECT ')[1] if 'CONNECT' in conn.log else 'Unknown',
-                    'type': 'CLOSE',
-                    'duration': getattr(conn, 'connection_duration', 0)
-                }
-                self.connection_events.append(event)
-                
-        finally:
-            self.threadsLock.release()
+        with self.threadsLock:
+            if self.conns.pop(conn.conn_id, None) is not None:
+                connection_stats['active_connections'] = len(self.conns)
+                self.connection_events.append(ConnectionEvent('CLOSE', conn, conn.connection_duration))
 
     def close(self):
         try:
             self.running = False
             self.threadsLock.acquire()
-            threads = list(self.threads)
-            for c in threads:
+            conns = list(self.conns.values())
+            for c in conns:
+                c.set_close_reason('terminated')
                 c.close()
         finally:
             self.threadsLock.release()
 
+    def render_metrics(self):
+        ns = METRICS_NAMESPACE
+        lines = []
+        for name, kind, help_text, value in (
+            ('connections_total', 'counter', 'Accepted connections', connection_stats['total_connections']),
+            ('active_connections', 'gauge', 'Open connections', len(self.conns)),
+            ('handshaking', 'gauge', 'Connections still sending request headers', connection_stats['handshaking']),
+            ('auth_failures_total', 'counter', 'Rejected credentials', connection_stats['auth_failures']),
+            ('upstream_errors_total', 'counter', 'Failed target connections', connection_stats['connect_failures']),
+            ('handshake_timeouts_total', 'counter', 'Handshakes that timed out', connection_stats['handshake_timeouts']),
+            ('oversized_headers_total', 'counter', 'Handshakes over MAX_HEADER_SIZE', connection_stats['oversized_headers']),
+            ('blocked_connections_total', 'counter', 'Connections refused by the CIDR filter', connection_stats['blocked_connections']),
+        ):
+            lines += [f'# HELP {ns}_{name} {help_text}', f'# TYPE {ns}_{name} {kind}', f'{ns}_{name} {value}']
+        lines += [f'# HELP {ns}_bytes_total Bytes relayed by closed tunnels',
+                  f'# TYPE {ns}_bytes_total counter',
+                  f'{ns}_bytes_total{{direction="down"}} {connection_stats["download_bytes"]}',
+                  f'{ns}_bytes_total{{direction="up"}} {connection_stats["upload_bytes"]}']
+        for histogram in (handshake_histogram, connect_histogram, duration_histogram, size_histogram):
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+    def sample_tcp_info(self):
+        # One getsockopt per established tunnel; the latest sample is kept
+        # on the handler and summarised here
+        with self.threadsLock:
+            conns = [c for c in self.conns.values() if c.established_time and not c.clientClosed]
+        sampled = []
+        for conn in conns:
+            info = read_tcp_info(conn.client)
+            if info:
+                info['max_rtt_ms'] = max(info['rtt_ms'], conn.tcp_info['max_rtt_ms'] if conn.tcp_info else 0)
+                conn.tcp_info = info
+                sampled.append(conn)
+        self.tcp_summary = summarize_tcp_info([conn.tcp_info for conn in sampled])
+
     def get_stats(self):
         current_time = time.time()
         uptime = current_time - connection_stats['start_time']
         
         return {
-            'active_connections': len(self.threads),
+            'active_connections': len(self.conns),
             'total_connections': connection_stats['total_connections'],
+            'blocked_connections': connection_stats['blocked_connections'],
+            'handshaking': connection_stats['handshaking'],
+            'handshake_timeouts': connection_stats['handshake_timeouts'],
+            'oversized_headers': connection_stats['oversized_headers'],
+            'cidr_rules': self.ip_filter.entries,
             'listening_port': self.port,
+            'state': 'draining' if self.draining else 'running',
+            'config_generation': self.config.generation,
+            'last_reload_ms': round(self.last_reload_ms, 2),
+            'drain_remaining': max(0, int(self.drain_deadline - current_time)) if self.draining else 0,
             'server_uptime': uptime,
-            'connections_per_minute': connection_stats['total_connections'] / (uptime / 60) if uptime > 0 else 0
+            'connections_per_minute': connection_stats['total_connections'] / (uptime / 60) if uptime > 0 else 0,
+            'tcp': self.tcp_summary
         }
     
-    def get_recent_events(self, count=10):
-        return self.connection_events[-count:]
+    def get_connections(self):
+        with self.threadsLock:
+            conns = list(self.conns.values())
+        now = time.time()
+        return [{
+            'conn_id': c.conn_id,
+            'client': c.client_addr,
+            'target': c.target_info,
+            'started': datetime.fromtimestamp(c.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': round(now - c.start_time, 1),
+            'tcp': c.tcp_info
+        } for c in conns]
+
+    def get_recent_events(self, count=10, event_type=None):
+        count = int(count)
+        if event_type is None:
+            events = list(itertools.islice(reversed(self.connection_events), count))
+        else:
+            events = list(itertools.islice((e for e in reversed(self.connection_events) if e.type == event_type), count))
+        return [e.as_dict() for e in reversed(events)]
+
+class HandshakeError(Exception):
+    pass
 
 class ConnectionHandler(threading.Thread):
     def __init__(self, socClient, server, addr):
@@ -205,9 +1068,24 @@ class ConnectionHandler(threading.Thread):
         self.client = socClient
         self.client_buffer = b''
         self.server = server
-        self.log = f"Connection: {addr[0]}:{addr[1]}"
+        self.config = server.config
+        self.conn_id = next(server.conn_ids)
+        self.client_addr = f"{addr[0]}:{addr[1]}"
+        self.target_info = 'Unknown'
+        self.log = f"Connection: {self.client_addr}"
         self.start_time = time.time()
+        self.handshake_deadline = time.monotonic() + self.config.handshake_timeout
+        self.established_time = None
         self.connection_duration = 0
+        self.close_reason = None
+        self.download_bytes = 0
+        self.upload_bytes = 0
+        # Per-event info lines are logged for a sample of connections
+        self.verbose = random.random() < self.config.log_sample_rate
+        # Monotonic end time of each handshake phase, starting at accept
+        self.trace = [('accepted', time.monotonic())]
+        self.trace_logged = random.random() < self.config.trace_sample_rate
+        self.tcp_info = None
 
     def close(self):
         try:
@@ -228,9 +1106,69 @@ class ConnectionHandler(threading.Thread):
         finally:
             self.targetClosed = True
 
+    def set_close_reason(self, reason):
+        # First reason wins; a terminate() surfaces later as a socket error
+        if self.close_reason is None:
+            self.close_reason = reason
+
+    def record_metrics(self):
+        with stats_lock:
+            connection_stats['download_bytes'] += self.download_bytes
+            connection_stats['upload_bytes'] += self.upload_bytes
+        if self.established_time:
+            duration_histogram.observe(time.time() - self.established_time)
+            size_histogram.observe(self.download_bytes + self.upload_bytes)
+
+    def mark(self, phase):
+        self.trace.append((phase, time.monotonic()))
+
+    def finish_trace(self):
+        # Each phase is the time since the previous mark: queued (waiting for
+        # a thread), headers, auth, resolve, connect and response (the 101)
+        phases = {}
+        started = previous = self.trace[0][1]
+        for phase, at in self.trace[1:]:
+            phases[phase] = round((at - previous) * 1000, 3)
+            previous = at
+        total_ms = round((previous - started) * 1000, 3)
+        self.server.slow_traces.add(total_ms, {
+            'id': self.conn_id,
+            'time': datetime.fromtimestamp(self.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+            'client': self.client_addr,
+            'target': self.target_info,
+            'total_ms': total_ms,
+            'phases': phases
+        })
+        if self.trace_logged:
+            breakdown = ' '.join(f'{phase}={ms}ms' for phase, ms in phases.items())
+            logging.info(f"🧭 {Colors.BLUE}Trace {self.conn_id}: {total_ms}ms - {breakdown}{Colors.RESET}")
+
+    def log_access(self):
+        # A last TCP_INFO sample, so short tunnels get one too
+        tcp_info = read_tcp_info(self.client) if self.established_time and not self.clientClosed else None
+        tcp_info = tcp_info or self.tcp_info
+        access_log.info('', extra={'access': {
+            'ts': round(time.time(), 3),
+            'id': self.conn_id,
+            'client': self.client_addr,
+            'target': self.target_info,
+            'start': round(self.start_time, 3),
+            'duration': round(self.connection_duration, 3),
+            'handshake_ms': round((self.established_time - self.start_time) * 1000, 1) if self.established_time else None,
+            'up': self.upload_bytes,
+            'down': self.download_bytes,
+            'reason': self.close_reason or 'closed',
+            'rtt_ms': tcp_info['rtt_ms'] if tcp_info else None,
+            'retrans': tcp_info['retrans'] if tcp_info else None,
+        }})
+
     def run(self):
+        if self.verbose:
+            logging.info(f"🔗 {Colors.BLUE}New connection from {self.client_addr}{Colors.RESET}")
+        self.mark('queued')
         try:
-            self.client_buffer = self.client.recv(BUFLEN)
+            self.client_buffer = self.read_handshake()
+            self.mark('headers')
 
             # Enhanced header parsing for various payload types
             hostPort = self.findHeader(self.client_buffer, b'X-Real-Host')
@@ -248,29 +1186,35 @@ class ConnectionHandler(threading.Thread):
                     if host_header and not host_header.endswith(b':8098'):
                         # Host header contains the actual target
                         hostPort = host_header
-                        logging.info(f"🌐 {Colors.MAGENTA}WebSocket payload detected, target: {hostPort.decode('utf-8')}{Colors.RESET}")
+                        if self.verbose:
+                            logging.info(f"🌐 {Colors.MAGENTA}WebSocket payload detected, target: {hostPort.decode('utf-8')}{Colors.RESET}")
                     else:
                         # Use default SSH target
-                        hostPort = DEFAULT_HOST.encode('utf-8')
+                        hostPort = self.config.default_host.encode('utf-8')
                 else:
                     # Standard proxy request
-                    hostPort = host_header if host_header else DEFAULT_HOST.encode('utf-8')
+                    hostPort = host_header if host_header else self.config.default_host.encode('utf-8')
 
             # If still no host, use default
             if hostPort == b'':
-                hostPort = DEFAULT_HOST.encode('utf-8')
+                hostPort = self.config.default_host.encode('utf-8')
 
             split = self.findHeader(self.client_buffer, b'X-Split')
 
-            if split != b'':
-                self.client.recv(BUFLEN)
+            if split != b'' and self.client_buffer.count(b'\r\n\r\n') < 2:
+                self.recv_before_deadline()
 
             if hostPort != b'':
                 passwd = self.findHeader(self.client_buffer, b'X-Pass')
+                self.mark('auth')
                 
-                if len(PASS) != 0 and passwd == PASS.encode('utf-8'):
+                password = self.config.password
+                if len(password) != 0 and passwd == password.encode('utf-8'):
                     self.method_CONNECT(hostPort)
-                elif len(PASS) != 0 and passwd != PASS.encode('utf-8'):
+                elif len(password) != 0 and passwd != password.encode('utf-8'):
+                    self.set_close_reason('wrong_password')
+                    with stats_lock:
+                        connection_stats['auth_failures'] += 1
                     self.client.send(b'HTTP/1.1 400 WrongPass!\r\n\r\n')
                     logging.warning(f"🔒 {Colors.RED}Wrong password attempt from {self.log}{Colors.RESET}")
                 else:
@@ -280,15 +1224,65 @@ class ConnectionHandler(threading.Thread):
                 logging.warning(f"⚠️ {Colors.YELLOW}No target host provided from {self.log}{Colors.RESET}")
                 self.client.send(b'HTTP/1.1 400 NoTargetHost!\r\n\r\n')
 
+        except HandshakeError as e:
+            reason = str(e)
+            if reason == 'timeout':
+                with stats_lock:
+                    connection_stats['handshake_timeouts'] += 1
+            elif reason == 'oversized':
+                with stats_lock:
+                    connection_stats['oversized_headers'] += 1
+                try:
+                    self.client.send(b'HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n')
+                except OSError:
+                    pass
+            self.log += f' - handshake {reason}'
+            self.set_close_reason(f'handshake_{reason}')
+            logging.warning(f"⏱️ {Colors.YELLOW}Dropped during handshake: {self.log}{Colors.RESET}")
         except Exception as e:
             self.log += f' - error: {str(e)}'
+            self.set_close_reason('error')
             logging.error(f"💥 {Colors.RED}Connection error: {self.log}{Colors.RESET}")
         finally:
             self.connection_duration = time.time() - self.start_time
-            logging.info(f"🔌 {Colors.CYAN}Connection closed: {self.log} - Duration: {self.connection_duration:.2f}s{Colors.RESET}")
+            if self.verbose:
+                logging.info(f"🔌 {Colors.CYAN}Connection closed: {self.log} - Duration: {self.connection_duration:.2f}s{Colors.RESET}")
+            self.log_access()
+            self.record_metrics()
             self.close()
             self.server.removeConn(self)
 
+    def read_handshake(self):
+        # Read up to the end of the request headers within HANDSHAKE_TIMEOUT and
+        # MAX_HEADER_SIZE, so idle or trickling clients cannot pin a thread
+        with stats_lock:
+            connection_stats['handshaking'] += 1
+        try:
+            buffer = b''
+            while b'\r\n\r\n' not in buffer:
+                buffer += self.recv_before_deadline()
+                if len(buffer) > self.config.max_header_size:
+                    raise HandshakeError('oversized')
+            return buffer
+        finally:
+            with stats_lock:
+                connection_stats['handshaking'] -= 1
+
+    def recv_before_deadline(self):
+        remaining = self.handshake_deadline - time.monotonic()
+        if remaining <= 0:
+            raise HandshakeError('timeout')
+        self.client.settimeout(remaining)
+        try:
+            data = self.client.recv(self.config.buflen)
+        except socket.timeout:
+            raise HandshakeError('timeout')
+        finally:
+            self.client.settimeout(None)
+        if not data:
+            raise HandshakeError('closed')
+        return data
+
     def findHeader(self, head, header):
         aux = head.find(header + b': ')
 
@@ -305,6 +1299,7 @@ class ConnectionHandler(threading.Thread):
         return head[:aux]
 
     def connect_target(self, host):
+        started = time.perf_counter()
         try:
             i = host.find(b':')
             if i != -1:
@@ -314,29 +1309,41 @@ class ConnectionHandler(threading.Thread):
                 port = 22  # Default to SSH port
 
             (soc_family, soc_type, proto, _, address) = socket.getaddrinfo(host.decode('utf-8'), port)[0]
+            self.mark('resolve')
 
             self.target = socket.socket(soc_family, soc_type, proto)
             self.targetClosed = False
             self.target.connect(address)
+            connect_histogram.observe(time.perf_counter() - started)
+            self.mark('connect')
             
-            logging.info(f"✅ {Colors.GREEN}Connected to target: {host.decode('utf-8')}:{port}{Colors.RESET}")
+            if self.verbose:
+                logging.info(f"✅ {Colors.GREEN}Connected to target: {host.decode('utf-8')}:{port}{Colors.RESET}")
             
         except Exception as e:
             logging.error(f"❌ {Colors.RED}Failed to connect to target {host.decode('utf-8')}: {e}{Colors.RESET}")
             raise
 
     def method_CONNECT(self, path):
-        target_info = path.decode('utf-8')
-        self.log += f' - CONNECT {target_info}'
+        self.target_info = path.decode('utf-8')
+        self.log += f' - CONNECT {self.target_info}'
         
-        logging.info(f"🚀 {Colors.GREEN}New tunnel established: {self.log}{Colors.RESET}")
+        if self.verbose:
+            logging.info(f"🚀 {Colors.GREEN}New tunnel established: {self.log}{Colors.RESET}")
 
         try:
             self.connect_target(path)
             self.client.sendall(RESPONSE.encode('utf-8'))
+            self.established_time = time.time()
+            self.mark('response')
+            handshake_histogram.observe(self.established_time - self.start_time)
+            self.finish_trace()
             self.client_buffer = b''
             self.doCONNECT()
         except Exception as e:
+            self.set_close_reason('connect_failed')
+            with stats_lock:
+                connection_stats['connect_failures'] += 1
             logging.error(f"💥 {Colors.RED}Tunnel setup failed: {e}{Colors.RESET}")
             self.client.send(b'HTTP/1.1 500 TunnelError\r\n\r\n')
 
@@ -344,38 +1351,43 @@ class ConnectionHandler(threading.Thread):
         socs = [self.client, self.target]
         count = 0
         error = False
-        data_transferred = 0
         
         while True:
             count += 1
             (recv, _, err) = select.select(socs, [], socs, 3)
             if err:
+                self.set_close_reason('relay_error')
                 error = True
             if recv:
                 for in_ in recv:
                     try:
-                        data = in_.recv(BUFLEN)
+                        data = in_.recv(self.config.buflen)
                         if data:
-                            data_transferred += len(data)
                             if in_ is self.target:
+                                self.download_bytes += len(data)
                                 self.client.send(data)
                             else:
+                                self.upload_bytes += len(data)
                                 while data:
                                     byte = self.target.send(data)
                                     data = data[byte:]
                             count = 0
                         else:
+                            self.set_close_reason('client_closed' if in_ is self.client else 'target_closed')
                             break
                     except:
+                        self.set_close_reason('relay_error')
                         error = True
                         break
-            if count == TIMEOUT:
+            if count == self.config.timeout:
+                self.set_close_reason('idle_timeout')
                 error = True
             if error:
                 break
         
         # Log data transfer stats
-        if data_transferred > 0:
+        data_transferred = self.download_bytes + self.upload_bytes
+        if data_transferred > 0 and self.verbose:
             logging.info(f"📊 {Colors.BLUE}Data transferred: {data_transferred} bytes - {self.log}{Colors.RESET}")
 
 def print_usage():
@@ -394,6 +1406,8 @@ def print_usage():
 {Colors.YELLOW}Options:{Colors.RESET}
   {Colors.WHITE}-b, --bind    Bind address (default: 0.0.0.0){Colors.RESET}
   {Colors.WHITE}-p, --port    Listening port (default: 8098){Colors.RESET}
+  {Colors.WHITE}--no-color    Plain console output (automatic under systemd){Colors.RESET}
+  {Colors.WHITE}--metrics-port <port>  Serve Prometheus metrics on 127.0.0.1:<port>/metrics{Colors.RESET}
   {Colors.WHITE}-h, --help    Show this help message{Colors.RESET}
 
 {Colors.YELLOW}Features:{Colors.RESET}
@@ -404,11 +1418,11 @@ def print_usage():
     ''')
 
 def parse_args(argv):
-    global LISTENING_ADDR
-    global LISTENING_PORT
+    global COLOR_OUTPUT
+    global METRICS_PORT
     
     try:
-        opts, args = getopt.getopt(argv,"hb:p:",["bind=","port="])
+        opts, args = getopt.getopt(argv,"hb:p:",["bind=","port=","no-color","metrics-port="])
     except getopt.GetoptError:
         print_usage()
         sys.exit(2)
@@ -417,9 +1431,13 @@ def parse_args(argv):
             print_usage()
             sys.exit()
         elif opt in ("-b", "--bind"):
-            LISTENING_ADDR = arg
+            CLI_OVERRIDES['listening_addr'] = arg
         elif opt in ("-p", "--port"):
-            LISTENING_PORT = int(arg)
+            CLI_OVERRIDES['listening_port'] = int(arg)
+        elif opt == "--no-color":
+            COLOR_OUTPUT = 'never'
+        elif opt == "--metrics-port":
+            METRICS_PORT = int(arg)
 
 def show_banner():
     banner = f'''
@@ -442,12 +1460,26 @@ def display_stats(server):
     
     print(f"\n{Colors.CYAN}{Colors.BOLD}📊 REAL-TIME STATISTICS:{Colors.RESET}")
     print(f"{Colors.WHITE}╔═══════════════════════════════════════╗{Colors.RESET}")
+    if stats['state'] == 'draining':
+        print(f"{Colors.YELLOW}🌊 Draining: {stats['active_connections']} tunnels left, {stats['drain_remaining']}s until forced close{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.GREEN}🟢 Active Connections: {Colors.CYAN}{stats['active_connections']:>15}{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.YELLOW}📈 Total Connections: {Colors.CYAN}{stats['total_connections']:>15}{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.BLUE}⏱️  Server Uptime: {Colors.CYAN}{stats['server_uptime']:>18.1f}s{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.MAGENTA}🚀 Connections/Min: {Colors.CYAN}{stats['connections_per_minute']:>16.1f}{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.RED}🚫 Blocked by CIDR: {Colors.CYAN}{stats['blocked_connections']:>16}{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.YELLOW}🤝 In Handshake: {Colors.CYAN}{stats['handshaking']:>19}{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.RED}⏱️  Handshake Drops: {Colors.CYAN}{stats['handshake_timeouts'] + stats['oversized_headers']:>15}{Colors.WHITE} ║{Colors.RESET}")
+    if stats['tcp']['tunnels']:
+        print(f"{Colors.WHITE}║ {Colors.BLUE}📶 Avg Client RTT: {Colors.CYAN}{stats['tcp']['avg_rtt_ms']:>15.1f}ms{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}╚═══════════════════════════════════════╝{Colors.RESET}")
     
+    slowest = server.slow_traces.get(3)
+    if slowest:
+        print(f"\n{Colors.YELLOW}{Colors.BOLD}🐢 SLOWEST HANDSHAKES:{Colors.RESET}")
+        for trace in slowest:
+            breakdown = ' '.join(f'{phase}={ms:.1f}ms' for phase, ms in trace['phases'].items())
+            print(f"  {Colors.WHITE}{trace['time']} #{trace['id']} {trace['client']} {trace['total_ms']:.1f}ms - {breakdown}{Colors.RESET}")
+
     if recent_events:
         print(f"\n{Colors.YELLOW}{Colors.BOLD}🕒 RECENT ACTIVITY:{Colors.RESET}")
         for event in recent_events:
@@ -463,19 +1495,38 @@ def main(host=LISTENING_ADDR, port=LISTENING_PORT):
     # Show banner
     show_banner()
     
-    print(f"{Colors.YELLOW}📍 {Colors.WHITE}Listening on: {Colors.CYAN}{LISTENING_ADDR}:{LISTENING_PORT}{Colors.RESET}")
-    print(f"{Colors.YELLOW}🔐 {Colors.WHITE}Password: {Colors.GREEN if PASS else Colors.RED}{'Enabled' if PASS else 'Disabled'}{Colors.RESET}")
+    try:
+        config = load_config(CONFIG_FILE)
+    except (OSError, ValueError) as e:
+        print(f"{Colors.RED}❌ Invalid configuration: {e}{Colors.RESET}")
+        sys.exit(1)
+
+    print(f"{Colors.YELLOW}📍 {Colors.WHITE}Listening on: {Colors.CYAN}{config.listening_addr}:{config.listening_port}{Colors.RESET}")
+    print(f"{Colors.YELLOW}🔐 {Colors.WHITE}Password: {Colors.GREEN if config.password else Colors.RED}{'Enabled' if config.password else 'Disabled'}{Colors.RESET}")
     print(f"{Colors.YELLOW}📊 {Colors.WHITE}Logging to: {Colors.CYAN}/var/log/agn_websocket.log{Colors.RESET}")
     print(f"{Colors.YELLOW}🚀 {Colors.WHITE}Starting server...{Colors.RESET}\n")
     
-    server = Server(LISTENING_ADDR, LISTENING_PORT)
+    server = Server(config)
     server.start()
+
+    # Config reload: new settings apply to new connections
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=server.reload_config, daemon=True).start())
+
+    # Graceful restart (systemctl reload): hand over the socket and drain
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=server.handoff, daemon=True).start())
+
+    # Diagnostics: thread dump, sampling profile and allocation diff
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=server.profiler.capture, daemon=True).start())
+
+    # systemctl stop/restart: shut down as on Ctrl+C, so queued stats rows,
+    # log and access records are flushed before the process exits
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     
     last_stat_display = 0
     stat_interval = 10  # seconds
     
     try:
-        while True:
+        while server.is_alive():
             time.sleep(2)
             
             # Display stats every stat_interval seconds
@@ -489,6 +1540,8 @@ def main(host=LISTENING_ADDR, port=LISTENING_PORT):
                 logging.info(f"📈 Stats - Active: {stats['active_connections']}, Total: {stats['total_connections']}, Rate: {stats['connections_per_minute']:.1f}/min")
                 
     except KeyboardInterrupt:
+        # A repeated SIGTERM must not cut the flush short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         print(f'\n\n{Colors.YELLOW}🛑 Stopping server...{Colors.RESET}')
         server.close()
         server.join()
@@ -4,9 +4,11 @@
 AGN_WEBSOCKET_SERVICE="agn-websocket"
 PYTHON_SCRIPT_PATH="/opt/agn_websocket/agn_websocket.py"
 LOG_FILE="/var/log/agn_websocket.log"
+ACCESS_LOG="/var/log/agn_websocket_access.jsonl"
 UDPGW_SERVICE="udpgw"
 UDPGW_PORT="7300"
 CONFIG_FILE="/opt/agn_websocket/agn_config.conf"
+TUNNEL_CONFIG_FILE="/opt/agn_websocket/agn_websocket.conf"
 
 # Color codes for pretty output
 RED='\033[0;31m'
@@ -258,9 +260,34 @@ check_server_status() {
    show_recent_connections
 }
 
+# Function to set a proxy setting in the runtime config file
+set_tunnel_setting() {
+   local key="$1"
+   local value="$2"
+   touch "$TUNNEL_CONFIG_FILE"
+   chmod 600 "$TUNNEL_CONFIG_FILE"
+   if grep -q "^$key=" "$TUNNEL_CONFIG_FILE"; then
+       sed -i "s|^$key=.*|$key=$value|" "$TUNNEL_CONFIG_FILE"
+   else
+       echo "$key=$value" >> "$TUNNEL_CONFIG_FILE"
+   fi
+}
+
+# Function to apply config file changes without dropping tunnels
+reload_websocket_config() {
+   if systemctl is-active --quiet $AGN_WEBSOCKET_SERVICE; then
+       systemctl kill -s HUP --kill-who=main $AGN_WEBSOCKET_SERVICE
+       echo -e "${GREEN}✅ Configuration reloaded, open tunnels kept${NC}"
+   else
+       restart_websocket_service
+   fi
+}
+
 # Function to get listening port
 get_listening_port() {
-   if [ -f "$PYTHON_SCRIPT_PATH" ]; then
+   if grep -qP '^LISTENING_PORT=' "$TUNNEL_CONFIG_FILE" 2>/dev/null; then
+       grep -oP '^LISTENING_PORT=\K[0-9]+' "$TUNNEL_CONFIG_FILE"
+   elif [ -f "$PYTHON_SCRIPT_PATH" ]; then
        grep -oP 'LISTENING_PORT\s*=\s*\K[0-9]+' "$PYTHON_SCRIPT_PATH" 2>/dev/null || echo "8098"
    else
        echo "8098"
@@ -466,15 +493,10 @@ change_listening_port() {
    fi
 
    if [ -f "$PYTHON_SCRIPT_PATH" ]; then
-       # Stop service first
-       systemctl stop $AGN_WEBSOCKET_SERVICE 2>/dev/null
-       
-       # Update port in Python script
-       sed -i "s/LISTENING_PORT = [0-9]\+/LISTENING_PORT = $new_port/" "$PYTHON_SCRIPT_PATH"
+       # The proxy rebinds on reload; open tunnels stay up
+       set_tunnel_setting LISTENING_PORT "$new_port"
        echo -e "${GREEN}✅ WebSocket listening port changed to $new_port${NC}"
-
-       # Restart WebSocket service
-       restart_websocket_service
+       reload_websocket_config
    else
        echo -e "${RED}❌ File $PYTHON_SCRIPT_PATH not found${NC}"
    fi
@@ -484,8 +506,23 @@ change_listening_port() {
 restart_websocket_service() {
    echo -e "${WHITE}🔄 RESTARTING GX TUNNEL SERVICE${NC}"
    echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
-   systemctl daemon-reload
-   systemctl restart $AGN_WEBSOCKET_SERVICE
+   # Enable graceful reloads: the proxy hands its socket to a new process
+   # on SIGUSR2 and lets open tunnels drain
+   local dropin="/etc/systemd/system/$AGN_WEBSOCKET_SERVICE.service.d/graceful.conf"
+   if [ ! -f "$dropin" ]; then
+       mkdir -p "$(dirname "$dropin")"
+       cat > "$dropin" <<EOF
+[Service]
+Type=notify
+NotifyAccess=all
+ExecReload=/bin/kill -USR2 \$MAINPID
+EOF
+       systemctl daemon-reload
+       systemctl restart $AGN_WEBSOCKET_SERVICE
+   else
+       systemctl daemon-reload
+       systemctl reload-or-restart $AGN_WEBSOCKET_SERVICE
+   fi
    sleep 2
    echo -e "${GREEN}✅ Service restarted${NC}"
    echo
@@ -518,7 +555,17 @@ view_connection_stats() {
    echo -e "${WHITE}📈 CONNECTION STATISTICS${NC}"
    echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
    
-   if [ -f "$LOG_FILE" ]; then
+   if [ -f "$ACCESS_LOG" ] && command -v jq > /dev/null; then
+       # One JSON record per closed tunnel; only the tail is parsed
+       echo -e "${GREEN}📊 Recent Connections:${NC}"
+       tail -5 "$ACCESS_LOG" | jq -r '"\(.ts | strftime("%Y-%m-%d %H:%M:%S")) \(.client) → \(.target) \(.duration)s ↑\(.up) ↓\(.down) \(.reason)"'
+       echo
+       echo -e "${BLUE}📈 Close Reasons (last 1000 tunnels):${NC}"
+       tail -1000 "$ACCESS_LOG" | jq -r '.reason' | sort | uniq -c | sort -rn
+       echo
+       echo -e "${RED}❌ Recent Errors:${NC}"
+       grep -E "(error|Error|ERROR)" "$LOG_FILE" 2>/dev/null | tail -5
+   elif [ -f "$LOG_FILE" ]; then
        echo -e "${GREEN}📊 Recent Connections:${NC}"
        grep "New tunnel" "$LOG_FILE" | tail -5
        echo
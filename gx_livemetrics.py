@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+import mmap
+import struct
+import time
+
+# =============================================
+# 📈 GX TUNNEL - Live metrics layout
+# =============================================
+# Fixed-layout memory-mapped file that gx_websocket.py rewrites every
+# interval and that its --live option and webgui.py read without touching
+# the tunnel or the database. Both sides import the layout from here.
+
+LIVE_METRICS_FILE = "/run/gx_tunnel/metrics.bin"
+LIVE_MAGIC = b'GXLIVE\0\0'
+LIVE_VERSION = 1
+# magic, version, seq, pid, user count, started, updated
+LIVE_HEADER = struct.Struct('<8sIIIIdd')
+LIVE_COUNTERS = ('active_connections', 'total_connections', 'handshaking', 'handshakes',
+                 'handshake_timeouts', 'oversized_headers', 'auth_failures',
+                 'banned_connections', 'blocked_connections', 'connect_failures',
+                 'active_download_bytes', 'active_upload_bytes')
+LIVE_COUNTER_BLOCK = struct.Struct(f'<{len(LIVE_COUNTERS)}Q')
+# username, sessions, reserved, download bytes, upload bytes
+LIVE_USER = struct.Struct('<32sIIQQ')
+LIVE_SEQ_OFFSET = 12
+
+def read_live_metrics(path=LIVE_METRICS_FILE, retries=100):
+    # Seqlock read: copy the file and retry if the tunnel rewrote it meanwhile
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for _ in range(retries):
+                seq = struct.unpack_from('<I', view, LIVE_SEQ_OFFSET)[0]
+                if seq & 1:
+                    time.sleep(0.001)
+                    continue
+                data = view[:]
+                if struct.unpack_from('<I', view, LIVE_SEQ_OFFSET)[0] == seq:
+                    break
+            else:
+                raise OSError('live metrics are being rewritten too often to read')
+
+    magic, version, _, pid, user_count, started, updated = LIVE_HEADER.unpack_from(data, 0)
+    if magic != LIVE_MAGIC or version != LIVE_VERSION:
+        raise ValueError(f'{path} is not a version {LIVE_VERSION} live metrics file')
+    offset = LIVE_HEADER.size
+    metrics = dict(zip(LIVE_COUNTERS, LIVE_COUNTER_BLOCK.unpack_from(data, offset)))
+    offset += LIVE_COUNTER_BLOCK.size
+    users = {}
+    for _ in range(user_count):
+        name, sessions, _, download_bytes, upload_bytes = LIVE_USER.unpack_from(data, offset)
+        users[name.rstrip(b'\0').decode('utf-8', 'replace')] = {
+            'sessions': sessions,
+            'download_bytes': download_bytes,
+            'upload_bytes': upload_bytes
+        }
+        offset += LIVE_USER.size
+    metrics.update(pid=pid, started=started, updated=updated, users=users)
+    return metrics
@@ -5,9 +5,10 @@ GX_TUNNEL_SERVICE="gx-tunnel"
 GX_WEBGUI_SERVICE="gx-webgui"
 PYTHON_SCRIPT_PATH="/opt/gx_tunnel/gx_websocket.py"
 WEBGUI_SCRIPT_PATH="/opt/gx_tunnel/webgui.py"
+USER_STORE_SCRIPT="/opt/gx_tunnel/gx_userstore.py"
 LOG_FILE="/var/log/gx_tunnel/websocket.log"
 CONNECTIONS_LOG="/var/log/gx_tunnel/connections.log"
-USER_DB="/opt/gx_tunnel/users.json"
+USER_DB="/opt/gx_tunnel/users.db"
 STATS_DB="/opt/gx_tunnel/statistics.db"
 CONFIG_FILE="/opt/gx_tunnel/gx_config.conf"
 
@@ -73,18 +74,12 @@ EOF
 
 # Function to load user database
 load_user_db() {
-    if [ -f "$USER_DB" ]; then
-        cat "$USER_DB"
-    else
-        echo '{"users": [], "settings": {}}'
-    fi
+    python3 "$USER_STORE_SCRIPT" export 2>/dev/null || echo '{"users": [], "settings": {}}'
 }
 
-# Function to save user database
-save_user_db() {
-    local data="$1"
-    echo "$data" > "$USER_DB"
-    chmod 600 "$USER_DB"
+# Function to check whether a user exists in the user store
+user_exists() {
+    python3 "$USER_STORE_SCRIPT" get "$1" >/dev/null 2>&1
 }
 
 # Function to get server IP
@@ -120,10 +115,7 @@ add_tunnel_user() {
     fi
 
     # Check if user exists in database
-    local user_db=$(load_user_db)
-    local user_exists=$(echo "$user_db" | jq -r ".users[] | select(.username == \"$username\") | .username")
-    
-    if [ -n "$user_exists" ]; then
+    if user_exists "$username"; then
         echo -e "${RED}❌ User $username already exists${NC}"
         return 1
     fi
@@ -147,17 +139,16 @@ add_tunnel_user() {
     # Create system user with nologin shell
     if useradd -m -s /usr/sbin/nologin "$username" 2>/dev/null; then
         if echo "$username:$password" | chpasswd 2>/dev/null; then
-            # Add to user database
-            local new_user=$(jq -n \
+            # Add to user database; the tunnel only stores a hash
+            local password_hash=$(printf '%s\n' "$password" | python3 "$PYTHON_SCRIPT_PATH" --hash-password)
+            jq -n \
                 --arg username "$username" \
-                --arg password "$password" \
+                --arg password "$password_hash" \
                 --arg created "$(date +%Y-%m-%d)" \
                 --arg expires "$expiry_date" \
                 --argjson max_conn "$max_connections" \
-                '{username: $username, password: $password, created: $created, expires: $expires, max_connections: $max_conn, active: true}')
-            
-            local updated_db=$(echo "$user_db" | jq ".users += [$new_user]")
-            save_user_db "$updated_db"
+                '{username: $username, password: $password, created: $created, expires: $expires, max_connections: $max_conn, active: true}' | \
+                python3 "$USER_STORE_SCRIPT" add
             
             echo -e "${GREEN}✅ User $username created successfully${NC}"
             show_user_config "$username" "$password" "$expiry_date" "$max_connections"
@@ -233,9 +224,7 @@ delete_tunnel_user() {
     fi
 
     # Check if user exists
-    local user_exists=$(echo "$user_db" | jq -r ".users[] | select(.username == \"$username\") | .username")
-    
-    if [ -z "$user_exists" ]; then
+    if ! user_exists "$username"; then
         echo -e "${RED}❌ User $username not found${NC}"
         return
     fi
@@ -243,8 +232,7 @@ delete_tunnel_user() {
     # Delete from system
     if userdel -r "$username" 2>/dev/null; then
         # Remove from database
-        local updated_db=$(echo "$user_db" | jq "del(.users[] | select(.username == \"$username\"))")
-        save_user_db "$updated_db"
+        python3 "$USER_STORE_SCRIPT" delete "$username"
         
         echo -e "${GREEN}✅ User $username deleted successfully${NC}"
     else
@@ -258,7 +246,7 @@ list_tunnel_users() {
     echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
     
     local user_db=$(load_user_db)
-    local users=$(echo "$user_db" | jq -r '.users[] | "\(.username)|\(.password)|\(.created)|\(.expires)|\(.max_connections)"' 2>/dev/null)
+    local users=$(echo "$user_db" | jq -r '.users[] | "\(.username)|\(if (.password | startswith("pbkdf2_sha256$")) then "(hashed)" else .password end)|\(.created)|\(.expires)|\(.max_connections)"' 2>/dev/null)
     
     if [ -z "$users" ]; then
         echo -e "${YELLOW}⚠️  No users found${NC}"
@@ -330,14 +318,18 @@ show_connection_stats() {
         echo -e "${WHITE}📈 CONNECTION STATISTICS${NC}"
         echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
         
-        # Get total statistics
-        local total_download=$(sqlite3 "$STATS_DB" "SELECT COALESCE(SUM(download_bytes), 0) FROM connection_log" 2>/dev/null || echo "0")
-        local total_upload=$(sqlite3 "$STATS_DB" "SELECT COALESCE(SUM(upload_bytes), 0) FROM connection_log" 2>/dev/null || echo "0")
-        local total_connections=$(sqlite3 "$STATS_DB" "SELECT COUNT(*) FROM connection_log" 2>/dev/null || echo "0")
+        # Totals are kept incrementally, no table scans needed
+        local total_download=$(sqlite3 "$STATS_DB" "SELECT COALESCE((SELECT value FROM global_stats WHERE key = 'total_download'), 0)" 2>/dev/null || echo "0")
+        local total_upload=$(sqlite3 "$STATS_DB" "SELECT COALESCE((SELECT value FROM global_stats WHERE key = 'total_upload'), 0)" 2>/dev/null || echo "0")
+        local total_connections=$(sqlite3 "$STATS_DB" "SELECT COALESCE((SELECT value FROM global_stats WHERE key = 'total_connections'), 0)" 2>/dev/null || echo "0")
+        local today=$(sqlite3 -separator ' ' "$STATS_DB" "SELECT connections, download_bytes + upload_bytes FROM rollup_daily WHERE username = '*' AND bucket = CAST(strftime('%s', 'now') AS INTEGER) / 86400 * 86400" 2>/dev/null)
+        local today_connections=$(echo "$today" | awk '{print $1+0}')
+        local today_bytes=$(echo "$today" | awk '{print $2+0}')
         
         echo -e "${WHITE}Total Connections: ${GREEN}$total_connections${NC}"
         echo -e "${WHITE}Total Download: ${GREEN}$(bytes_to_human $total_download)${NC}"
         echo -e "${WHITE}Total Upload: ${GREEN}$(bytes_to_human $total_upload)${NC}"
+        echo -e "${WHITE}Today (UTC): ${GREEN}$today_connections connections, $(bytes_to_human $today_bytes)${NC}"
     fi
 }
 
@@ -355,6 +347,156 @@ bytes_to_human() {
     fi
 }
 
+# Function to show temporary authentication bans
+show_auth_bans() {
+    echo -e "${WHITE}🚫 AUTHENTICATION BANS${NC}"
+    echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
+
+    local bans=$(python3 "$PYTHON_SCRIPT_PATH" --control bans 2>/dev/null)
+    if [ -z "$bans" ] || ! echo "$bans" | jq -e '.bans' >/dev/null 2>&1; then
+        echo -e "${RED}❌ Tunnel control socket not reachable${NC}"
+        return 1
+    fi
+
+    echo -e "${WHITE}Tracked keys: ${GREEN}$(echo "$bans" | jq -r '.tracked')${NC}"
+    if [ "$(echo "$bans" | jq '.bans | length')" -eq 0 ]; then
+        echo -e "${GREEN}✅ No active bans${NC}"
+        return
+    fi
+    echo "$bans" | jq -r '.bans[] | "\(.key)|\(.until)|\(.remaining)|\(.ban_count)"' | \
+        while IFS='|' read -r key until remaining count; do
+            printf "${RED}%-40s ${WHITE}until %s ${YELLOW}(%ss left, ban #%s)${NC}\n" "$key" "$until" "$remaining" "$count"
+        done
+}
+
+# Function to lift a temporary authentication ban
+unban_key() {
+    local key="$1"
+    if [ -z "$key" ]; then
+        read -p "Enter key to unban (e.g. ip:1.2.3.4 or user:alice): " key
+    fi
+    python3 "$PYTHON_SCRIPT_PATH" --control "unban $key"
+}
+
+# Function to show a user's data usage against their quotas
+show_user_quota() {
+    local username="$1"
+    if [ -z "$username" ]; then
+        read -p "Enter username: " username
+    fi
+    local usage=$(python3 "$PYTHON_SCRIPT_PATH" --control "quota $username" 2>/dev/null)
+    if ! echo "$usage" | jq -e '.total' >/dev/null 2>&1; then
+        echo -e "${RED}❌ Tunnel control socket not reachable${NC}"
+        return 1
+    fi
+    echo -e "${WHITE}📦 DATA QUOTA: $username${NC}"
+    echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
+    for period in daily monthly total; do
+        local used=$(echo "$usage" | jq -r ".$period")
+        local limit=$(echo "$usage" | jq -r ".${period}_limit")
+        if [ "$limit" -gt 0 ]; then
+            limit=$(numfmt --to=iec "$limit")
+        else
+            limit="unlimited"
+        fi
+        printf "  ${CYAN}%-8s ${YELLOW}%8s${NC} / %s\n" "$period" "$(numfmt --to=iec "$used")" "$limit"
+    done
+    if [ "$(echo "$usage" | jq -r '.within_quota')" != "true" ]; then
+        echo -e "${RED}⚠️  Quota reached${NC}"
+    fi
+}
+
+# Function to set a user's daily, monthly and total quotas (e.g. 2G, 0 = none)
+set_user_quota() {
+    local username="$1"
+    if [ -z "$username" ]; then
+        read -p "Enter username: " username
+    fi
+    if ! user_exists "$username"; then
+        echo -e "${RED}❌ User $username not found${NC}"
+        return 1
+    fi
+    local daily monthly total
+    read -p "Daily quota (e.g. 2G, 0 for none): " daily
+    read -p "Monthly quota (e.g. 50G, 0 for none): " monthly
+    read -p "Total quota (e.g. 500G, 0 for none): " total
+    daily=$(numfmt --from=iec "${daily:-0}" 2>/dev/null) || { echo -e "${RED}❌ Invalid size${NC}"; return 1; }
+    monthly=$(numfmt --from=iec "${monthly:-0}" 2>/dev/null) || { echo -e "${RED}❌ Invalid size${NC}"; return 1; }
+    total=$(numfmt --from=iec "${total:-0}" 2>/dev/null) || { echo -e "${RED}❌ Invalid size${NC}"; return 1; }
+
+    jq -n --argjson daily "$daily" --argjson monthly "$monthly" --argjson total "$total" \
+        '{quota_daily: $daily, quota_monthly: $monthly, quota_total: $total}' | \
+        python3 "$USER_STORE_SCRIPT" update "$username"
+    echo -e "${GREEN}✅ Quotas for $username updated${NC}"
+}
+
+# Function to reload tunnel.conf and users without dropping tunnels
+reload_tunnel_config() {
+    local result=$(python3 "$PYTHON_SCRIPT_PATH" --control reload 2>/dev/null)
+    if echo "$result" | jq -e '.generation' >/dev/null 2>&1; then
+        echo -e "${GREEN}✅ Configuration generation $(echo "$result" | jq -r '.generation') loaded in $(echo "$result" | jq -r '.reload_ms')ms${NC}"
+    elif echo "$result" | jq -e '.error' >/dev/null 2>&1; then
+        echo -e "${RED}❌ Reload failed: $(echo "$result" | jq -r '.error')${NC}"
+        return 1
+    else
+        echo -e "${RED}❌ Tunnel control socket not reachable${NC}"
+        return 1
+    fi
+}
+
+# Function to show the slowest recent handshakes with their phase breakdown
+show_slow_handshakes() {
+    local count=${1:-10}
+    echo -e "${WHITE}🐢 SLOWEST HANDSHAKES${NC}"
+    echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
+
+    local traces=$(python3 "$PYTHON_SCRIPT_PATH" --control "slow $count" 2>/dev/null)
+    if [ -z "$traces" ] || ! echo "$traces" | jq -e 'type == "array"' >/dev/null 2>&1; then
+        echo -e "${RED}❌ Tunnel control socket not reachable${NC}"
+        return 1
+    fi
+    if [ "$(echo "$traces" | jq 'length')" -eq 0 ]; then
+        echo -e "${GREEN}✅ No completed handshakes yet${NC}"
+        return
+    fi
+    echo "$traces" | jq -r '.[] | "\(.time)|\(.id)|\(.user)|\(.total_ms)|\(.phases | to_entries | map("\(.key)=\(.value)ms") | join(" "))"' | \
+        while IFS='|' read -r time id user total phases; do
+            printf "${WHITE}%s ${CYAN}#%-8s ${YELLOW}%-16s ${RED}%10sms ${NC}%s\n" "$time" "$id" "$user" "$total" "$phases"
+        done
+}
+
+# Function to capture a profile, thread dump and allocation diff
+capture_profile() {
+    local seconds=${1:-30}
+    local result=$(python3 "$PYTHON_SCRIPT_PATH" --control "profile $seconds" 2>/dev/null)
+    if echo "$result" | jq -e '.profile' >/dev/null 2>&1; then
+        echo -e "${GREEN}✅ Profiling for ${seconds}s${NC}"
+        echo "$result" | jq -r '"  threads: \(.threads)\n  profile: \(.profile)\n  folded:  \(.folded)\n  memory:  \(.memory)"'
+    elif echo "$result" | jq -e '.error' >/dev/null 2>&1; then
+        echo -e "${RED}❌ $(echo "$result" | jq -r '.error')${NC}"
+        return 1
+    else
+        echo -e "${RED}❌ Tunnel control socket not reachable${NC}"
+        return 1
+    fi
+}
+
+# Function to show live tunnel counters
+show_live_stats() {
+    local live=$(python3 "$PYTHON_SCRIPT_PATH" --live 2>/dev/null)
+    if ! echo "$live" | jq -e '.pid' >/dev/null 2>&1; then
+        echo -e "${RED}❌ Live metrics not available (is gx-tunnel running?)${NC}"
+        return 1
+    fi
+    
+    echo -e "${WHITE}⚡ LIVE TUNNEL COUNTERS${NC}"
+    echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
+    echo "$live" | jq -r 'to_entries[] | select(.value | type == "number") | select(.key != "pid" and .key != "started" and .key != "updated") | "  \(.key): \(.value)"'
+    echo
+    echo -e "${WHITE}👥 ACTIVE USERS${NC}"
+    echo "$live" | jq -r '.users | to_entries[] | "  \(.key): \(.value.sessions) sessions, ↓\(.value.download_bytes) ↑\(.value.upload_bytes) bytes"'
+}
+
 # Function to show VPS statistics
 show_vps_stats() {
     echo -e "${WHITE}💻 VPS STATISTICS${NC}"
@@ -402,7 +544,8 @@ restart_services() {
     echo -e "${WHITE}🔄 RESTARTING GX TUNNEL SERVICES${NC}"
     echo -e "${CYAN}───────────────────────────────────────────────────────────${NC}"
     
-    systemctl restart "$GX_TUNNEL_SERVICE"
+    # reload hands the listening socket to a new process, open tunnels drain
+    systemctl reload-or-restart "$GX_TUNNEL_SERVICE"
     systemctl restart "$GX_WEBGUI_SERVICE"
     sleep 2
     show_service_status
@@ -595,8 +738,35 @@ case "${1:-}" in
     "logs")
         show_realtime_logs
         ;;
+    "bans")
+        show_auth_bans
+        ;;
+    "unban")
+        unban_key "$2"
+        ;;
+    "reload")
+        reload_tunnel_config
+        ;;
+    "live")
+        show_live_stats
+        ;;
+    "slow")
+        show_slow_handshakes "$2"
+        ;;
+    "hash-users")
+        python3 "$PYTHON_SCRIPT_PATH" --hash-users
+        ;;
+    "profile")
+        capture_profile "$2"
+        ;;
+    "quota")
+        show_user_quota "$2"
+        ;;
+    "set-quota")
+        set_user_quota "$2"
+        ;;
     *)
-        echo -e "${GREEN}Usage: $0 {menu|start|stop|restart|status|add-user|list-users|stats|logs}${NC}"
+        echo -e "${GREEN}Usage: $0 {menu|start|stop|restart|status|add-user|list-users|stats|logs|bans|unban|reload|live|slow|profile|hash-users|quota|set-quota}${NC}"
         echo
         echo -e "${WHITE}Commands:${NC}"
         echo -e "  ${CYAN}menu${NC}       - Show interactive menu"
@@ -608,6 +778,15 @@ case "${1:-}" in
         echo -e "  ${CYAN}list-users${NC} - List all users"
         echo -e "  ${CYAN}stats${NC}      - Show VPS statistics"
         echo -e "  ${CYAN}logs${NC}       - Show real-time logs"
+        echo -e "  ${CYAN}bans${NC}       - Show temporary authentication bans"
+        echo -e "  ${CYAN}unban${NC}      - Lift a ban (ip:<addr> or user:<name>)"
+        echo -e "  ${CYAN}reload${NC}     - Reload tunnel.conf and users without dropping tunnels"
+        echo -e "  ${CYAN}live${NC}       - Show live counters and active users"
+        echo -e "  ${CYAN}slow${NC}       - Show the slowest handshakes by phase (optional count)"
+        echo -e "  ${CYAN}hash-users${NC} - Replace plaintext passwords in the user store with hashes"
+        echo -e "  ${CYAN}profile${NC}    - Capture a profile into /var/log/gx_tunnel/profiles (optional seconds)"
+        echo -e "  ${CYAN}quota${NC}      - Show a user's data usage against their quotas"
+        echo -e "  ${CYAN}set-quota${NC}  - Set a user's daily, monthly and total data quotas"
         exit 1
         ;;
 esac
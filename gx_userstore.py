@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+import sqlite3
+import threading
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# =============================================
+# 👥 GX TUNNEL - Shared user store
+# =============================================
+# One SQLite database used by gx_websocket.py, webgui.py and gx_manager.sh
+# (through the command line below). WAL lets the tunnel keep reading while
+# an admin tool writes, every change is its own short transaction on one
+# row, and triggers log the changed usernames so the tunnel reloads only
+# those.
+
+USER_STORE = "/opt/gx_tunnel/users.db"
+LEGACY_USER_DB = "/opt/gx_tunnel/users.json"  # imported once, then renamed
+USER_CHANGE_RETENTION = 86400  # seconds user_changes rows are kept
+
+USER_FIELDS = ('username', 'password', 'created', 'expires', 'max_connections', 'active',
+               'quota_daily', 'quota_monthly', 'quota_total')
+
+DEFAULT_SETTINGS = {
+    'max_users': 100,
+    'default_expiry_days': 30,
+    'max_connections_per_user': 3
+}
+
+# users.db schema steps, applied in order and recorded in PRAGMA user_version
+USER_MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE users (
+               username TEXT PRIMARY KEY,
+               password TEXT NOT NULL,
+               created TEXT,
+               expires TEXT,
+               max_connections INTEGER,
+               active INTEGER NOT NULL DEFAULT 1,
+               quota_daily INTEGER,
+               quota_monthly INTEGER,
+               quota_total INTEGER
+           )''',
+        'CREATE INDEX idx_users_expires ON users (expires) WHERE expires IS NOT NULL',
+        '''CREATE TABLE settings (
+               key TEXT PRIMARY KEY,
+               value TEXT NOT NULL
+           )''',
+        # '*' marks a settings change, which reloads everything
+        '''CREATE TABLE user_changes (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username TEXT NOT NULL,
+               changed_at INTEGER NOT NULL
+           )''',
+        '''CREATE TRIGGER users_insert AFTER INSERT ON users BEGIN
+               INSERT INTO user_changes (username, changed_at) VALUES (NEW.username, CAST(strftime('%s', 'now') AS INTEGER));
+           END''',
+        '''CREATE TRIGGER users_update AFTER UPDATE ON users BEGIN
+               INSERT INTO user_changes (username, changed_at) VALUES (OLD.username, CAST(strftime('%s', 'now') AS INTEGER));
+               INSERT INTO user_changes (username, changed_at) SELECT NEW.username, CAST(strftime('%s', 'now') AS INTEGER)
+                   WHERE NEW.username != OLD.username;
+           END''',
+        '''CREATE TRIGGER users_delete AFTER DELETE ON users BEGIN
+               INSERT INTO user_changes (username, changed_at) VALUES (OLD.username, CAST(strftime('%s', 'now') AS INTEGER));
+           END''',
+        '''CREATE TRIGGER settings_insert AFTER INSERT ON settings BEGIN
+               INSERT INTO user_changes (username, changed_at) VALUES ('*', CAST(strftime('%s', 'now') AS INTEGER));
+           END''',
+        '''CREATE TRIGGER settings_update AFTER UPDATE ON settings BEGIN
+               INSERT INTO user_changes (username, changed_at) VALUES ('*', CAST(strftime('%s', 'now') AS INTEGER));
+           END''',
+    ]),
+]
+
+def user_row(user):
+    # users.json record -> users row values
+    return (user['username'], user['password'], user.get('created'), user.get('expires') or None,
+            user.get('max_connections'), 1 if user.get('active', True) else 0,
+            user.get('quota_daily'), user.get('quota_monthly'), user.get('quota_total'))
+
+def row_user(row):
+    user = dict(zip(USER_FIELDS, row))
+    user['active'] = bool(user['active'])
+    return user
+
+class UserStore:
+    def __init__(self, path=USER_STORE, legacy_path=LEGACY_USER_DB):
+        self.path = path
+        self.legacy_path = legacy_path
+        # Long-lived connection for PRAGMA data_version polling, which only
+        # reports commits made by other connections
+        self.watch_conn = None
+        self.watch_version = None
+        self.watch_lock = threading.Lock()
+        if not os.path.exists(path):
+            # Holds password hashes: owner only, like users.json was
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        conn = self.connect()
+        try:
+            # Switching modes needs the write lock; it is persistent, so only once
+            if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+                conn.execute('PRAGMA journal_mode=WAL')
+            self.migrate(conn)
+        finally:
+            conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def transaction(self, conn=None):
+        # BEGIN IMMEDIATE takes the write lock up front, so two writers queue
+        # on busy_timeout instead of failing when a read upgrades to a write
+        own = conn is None
+        if own:
+            conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            if own:
+                conn.close()
+
+    @contextmanager
+    def snapshot(self, conn=None):
+        # Read transaction: every query inside sees the same state
+        own = conn is None
+        if own:
+            conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            conn.execute('COMMIT')
+            if own:
+                conn.close()
+
+    def migrate(self, conn):
+        # Plain read first, so opening a current database never takes the
+        # write lock; the version is checked again inside each transaction
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= USER_MIGRATIONS[-1][0]:
+            return
+        imported = False
+        for version, statements in USER_MIGRATIONS:
+            with self.transaction(conn):
+                if conn.execute('PRAGMA user_version').fetchone()[0] < version:
+                    for sql in statements:
+                        conn.execute(sql)
+                    if version == 1:
+                        imported = self.import_legacy(conn)
+                    conn.execute(f'PRAGMA user_version = {version}')
+        if imported:
+            # Renamed only once the import has committed
+            os.replace(self.legacy_path, f'{self.legacy_path}.imported')
+
+    def import_legacy(self, conn):
+        # One-time import of users.json, in the transaction that creates the
+        # tables so concurrent first starts cannot import it twice
+        settings = dict(DEFAULT_SETTINGS)
+        imported = bool(self.legacy_path) and os.path.exists(self.legacy_path)
+        if imported:
+            with open(self.legacy_path) as f:
+                data = json.load(f)
+            self.insert_users(conn, data.get('users', []))
+            settings.update(data.get('settings', {}))
+        conn.executemany('INSERT INTO settings (key, value) VALUES (?, ?)',
+                         [(key, json.dumps(value)) for key, value in settings.items()])
+        return imported
+
+    def insert_users(self, conn, users):
+        # Returns the usernames that already existed and were left alone
+        existing = []
+        for user in users:
+            cursor = conn.execute(f'INSERT OR IGNORE INTO users ({", ".join(USER_FIELDS)}) VALUES ({", ".join("?" * len(USER_FIELDS))})',
+                                  user_row(user))
+            if not cursor.rowcount:
+                existing.append(user['username'])
+        return existing
+
+    def get_user(self, username, conn=None):
+        own = conn is None
+        if own:
+            conn = self.connect()
+        try:
+            row = conn.execute(f'SELECT {", ".join(USER_FIELDS)} FROM users WHERE username = ?', (username,)).fetchone()
+        finally:
+            if own:
+                conn.close()
+        return row_user(row) if row else None
+
+    def load(self, conn=None):
+        # (users, settings, newest change id), read consistently
+        with self.snapshot(conn) as conn:
+            change_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM user_changes').fetchone()[0]
+            users = [row_user(row) for row in conn.execute(f'SELECT {", ".join(USER_FIELDS)} FROM users ORDER BY username')]
+            settings = {key: json.loads(value) for key, value in conn.execute('SELECT key, value FROM settings')}
+        return users, settings, change_id
+
+    def export(self):
+        users, settings, _ = self.load()
+        return {'users': users, 'settings': settings}
+
+    def add_user(self, user):
+        with self.transaction() as conn:
+            return not self.insert_users(conn, [user])
+
+    def add_users(self, users):
+        # Bulk insert in one transaction; returns the usernames that already existed
+        with self.transaction() as conn:
+            return self.insert_users(conn, users)
+
+    def update_user(self, username, **fields):
+        fields = {key: value for key, value in fields.items() if key in USER_FIELDS}
+        if 'active' in fields:
+            fields['active'] = 1 if fields['active'] else 0
+        if not fields:
+            return self.get_user(username) is not None
+        with self.transaction() as conn:
+            cursor = conn.execute(f'UPDATE users SET {", ".join(f"{key} = ?" for key in fields)} WHERE username = ?',
+                                  (*fields.values(), username))
+            return cursor.rowcount > 0
+
+    def delete_user(self, username):
+        with self.transaction() as conn:
+            return conn.execute('DELETE FROM users WHERE username = ?', (username,)).rowcount > 0
+
+    def set_setting(self, key, value):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                         (key, json.dumps(value)))
+
+    def changed(self):
+        # Cheap poll: True when another connection has committed since the last call
+        with self.watch_lock:
+            if self.watch_conn is None:
+                self.watch_conn = self.connect()
+                self.watch_version = self.watch_conn.execute('PRAGMA data_version').fetchone()[0]
+                return True
+            version = self.watch_conn.execute('PRAGMA data_version').fetchone()[0]
+            changed, self.watch_version = version != self.watch_version, version
+            return changed
+
+    def changes_since(self, change_id):
+        # (usernames changed after change_id, newest id). Usernames is None
+        # when the log was pruned past change_id or settings changed, in
+        # which case the caller reloads everything.
+        with self.snapshot() as conn:
+            oldest = conn.execute('SELECT MIN(id) FROM user_changes').fetchone()[0]
+            rows = conn.execute('SELECT id, username FROM user_changes WHERE id > ? ORDER BY id', (change_id,)).fetchall()
+        if not rows:
+            return [], change_id
+        usernames = {username for _, username in rows}
+        if (oldest is not None and oldest > change_id + 1) or '*' in usernames:
+            return None, rows[-1][0]
+        return sorted(usernames), rows[-1][0]
+
+    def prune_changes(self, max_age=USER_CHANGE_RETENTION):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM user_changes WHERE changed_at < ?', (int(time.time()) - max_age,))
+
+def main(argv):
+    # Command line used by gx_manager.sh. Users and fields are read as JSON
+    # on stdin, so password hashes stay out of the process list.
+    usage = 'Usage: gx_userstore.py {export|get <user>|add|update <user>|delete <user>|set-setting <key> <json>|import <users.json>}'
+    if not argv:
+        print(usage, file=sys.stderr)
+        return 2
+    command, args = argv[0], argv[1:]
+    path = os.environ.get('GX_USER_STORE', USER_STORE)
+    store = UserStore(path)
+    if command == 'export':
+        print(json.dumps(store.export(), indent=2))
+    elif command == 'get' and len(args) == 1:
+        user = store.get_user(args[0])
+        if user is None:
+            return 1
+        print(json.dumps(user))
+    elif command == 'add':
+        if not store.add_user(json.load(sys.stdin)):
+            print('User already exists', file=sys.stderr)
+            return 1
+    elif command == 'update' and len(args) == 1:
+        if not store.update_user(args[0], **json.load(sys.stdin)):
+            print('User not found', file=sys.stderr)
+            return 1
+    elif command == 'delete' and len(args) == 1:
+        if not store.delete_user(args[0]):
+            print('User not found', file=sys.stderr)
+            return 1
+    elif command == 'set-setting' and len(args) == 2:
+        store.set_setting(args[0], json.loads(args[1]))
+    elif command == 'import' and len(args) == 1:
+        # Merge another users.json; existing usernames are kept as they are
+        with open(args[0]) as f:
+            data = json.load(f)
+        with store.transaction() as conn:
+            existing = store.insert_users(conn, data.get('users', []))
+        print(json.dumps({'imported': len(data.get('users', [])) - len(existing), 'skipped': existing}))
+    else:
+        print(usage, file=sys.stderr)
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,15 +2,42 @@
 import socket
 import threading
 import select
+import selectors
 import sys
 import getopt
 import time
 import logging
-from datetime import datetime
+import logging.handlers
+import queue
+import atexit
+import re
+import gzip
+import shutil
+import random
+from datetime import datetime, timezone
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os
 import json
+import signal
+import subprocess
+import itertools
+import ipaddress
+import bisect
+import heapq
+import traceback
+import tracemalloc
+import http.server
 import hashlib
+import hmac
+import base64
+import getpass
 import sqlite3
+import mmap
+import struct
+from gx_userstore import UserStore
+from gx_livemetrics import (LIVE_METRICS_FILE, LIVE_MAGIC, LIVE_VERSION, LIVE_HEADER, LIVE_COUNTERS,
+                            LIVE_COUNTER_BLOCK, LIVE_USER, LIVE_SEQ_OFFSET, read_live_metrics)
 from typing import Dict, List, Optional
 
 # =============================================
@@ -25,23 +52,278 @@ TIMEOUT = 60
 DEFAULT_HOST = '127.0.0.1:22'
 RESPONSE = 'HTTP/1.1 101 Switching Protocols\r\n\r\nContent-Length: 104857600000\r\n\r\n'
 
+# Execution mode: 'thread' runs one thread per connection, 'pool' runs
+# handshakes on a bounded thread pool and relays tunnels on RELAY_WORKERS
+# selector loops
+EXEC_MODE = 'thread'
+RELAY_WORKERS = os.cpu_count() or 2
+HANDSHAKE_WORKERS = 64
+# Accepted sockets allowed to wait for a handshake worker; further ones are
+# closed at once, since their handshake deadline runs while they queue
+HANDSHAKE_BACKLOG = 256
+
 # Database paths
-USER_DB = "/opt/gx_tunnel/users.json"
+USER_DB = "/opt/gx_tunnel/users.db"
+LEGACY_USER_DB = "/opt/gx_tunnel/users.json"  # imported into USER_DB on first start
+USER_RELOAD_INTERVAL = 2  # seconds between checks for changed users
+
+# Passwords are stored as pbkdf2_sha256$<iterations>$<salt>$<hash> (base64).
+# Plaintext entries from older installs still work until --hash-users.
+PASSWORD_HASH_ITERATIONS = 200000
+AUTH_CACHE_SIZE = 4096    # recent successful verifications kept in memory
+
+# A login over the user's max_connections is refused ('reject') or closes
+# that user's oldest session to make room ('evict')
+SESSION_LIMIT_POLICY = 'reject'
+
+# Data quotas: user records may set quota_daily, quota_monthly and
+# quota_total in bytes (UTC days and months). A user at a limit is cut off
+# ('disconnect') or slowed to QUOTA_THROTTLE_RATE bytes/s ('throttle').
+QUOTA_ACTION = 'disconnect'
+QUOTA_THROTTLE_RATE = 32 * 1024
+QUOTA_CHECK_BYTES = 256 * 1024  # bytes a tunnel relays between quota checks
 STATS_DB = "/opt/gx_tunnel/statistics.db"
 LOG_DIR = "/var/log/gx_tunnel"
 
+# Statistics writer: finished tunnels are queued and written in batches
+STATS_BATCH_SIZE = 500       # rows per transaction at most
+STATS_FLUSH_INTERVAL = 1.0   # seconds a row may wait before it is written
+STATS_QUEUE_SIZE = 100000    # rows beyond this are dropped rather than block
+
+# Retention: raw connection_log rows are pruned after STATS_RETENTION_DAYS
+# (0 keeps them); long-term totals live in the rollup tables
+STATS_RETENTION_DAYS = 90
+STATS_ARCHIVE_DB = ""        # copy pruned rows here first, e.g. /opt/gx_tunnel/archive.db
+ROLLUP_HOURLY_RETENTION_DAYS = 90
+STATS_MAINTENANCE_INTERVAL = 3600  # seconds between prune runs
+STATS_VACUUM_DAYS = 7        # days between VACUUMs, 0 disables
+STATS_PRUNE_BATCH = 5000     # rows deleted per transaction
+STATS_CHECKPOINT_INTERVAL = 60  # seconds between in-flight byte checkpoints, 0 disables
+
+# statistics.db schema steps, applied in order by StatisticsManager.migrate
+# and recorded in PRAGMA user_version
+STATS_MIGRATIONS = [
+    # 1: original layout (text timestamps, no indexes)
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS user_stats (
+               username TEXT PRIMARY KEY,
+               connections INTEGER DEFAULT 0,
+               download_bytes INTEGER DEFAULT 0,
+               upload_bytes INTEGER DEFAULT 0,
+               last_connection TEXT
+           )''',
+        '''CREATE TABLE IF NOT EXISTS global_stats (
+               key TEXT PRIMARY KEY,
+               value INTEGER DEFAULT 0
+           )''',
+        '''CREATE TABLE IF NOT EXISTS connection_log (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username TEXT,
+               client_ip TEXT,
+               start_time TEXT,
+               end_time TEXT,
+               duration INTEGER,
+               download_bytes INTEGER,
+               upload_bytes INTEGER
+           )''',
+    ]),
+    # 2: integer epoch timestamps, lookup indexes, total_connections counter
+    (2, [
+        '''CREATE TABLE user_stats_v2 (
+               username TEXT PRIMARY KEY,
+               connections INTEGER NOT NULL DEFAULT 0,
+               download_bytes INTEGER NOT NULL DEFAULT 0,
+               upload_bytes INTEGER NOT NULL DEFAULT 0,
+               last_connection INTEGER
+           )''',
+        '''INSERT INTO user_stats_v2
+           SELECT username, COALESCE(connections, 0), COALESCE(download_bytes, 0), COALESCE(upload_bytes, 0),
+                  CAST(strftime('%s', last_connection) AS INTEGER)
+           FROM user_stats''',
+        'DROP TABLE user_stats',
+        'ALTER TABLE user_stats_v2 RENAME TO user_stats',
+        '''CREATE TABLE connection_log_v2 (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username TEXT,
+               client_ip TEXT,
+               start_time INTEGER,
+               end_time INTEGER,
+               duration INTEGER,
+               download_bytes INTEGER,
+               upload_bytes INTEGER
+           )''',
+        '''INSERT INTO connection_log_v2
+           SELECT id, username, client_ip,
+                  CAST(strftime('%s', start_time) AS INTEGER), CAST(strftime('%s', end_time) AS INTEGER),
+                  duration, download_bytes, upload_bytes
+           FROM connection_log''',
+        'DROP TABLE connection_log',
+        'ALTER TABLE connection_log_v2 RENAME TO connection_log',
+        'CREATE INDEX idx_connection_log_user_time ON connection_log (username, start_time)',
+        'CREATE INDEX idx_connection_log_time ON connection_log (start_time)',
+        '''INSERT INTO global_stats (key, value) SELECT 'total_connections', COUNT(*) FROM connection_log WHERE 1
+           ON CONFLICT(key) DO UPDATE SET value = excluded.value''',
+    ]),
+    # 3: hourly/daily rollups per user and globally (username '*'),
+    # bucketed by close time in UTC and backfilled from connection_log
+    (3, [
+        '''CREATE TABLE rollup_hourly (
+               bucket INTEGER NOT NULL,
+               username TEXT NOT NULL,
+               connections INTEGER NOT NULL DEFAULT 0,
+               download_bytes INTEGER NOT NULL DEFAULT 0,
+               upload_bytes INTEGER NOT NULL DEFAULT 0,
+               duration INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (bucket, username)
+           ) WITHOUT ROWID''',
+        '''CREATE TABLE rollup_daily (
+               bucket INTEGER NOT NULL,
+               username TEXT NOT NULL,
+               connections INTEGER NOT NULL DEFAULT 0,
+               download_bytes INTEGER NOT NULL DEFAULT 0,
+               upload_bytes INTEGER NOT NULL DEFAULT 0,
+               duration INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (bucket, username)
+           ) WITHOUT ROWID''',
+        'CREATE INDEX idx_rollup_daily_user ON rollup_daily (username, bucket)',
+        '''CREATE TABLE maintenance (
+               key TEXT PRIMARY KEY,
+               value INTEGER
+           )''',
+        '''INSERT INTO rollup_hourly
+           SELECT end_time - end_time % 3600, COALESCE(username, ''), COUNT(*),
+                  SUM(download_bytes), SUM(upload_bytes), SUM(duration)
+           FROM connection_log WHERE end_time IS NOT NULL GROUP BY 1, 2''',
+        '''INSERT INTO rollup_hourly
+           SELECT bucket, '*', SUM(connections), SUM(download_bytes), SUM(upload_bytes), SUM(duration)
+           FROM rollup_hourly GROUP BY bucket''',
+        '''INSERT INTO rollup_daily
+           SELECT bucket - bucket % 86400, username, SUM(connections),
+                  SUM(download_bytes), SUM(upload_bytes), SUM(duration)
+           FROM rollup_hourly GROUP BY 1, 2''',
+    ]),
+]
+
+# Access control lists (one CIDR per line, IPv4 or IPv6)
+CIDR_ALLOW_FILE = "/opt/gx_tunnel/cidr_allow.txt"
+CIDR_DENY_FILE = "/opt/gx_tunnel/cidr_deny.txt"
+CIDR_RELOAD_INTERVAL = 5  # seconds
+
+# Graceful restart: SIGUSR2 (systemctl reload) starts a new process, hands it
+# the listening socket and lets existing tunnels drain
+LISTEN_BACKLOG = 512
+HANDOFF_SOCKET = "/run/gx_tunnel/handoff.sock"
+HANDOFF_TIMEOUT = 15  # seconds for the new process to take over
+DRAIN_TIMEOUT = 300   # seconds old tunnels may keep running after a handoff
+
+# Runtime configuration file (KEY=value lines, '#' comments). Overrides the
+# defaults above; reloaded on SIGHUP without dropping open tunnels.
+CONFIG_FILE = "/opt/gx_tunnel/tunnel.conf"
+CONFIG_KEYS = {
+    'LISTENING_ADDR': ('listening_addr', str),
+    'LISTENING_PORT': ('listening_port', int),
+    'BUFLEN': ('buflen', int),
+    'TIMEOUT': ('timeout', int),
+    'DEFAULT_HOST': ('default_host', str),
+    'HANDSHAKE_TIMEOUT': ('handshake_timeout', float),
+    'MAX_HEADER_SIZE': ('max_header_size', int),
+    'LOG_SAMPLE_RATE': ('log_sample_rate', float),
+    'TRACE_SAMPLE_RATE': ('trace_sample_rate', float),
+    'SESSION_LIMIT_POLICY': ('session_limit_policy', str),
+    'QUOTA_ACTION': ('quota_action', str),
+    'QUOTA_THROTTLE_RATE': ('quota_throttle_rate', int),
+}
+CLI_OVERRIDES = {}
+
+# Logging: 'auto' colours the console only when it is a terminal
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+COLOR_OUTPUT = 'auto'
+LOG_SAMPLE_RATE = 1.0  # share of connections whose per-event info lines are logged
+TRACE_SAMPLE_RATE = 0.0  # share of handshakes whose per-phase timings are logged
+log_listener = None
+
+# Structured access log: one JSON object per closed tunnel
+ACCESS_LOG = f"{LOG_DIR}/access.jsonl"
+ACCESS_LOG_ROTATE = 'size'  # 'size', or a time interval such as 'midnight' or 'H'
+ACCESS_LOG_MAX_BYTES = 50 * 1024 * 1024
+ACCESS_LOG_BACKUPS = 7
+ACCESS_LOG_COMPRESS = True  # gzip rotated files
+access_log = logging.getLogger('gx.access')
+access_listener = None
+
+# Number of recent open/close events kept in memory
+EVENT_RING_SIZE = 1000
+
+# Slowest completed handshakes kept with their per-phase breakdown
+SLOW_TRACE_SIZE = 50
+
+# On-demand profiling (SIGUSR1 or the profile control command): a thread
+# dump, a sampling profile and a tracemalloc diff over a short window.
+# Nothing runs or is traced until a capture is requested.
+PROFILE_DIR = f"{LOG_DIR}/profiles"
+PROFILE_DURATION = 30           # seconds per capture
+PROFILE_MAX_DURATION = 120      # longer requests are cut to this
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TRACE_FRAMES = 10       # stack depth kept per allocation
+PROFILE_TOP = 50                # lines in the summaries
+
+# Handshake limits
+HANDSHAKE_TIMEOUT = 10  # seconds to receive the complete request headers
+MAX_HEADER_SIZE = 8192
+
+# Authentication failure throttling
+AUTH_FAIL_THRESHOLD = 5       # decayed failures before a temporary ban
+AUTH_FAIL_HALF_LIFE = 300     # seconds for a failure to lose half its weight
+AUTH_BAN_TIME = 600           # first ban in seconds, doubled on each repeat
+AUTH_BAN_MAX = 86400
+AUTH_TRACKER_SIZE = 65536     # max tracked IPs/usernames
+
+# Admin control socket
+CONTROL_SOCKET = "/run/gx_tunnel/control.sock"
+
+# Live metrics: a fixed-layout memory-mapped file rewritten every interval
+# for the web GUI and CLI; the layout and reader live in gx_livemetrics.py
+LIVE_METRICS_INTERVAL = 1   # seconds between snapshots
+LIVE_METRICS_USERS = 512    # per-user slots; the busiest users are kept
+
+# TCP_INFO sampling of client sockets (Linux): RTT, cwnd, retransmits and
+# delivery rate per tunnel, to tell a slow proxy from a slow network path
+TCP_INFO_INTERVAL = 10  # seconds between samples, 0 disables
+TCP_INFO_LENGTH = 168   # struct tcp_info up to tcpi_delivery_rate
+
+# Prometheus metrics endpoint, off unless METRICS_PORT is set
+METRICS_ADDR = '127.0.0.1'
+METRICS_PORT = 0
+METRICS_NAMESPACE = 'gx_tunnel'
+HANDSHAKE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONNECT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 14400, 86400)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912, 4294967296)
+
 # Statistics
 connection_stats = {
     'total_connections': 0,
     'active_connections': 0,
     'connections_per_minute': 0,
+    'blocked_connections': 0,
+    'handshaking': 0,
+    'handshakes': 0,
+    'handshake_timeouts': 0,
+    'oversized_headers': 0,
+    'connect_failures': 0,
+    'banned_connections': 0,
+    'handshake_overflows': 0,
+    'auth_failures': 0,
+    'download_bytes': 0,
+    'upload_bytes': 0,
     'last_reset': time.time(),
     'start_time': time.time()
 }
 
 # Active connections tracking
 active_connections = {}
-user_connections = {}
+
+stats_lock = threading.Lock()
 
 # Color codes for pretty output
 class Colors:
@@ -55,6 +337,11 @@ class Colors:
     RESET = '\033[0m'
     BOLD = '\033[1m'
 
+    @classmethod
+    def disable(cls):
+        for name in ('RED', 'GREEN', 'YELLOW', 'BLUE', 'MAGENTA', 'CYAN', 'WHITE', 'RESET', 'BOLD'):
+            setattr(cls, name, '')
+
 # Setup logging with colors and enhanced format
 class ColorFormatter(logging.Formatter):
     FORMATS = {
@@ -65,10 +352,61 @@ class ColorFormatter(logging.Formatter):
         logging.CRITICAL: Colors.RED + Colors.BOLD + "%(asctime)s - %(levelname)s - %(message)s" + Colors.RESET
     }
 
+    def __init__(self):
+        logging.Formatter.__init__(self, LOG_FORMAT)
+        # One formatter per level, built once instead of on every record
+        self.formatters = {level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()}
+
+    def format(self, record):
+        formatter = self.formatters.get(record.levelno)
+        return formatter.format(record) if formatter else logging.Formatter.format(self, record)
+
+class PlainFormatter(logging.Formatter):
+    # Log files get the messages without the ANSI colour codes embedded in them
+    ANSI_CODES = re.compile(r'\x1b\[[0-9;]*m')
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.ANSI_CODES.sub('', logging.Formatter.format(self, record))
+
+class AccessFormatter(logging.Formatter):
+    # Serialised on the listener thread, not in the connection thread
+    def format(self, record):
+        return json.dumps(record.access, separators=(',', ':'))
+
+def gzip_namer(name):
+    return name + '.gz'
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def setup_access_log():
+    global access_listener
+    if ACCESS_LOG_ROTATE == 'size':
+        handler = logging.handlers.RotatingFileHandler(ACCESS_LOG, maxBytes=ACCESS_LOG_MAX_BYTES,
+                                                       backupCount=ACCESS_LOG_BACKUPS)
+    else:
+        handler = logging.handlers.TimedRotatingFileHandler(ACCESS_LOG, when=ACCESS_LOG_ROTATE,
+                                                            backupCount=ACCESS_LOG_BACKUPS)
+    if ACCESS_LOG_COMPRESS:
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+    handler.setFormatter(AccessFormatter())
+
+    access_queue = queue.SimpleQueue()
+    access_listener = logging.handlers.QueueListener(access_queue, handler)
+    access_listener.start()
+    atexit.register(access_listener.stop)
+    access_log.propagate = False
+    access_log.setLevel(logging.INFO)
+    access_log.addHandler(logging.handlers.QueueHandler(access_queue))
+
+def use_color():
+    # Colour only on an interactive terminal; never under journald
+    if COLOR_OUTPUT != 'auto':
+        return COLOR_OUTPUT == 'always'
+    return 'JOURNAL_STREAM' not in os.environ and sys.stderr.isatty()
 
 # Setup logging
 def setup_logging():
@@ -81,95 +419,241 @@ def setup_logging():
     
     # File handler (no colors)
     file_handler = logging.FileHandler(f'{LOG_DIR}/websocket.log')
-    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(file_formatter)
+    file_handler.setFormatter(PlainFormatter(LOG_FORMAT))
     
-    # Console handler (with colors)
+    # Console handler (with colors unless disabled)
     console_handler = logging.StreamHandler()
-    console_handler.setFormatter(ColorFormatter())
+    if use_color():
+        console_handler.setFormatter(ColorFormatter())
+    else:
+        Colors.disable()
+        console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
     
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Connection threads only enqueue records; formatting and disk/console
+    # writes happen on the listener thread
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    setup_access_log()
 
 class StatisticsManager:
     def __init__(self, db_path):
         self.db_path = db_path
+        self.writer = None
         self.init_database()
     
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
     def init_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # User statistics table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_stats (
-                username TEXT PRIMARY KEY,
-                connections INTEGER DEFAULT 0,
-                download_bytes INTEGER DEFAULT 0,
-                upload_bytes INTEGER DEFAULT 0,
-                last_connection TEXT
-            )
-        ''')
-        
-        # Global statistics table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS global_stats (
-                key TEXT PRIMARY KEY,
-                value INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Connection log table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS connection_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT,
-                client_ip TEXT,
-                start_time TEXT,
-                end_time TEXT,
-                duration INTEGER,
-                download_bytes INTEGER,
-                upload_bytes INTEGER
-            )
-        ''')
-        
-        conn.commit()
+        conn = self.connect()
+        # WAL lets the webgui and gx_manager read while the writer commits
+        conn.execute('PRAGMA journal_mode=WAL')
+        self.migrate(conn)
         conn.close()
     
-    def log_connection(self, username, client_ip, duration, download_bytes, upload_bytes):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Update user stats
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_stats 
-            (username, connections, download_bytes, upload_bytes, last_connection)
-            VALUES (?, COALESCE((SELECT connections FROM user_stats WHERE username = ?), 0) + 1,
-                   COALESCE((SELECT download_bytes FROM user_stats WHERE username = ?), 0) + ?,
-                   COALESCE((SELECT upload_bytes FROM user_stats WHERE username = ?), 0) + ?,
-                   datetime('now'))
-        ''', (username, username, username, download_bytes, username, upload_bytes))
-        
-        # Update global stats
-        cursor.execute('''
-            INSERT OR REPLACE INTO global_stats (key, value)
-            VALUES ('total_download', COALESCE((SELECT value FROM global_stats WHERE key = 'total_download'), 0) + ?)
-        ''', (download_bytes,))
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO global_stats (key, value)
-            VALUES ('total_upload', COALESCE((SELECT value FROM global_stats WHERE key = 'total_upload'), 0) + ?)
-        ''', (upload_bytes,))
-        
-        # Log connection
-        cursor.execute('''
-            INSERT INTO connection_log 
-            (username, client_ip, start_time, end_time, duration, download_bytes, upload_bytes)
-            VALUES (?, ?, datetime('now', ?), datetime('now'), ?, ?, ?)
-        ''', (username, client_ip, f'-{duration} seconds', duration, download_bytes, upload_bytes))
+    def migrate(self, conn):
+        # Upgrade an existing statistics.db in place. Each step commits
+        # together with its PRAGMA user_version bump, so an interrupted
+        # upgrade resumes at the first step that did not complete.
+        conn.isolation_level = None
+        try:
+            for version, statements in STATS_MIGRATIONS:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    if conn.execute('PRAGMA user_version').fetchone()[0] < version:
+                        for sql in statements:
+                            conn.execute(sql)
+                        conn.execute(f'PRAGMA user_version = {version}')
+                        logging.info(f"🗄️ {Colors.CYAN}Statistics database upgraded to schema {version}{Colors.RESET}")
+                    conn.execute('COMMIT')
+                except sqlite3.Error:
+                    conn.execute('ROLLBACK')
+                    raise
+        finally:
+            conn.isolation_level = ''
+    
+    def start_writer(self):
+        self.writer = StatsWriter(self)
+        self.writer.start()
+    
+    def stop_writer(self):
+        writer, self.writer = self.writer, None
+        if writer:
+            writer.stop()
+    
+    def log_connection(self, username, client_ip, duration, download_bytes, upload_bytes,
+                       download_delta=None, upload_delta=None):
+        # The deltas are the bytes not yet counted by a checkpoint; the
+        # connection_log row always carries the full totals
+        end = int(time.time())
+        if download_delta is None:
+            download_delta, upload_delta = download_bytes, upload_bytes
+        self.submit((username, client_ip, end - duration, end, duration,
+                     download_bytes, upload_bytes, download_delta, upload_delta, True))
+
+    def checkpoint_usage(self, records):
+        # In-flight records only add to the totals and rollups; they are
+        # queued as one item so the whole checkpoint lands in one transaction
+        if records:
+            self.submit(records)
+
+    def submit(self, item):
+        writer = self.writer
+        if writer:
+            writer.submit(item)
+        else:
+            conn = self.connect()
+            try:
+                self.write_connections(conn, item if isinstance(item, list) else [item])
+            finally:
+                conn.close()
+    
+    def write_connections(self, conn, records):
+        # One transaction per batch; per-user, global and rollup totals are
+        # summed in Python first so each row is touched once per batch
+        # Records: (username, client_ip, start, end, duration, download, upload,
+        # download_delta, upload_delta, closed). Byte totals and rollups take
+        # the deltas; connection counts, durations and connection_log rows
+        # only come from closed tunnels.
+        per_user = {}
+        rollups = {}
+        closed_rows = []
+        total_download = total_upload = 0
+        for record in records:
+            username, end_time, duration = record[0], record[3], record[4]
+            download_bytes, upload_bytes, closed = record[7], record[8], record[9]
+            if closed:
+                closed_rows.append(record[:7])
+            else:
+                duration = 0
+            entry = per_user.setdefault(username, [0, 0, 0, end_time])
+            entry[0] += closed
+            entry[1] += download_bytes
+            entry[2] += upload_bytes
+            entry[3] = max(entry[3], end_time)
+            total_download += download_bytes
+            total_upload += upload_bytes
+            hour = end_time - end_time % 3600
+            day = end_time - end_time % 86400
+            for key in (('rollup_hourly', hour, username), ('rollup_hourly', hour, '*'),
+                        ('rollup_daily', day, username), ('rollup_daily', day, '*')):
+                entry = rollups.setdefault(key, [0, 0, 0, 0])
+                entry[0] += closed
+                entry[1] += download_bytes
+                entry[2] += upload_bytes
+                entry[3] += duration
         
-        conn.commit()
-        conn.close()
+        with conn:
+            cursor = conn.cursor()
+            
+            # Update user stats
+            cursor.executemany('''
+                INSERT INTO user_stats (username, connections, download_bytes, upload_bytes, last_connection)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET
+                    connections = connections + excluded.connections,
+                    download_bytes = download_bytes + excluded.download_bytes,
+                    upload_bytes = upload_bytes + excluded.upload_bytes,
+                    last_connection = MAX(COALESCE(last_connection, 0), excluded.last_connection)
+            ''', [(username, count, download, upload, last)
+                  for username, (count, download, upload, last) in per_user.items()])
+            
+            # Update global stats
+            cursor.executemany('''
+                INSERT INTO global_stats (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = value + excluded.value
+            ''', (('total_download', total_download),
+                  ('total_upload', total_upload),
+                  ('total_connections', len(closed_rows))))
+            
+            # Update rollups
+            for table in ('rollup_hourly', 'rollup_daily'):
+                cursor.executemany(f'''
+                    INSERT INTO {table} (bucket, username, connections, download_bytes, upload_bytes, duration)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(bucket, username) DO UPDATE SET
+                        connections = connections + excluded.connections,
+                        download_bytes = download_bytes + excluded.download_bytes,
+                        upload_bytes = upload_bytes + excluded.upload_bytes,
+                        duration = duration + excluded.duration
+                ''', [(bucket, username, *totals)
+                      for (name, bucket, username), totals in rollups.items() if name == table])
+            
+            # Log connections
+            cursor.executemany('''
+                INSERT INTO connection_log 
+                (username, client_ip, start_time, end_time, duration, download_bytes, upload_bytes)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', closed_rows)
+    
+    def request_maintenance(self):
+        writer = self.writer
+        if writer:
+            writer.submit(StatsWriter.MAINTAIN)
+    
+    def maintain(self, conn):
+        # Runs on the writer thread: prune old raw rows (optionally archiving
+        # them), trim hourly rollups and VACUUM when due
+        now = int(time.time())
+        if STATS_RETENTION_DAYS > 0:
+            pruned = self.prune(conn, now - STATS_RETENTION_DAYS * 86400)
+            if pruned:
+                logging.info(f"🧹 {Colors.CYAN}Pruned {pruned} connection log rows older than {STATS_RETENTION_DAYS} days{Colors.RESET}")
+        if ROLLUP_HOURLY_RETENTION_DAYS > 0:
+            with conn:
+                conn.execute('DELETE FROM rollup_hourly WHERE bucket < ?',
+                             (now - ROLLUP_HOURLY_RETENTION_DAYS * 86400,))
+        if STATS_VACUUM_DAYS > 0:
+            row = conn.execute("SELECT value FROM maintenance WHERE key = 'last_vacuum'").fetchone()
+            if not row or now - row[0] >= STATS_VACUUM_DAYS * 86400:
+                conn.execute('VACUUM')
+                with conn:
+                    conn.execute('''
+                        INSERT INTO maintenance (key, value) VALUES ('last_vacuum', ?)
+                        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                    ''', (now,))
+                logging.info(f"🧹 {Colors.CYAN}Statistics database vacuumed{Colors.RESET}")
+    
+    def prune(self, conn, cutoff):
+        # Small transactions so readers and the writer are never blocked long
+        batch = '''SELECT id FROM connection_log WHERE start_time < ?
+                   ORDER BY start_time, id LIMIT ?'''
+        if STATS_ARCHIVE_DB:
+            conn.execute('ATTACH DATABASE ? AS archive', (STATS_ARCHIVE_DB,))
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS archive.connection_log (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    client_ip TEXT,
+                    start_time INTEGER,
+                    end_time INTEGER,
+                    duration INTEGER,
+                    download_bytes INTEGER,
+                    upload_bytes INTEGER
+                )
+            ''')
+        pruned = 0
+        try:
+            while True:
+                with conn:
+                    if STATS_ARCHIVE_DB:
+                        conn.execute(f'INSERT OR IGNORE INTO archive.connection_log SELECT * FROM main.connection_log WHERE id IN ({batch})',
+                                     (cutoff, STATS_PRUNE_BATCH))
+                    deleted = conn.execute(f'DELETE FROM main.connection_log WHERE id IN ({batch})',
+                                           (cutoff, STATS_PRUNE_BATCH)).rowcount
+                pruned += deleted
+                if deleted < STATS_PRUNE_BATCH:
+                    return pruned
+        finally:
+            if STATS_ARCHIVE_DB:
+                conn.execute('DETACH DATABASE archive')
     
     def get_user_stats(self, username):
         conn = sqlite3.connect(self.db_path)
@@ -204,196 +688,1992 @@ class StatisticsManager:
         conn.close()
         return stats
 
-class UserManager:
-    def __init__(self, db_path):
+class StatsWriter(threading.Thread):
+    # Sole writer of statistics.db. Connection threads only enqueue; rows
+    # are committed in batches of up to STATS_BATCH_SIZE or every
+    # STATS_FLUSH_INTERVAL seconds on one long-lived connection.
+    STOP = object()
+    MAINTAIN = object()
+
+    def __init__(self, stats_manager):
+        threading.Thread.__init__(self, name='stats-writer', daemon=True)
+        self.stats_manager = stats_manager
+        self.queue = queue.Queue(STATS_QUEUE_SIZE)
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.last_batch_ms = 0
+        # dropped and max_depth are updated by every connection thread
+        self.lock = threading.Lock()
+
+    def submit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            with self.lock:
+                self.max_depth = max(self.max_depth, depth)
+
+    def run(self):
+        conn = self.stats_manager.connect()
+        pending = []
+        deadline = None
+        stopping = False
+        maintenance = False
+        try:
+            while not stopping:
+                timeout = max(0, deadline - time.monotonic()) if pending else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+                while item is not None:
+                    if item is self.STOP:
+                        stopping = True
+                        break
+                    if item is self.MAINTAIN:
+                        maintenance = True
+                        break
+                    if not pending:
+                        deadline = time.monotonic() + STATS_FLUSH_INTERVAL
+                    if isinstance(item, list):
+                        pending.extend(item)
+                    else:
+                        pending.append(item)
+                    if len(pending) >= STATS_BATCH_SIZE:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+                if pending and (maintenance or len(pending) >= STATS_BATCH_SIZE or time.monotonic() >= deadline):
+                    self.flush(conn, pending)
+                    pending = []
+                if maintenance:
+                    maintenance = False
+                    try:
+                        self.stats_manager.maintain(conn)
+                    except sqlite3.Error as e:
+                        logging.error(f"❌ {Colors.RED}Statistics maintenance failed: {e}{Colors.RESET}")
+
+            # Shutdown: write whatever is still queued
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, list):
+                    pending.extend(item)
+                elif item is not self.STOP and item is not self.MAINTAIN:
+                    pending.append(item)
+            for i in range(0, len(pending), STATS_BATCH_SIZE):
+                self.flush(conn, pending[i:i + STATS_BATCH_SIZE])
+        finally:
+            conn.close()
+
+    def flush(self, conn, records):
+        started = time.perf_counter()
+        try:
+            self.stats_manager.write_connections(conn, records)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logging.error(f"❌ {Colors.RED}Failed to write {len(records)} connection records: {e}{Colors.RESET}")
+            return
+        self.last_batch_ms = (time.perf_counter() - started) * 1000
+        self.written += len(records)
+        self.batches += 1
+
+    def stop(self):
+        self.queue.put(self.STOP)
+        self.join(30)
+
+    def get_stats(self):
+        with self.lock:
+            dropped, max_depth = self.dropped, self.max_depth
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': max_depth,
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': dropped,
+            'errors': self.errors,
+            'last_batch_ms': round(self.last_batch_ms, 2),
+        }
+
+def hash_password(password, iterations=PASSWORD_HASH_ITERATIONS):
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+def is_password_hash(stored):
+    return stored.startswith('pbkdf2_sha256$')
+
+def verify_password(password, stored):
+    if not is_password_hash(stored):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    try:
+        _, iterations, salt, expected = stored.split('$')
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+class VerificationCache:
+    # LRU of recent successful KDF checks, so reconnect storms cost a hash
+    # lookup instead of a PBKDF2 run. Keys are a BLAKE2 digest of username
+    # and password under a per-process secret; each entry remembers the
+    # stored hash it was checked against, so a changed record misses.
+    def __init__(self, size):
+        self.size = size
+        self.secret = os.urandom(32)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, username, password, stored):
+        if not is_password_hash(stored):
+            return verify_password(password, stored)
+        key = hashlib.blake2b(f'{username}\0{password}'.encode('utf-8'), key=self.secret, digest_size=16).digest()
+        with self.lock:
+            if self.entries.get(key) == stored:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not verify_password(password, stored):
+            return False
+        with self.lock:
+            self.entries[key] = stored
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return True
+
+    def get_stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+class SessionRegistry:
+    # Authenticated sessions per user, oldest first. reserve() checks the
+    # limit and registers the session under one lock, so concurrent logins
+    # cannot overshoot it and a release can never be lost.
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.evicted = 0
+
+    def reserve(self, username, conn, limit, policy):
+        # Returns (reserved, session to evict)
+        with self.lock:
+            sessions = self.sessions.get(username)
+            if sessions is None:
+                sessions = self.sessions[username] = OrderedDict()
+            victim = None
+            if len(sessions) >= limit:
+                if policy != 'evict' or not sessions:
+                    self.rejected += 1
+                    if not sessions:
+                        del self.sessions[username]
+                    return False, None
+                _, victim = sessions.popitem(last=False)
+                self.evicted += 1
+            sessions[conn.conn_id] = conn
+        return True, victim
+
+    def release(self, username, conn):
+        with self.lock:
+            sessions = self.sessions.get(username)
+            if sessions is not None:
+                sessions.pop(conn.conn_id, None)
+                if not sessions:
+                    del self.sessions[username]
+
+    def count(self, username):
+        sessions = self.sessions.get(username)
+        return len(sessions) if sessions else 0
+
+    def revoke(self, username, reason):
+        with self.lock:
+            conns = list(self.sessions.get(username, {}).values())
+        for conn in conns:
+            conn.set_close_reason(reason)
+            conn.terminate()
+        return len(conns)
+
+    def occupancy(self, limit_for):
+        with self.lock:
+            counts = {username: len(sessions) for username, sessions in self.sessions.items()}
+        return {username: {'sessions': count, 'limit': limit_for(username)} for username, count in counts.items()}
+
+    def get_stats(self, limit_for):
+        occupancy = self.occupancy(limit_for)
+        return {
+            'users': len(occupancy),
+            'sessions': sum(entry['sessions'] for entry in occupancy.values()),
+            'users_at_limit': sum(1 for entry in occupancy.values() if entry['sessions'] >= entry['limit']),
+            'rejected': self.rejected,
+            'evicted': self.evicted
+        }
+
+class ExpiryScheduler(threading.Thread):
+    # Closes sessions as soon as their account expires, is disabled or is
+    # deleted, without scanning users or connections. Expiries of users with
+    # open sessions sit in a min-heap; an entry whose expiry has since
+    # changed is stale and dropped when it reaches the top.
+    def __init__(self, user_manager, sessions):
+        threading.Thread.__init__(self, name='expiry', daemon=True)
+        self.user_manager = user_manager
+        self.sessions = sessions
+        self.heap = []
+        self.scheduled = {}
+        self.cond = threading.Condition()
+        self.running = True
+
+    def watch(self, username):
+        expires_at = self.user_manager.expiry(username)
+        if expires_at is None:
+            return
+        with self.cond:
+            if self.scheduled.get(username) == expires_at:
+                return
+            self.scheduled[username] = expires_at
+            heapq.heappush(self.heap, (expires_at, username))
+            if self.heap[0] == (expires_at, username):
+                self.cond.notify()
+
+    def users_changed(self, usernames):
+        # Called by UserManager after a reload with the records that changed
+        for username in usernames:
+            if self.sessions.count(username):
+                self.enforce(username)
+
+    def enforce(self, username):
+        reason = self.user_manager.account_status(username)
+        if reason:
+            count = self.sessions.revoke(username, reason)
+            if count:
+                logging.warning(f"⛔ {Colors.YELLOW}Closed {count} sessions of {username}: account {reason}{Colors.RESET}")
+        else:
+            self.watch(username)
+
+    def run(self):
+        while self.running:
+            due = []
+            with self.cond:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    expires_at, username = heapq.heappop(self.heap)
+                    if self.scheduled.get(username) == expires_at:
+                        del self.scheduled[username]
+                        due.append(username)
+                if not due:
+                    # Capped so a wall-clock jump is noticed within a minute
+                    delay = min(self.heap[0][0] - now, 60) if self.heap else None
+                    self.cond.wait(delay)
+                    continue
+            for username in due:
+                self.enforce(username)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+class QuotaManager:
+    # Bytes used per quota user in the current UTC day and month and in
+    # total, kept in memory. A user's counters are seeded from statistics.db
+    # by preload() during their first handshake, so usage from before a
+    # restart, overage included, still counts and the relay path never
+    # queries the database; checkpoints keep it at most
+    # STATS_CHECKPOINT_INTERVAL behind.
+    def __init__(self, user_manager, db_path):
+        self.user_manager = user_manager
         self.db_path = db_path
+        self.usage = {}  # username -> [day, month, daily, monthly, total]
+        self.lock = threading.Lock()
+        self.exceeded = 0
+
+    def limits(self, username):
+        # (daily, monthly, total) with 0 for no limit, or None without a quota
+        entry = self.user_manager.index.get(username)
+        if entry is None:
+            return None
+        limits = tuple(int(entry[0].get(key) or 0) for key in ('quota_daily', 'quota_monthly', 'quota_total'))
+        return limits if any(limits) else None
+
+    def periods(self, now):
+        day = int(now) - int(now) % 86400
+        month = datetime.fromtimestamp(now, timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return day, int(month.timestamp())
+
+    def preload(self, username):
+        usage = self.usage.get(username)
+        if usage is None:
+            usage = self.load(username, *self.periods(time.time()))
+        return usage
+
+    def load(self, username, day, month):
+        # Outside the lock; if two threads seed the same user the first wins
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                daily, monthly = conn.execute('''
+                    SELECT COALESCE(SUM(CASE WHEN bucket = ? THEN download_bytes + upload_bytes END), 0),
+                           COALESCE(SUM(download_bytes + upload_bytes), 0)
+                    FROM rollup_daily WHERE username = ? AND bucket >= ?
+                ''', (day, username, month)).fetchone()
+                row = conn.execute('SELECT download_bytes + upload_bytes FROM user_stats WHERE username = ?',
+                                   (username,)).fetchone()
+            finally:
+                conn.close()
+            seeded = [day, month, daily, monthly, row[0] if row else 0]
+        except sqlite3.Error as e:
+            logging.error(f"❌ {Colors.RED}Cannot read quota usage of {username}, starting from zero: {e}{Colors.RESET}")
+            seeded = [day, month, 0, 0, 0]
+        with self.lock:
+            return self.usage.setdefault(username, seeded)
+
+    def charge(self, username, nbytes):
+        # Adds nbytes to the user's counters; False once any limit is reached
+        limits = self.limits(username)
+        day, month = self.periods(time.time())
+        # Tunnels preload at login, so this only loads for direct callers
+        usage = self.usage.get(username) or self.preload(username)
+        with self.lock:
+            if usage[1] != month:
+                usage[1], usage[3] = month, 0
+            if usage[0] != day:
+                usage[0], usage[2] = day, 0
+            usage[2] += nbytes
+            usage[3] += nbytes
+            usage[4] += nbytes
+            return self.within(usage, limits)
+
+    def note_exceeded(self):
+        with self.lock:
+            self.exceeded += 1
+
+    def within(self, usage, limits):
+        return not limits or all(not limit or used < limit for used, limit in zip(usage[2:], limits))
+
+    def check(self, username):
+        # Whether the user is still within their quotas, without charging
+        usage = self.current([username]).get(username)
+        return usage is None or self.within(usage, self.limits(username))
+
+    def current(self, usernames=None):
+        # Copy of the counters with past days and months reading as zero
+        day, month = self.periods(time.time())
+        with self.lock:
+            if usernames is None:
+                usernames = list(self.usage)
+            usage = {username: list(self.usage[username]) for username in usernames if username in self.usage}
+        for entry in usage.values():
+            if entry[1] != month:
+                entry[3] = 0
+            if entry[0] != day:
+                entry[2] = 0
+        return usage
+
+    def get_usage(self, username=None):
+        # Users not seen since the start read as zero; nothing is loaded here
+        usage = self.current([username] if username else None)
+        usernames = [username] if username else list(usage)
+        result = {}
+        for name in usernames:
+            limits = self.limits(name) or (0, 0, 0)
+            entry = usage.get(name, [0, 0, 0, 0, 0])
+            result[name] = {
+                'daily': entry[2], 'daily_limit': limits[0],
+                'monthly': entry[3], 'monthly_limit': limits[1],
+                'total': entry[4], 'total_limit': limits[2],
+                'within_quota': self.within(entry, self.limits(name))
+            }
+        return result[username] if username else result
+
+    def get_stats(self):
+        usage = self.current()
+        with self.lock:
+            exceeded = self.exceeded
+        return {
+            'users': len(usage),
+            'over_quota': sum(1 for username, entry in usage.items()
+                              if not self.within(entry, self.limits(username))),
+            'exceeded': exceeded
+        }
+
+class UserManager:
+    # Users are looked up in a dict index over the shared user store. The
+    # housekeeper polls the store, which is a PRAGMA data_version query when
+    # nothing changed, and otherwise refreshes only the users listed in its
+    # change log; a full reload builds a new index and swaps the reference.
+    def __init__(self, db_path, legacy_path=None):
+        self.store = UserStore(db_path, legacy_path)
+        self.settings = {}
+        self.index = {}
+        self.change_id = 0
+        self.verifier = VerificationCache(AUTH_CACHE_SIZE)
+        self.on_change = None
         self.load_users()
     
     def load_users(self):
         try:
-            with open(self.db_path, 'r') as f:
-                data = json.load(f)
-                self.users = data.get('users', [])
-                self.settings = data.get('settings', {})
-        except:
-            self.users = []
-            self.settings = {}
+            users, settings, change_id = self.store.load()
+        except sqlite3.Error as e:
+            # On reload keep the last good copy rather than locking everyone out
+            logging.warning(f"⚠️ {Colors.YELLOW}Keeping previous users, cannot load {self.store.path}: {e}{Colors.RESET}")
+            return False
+        self.apply(users, settings)
+        self.change_id = change_id
+        return True
     
-    def save_users(self):
-        data = {
-            'users': self.users,
-            'settings': self.settings
-        }
-        with open(self.db_path, 'w') as f:
-            json.dump(data, f, indent=2)
+    def check_reload(self):
+        try:
+            if not self.store.changed():
+                return
+            usernames, change_id = self.store.changes_since(self.change_id)
+            if usernames is None:
+                if self.load_users():
+                    logging.info(f"👥 {Colors.CYAN}Reloaded {len(self.index)} users from {self.store.path}{Colors.RESET}")
+                return
+            changed = []
+            for username in usernames:
+                entry = self.index_entry(self.store.get_user(username))
+                if entry is None:
+                    if self.index.pop(username, None) is not None:
+                        changed.append(username)
+                elif self.index.get(username) != entry:
+                    self.index[username] = entry
+                    changed.append(username)
+            self.change_id = change_id
+        except sqlite3.Error as e:
+            logging.warning(f"⚠️ {Colors.YELLOW}Cannot check {self.store.path} for changes: {e}{Colors.RESET}")
+            return
+        if changed:
+            logging.info(f"👥 {Colors.CYAN}Updated {len(changed)} users from {self.store.path}{Colors.RESET}")
+            if self.on_change:
+                self.on_change(changed)
+    
+    def index_entry(self, user):
+        if user is None:
+            return None
+        expires_at = None
+        if user.get('expires'):
+            try:
+                # Accounts stop working at local midnight of the expiry date
+                expires_at = datetime.strptime(user['expires'], '%Y-%m-%d').timestamp()
+            except ValueError:
+                logging.warning(f"⚠️ {Colors.YELLOW}Invalid expiry '{user['expires']}' for {user.get('username')}, treating as expired{Colors.RESET}")
+                expires_at = 0
+        return (user, expires_at)
+    
+    def apply(self, users, settings):
+        index = {user['username']: self.index_entry(user) for user in users}
+        previous, self.index = self.index, index
+        self.settings = settings
+        if self.on_change:
+            changed = [username for username, entry in previous.items() if index.get(username) != entry]
+            if changed:
+                self.on_change(changed)
     
     def validate_user(self, username, password):
-        for user in self.users:
-            if user['username'] == username:
-                # Check if account is expired
-                if 'expires' in user and user['expires']:
-                    expiry_date = datetime.strptime(user['expires'], '%Y-%m-%d')
-                    if datetime.now() > expiry_date:
-                        return False, "Account expired"
-                
-                # Check if account is active
-                if not user.get('active', True):
-                    return False, "Account disabled"
-                
-                # Check concurrent connections
-                max_conn = self.settings.get('max_connections_per_user', 3)
-                current_conn = user_connections.get(username, 0)
-                if current_conn >= max_conn:
-                    return False, f"Maximum connections ({max_conn}) reached"
-                
-                # Simple password validation
-                if user['password'] == password:
-                    return True, "Valid user"
-                else:
-                    return False, "Invalid password"
-        return False, "User not found"
+        entry = self.index.get(username)
+        if entry is None:
+            return False, "User not found"
+        user, expires_at = entry
+        
+        # Check if account is expired
+        if expires_at is not None and time.time() >= expires_at:
+            return False, "Account expired"
+        
+        # Check if account is active
+        if not user.get('active', True):
+            return False, "Account disabled"
+        
+        if self.verifier.verify(username, password, user['password']):
+            return True, "Valid user"
+        else:
+            return False, "Invalid password"
+    
+    def expiry(self, username):
+        entry = self.index.get(username)
+        return entry[1] if entry else None
+    
+    def account_status(self, username):
+        # Why an open session may not continue, or None
+        entry = self.index.get(username)
+        if entry is None:
+            return 'deleted'
+        user, expires_at = entry
+        if not user.get('active', True):
+            return 'disabled'
+        if expires_at is not None and time.time() >= expires_at:
+            return 'expired'
+        return None
+    
+    def session_limit(self, username):
+        # The user's own max_connections, else the global default
+        entry = self.index.get(username)
+        limit = entry[0].get('max_connections') if entry else None
+        return int(limit or self.settings.get('max_connections_per_user', 3))
     
     def add_user(self, username, password, expires=None, max_connections=3):
-        user_data = {
+        added = self.store.add_user({
             'username': username,
-            'password': password,
+            'password': hash_password(password),
             'created': datetime.now().strftime('%Y-%m-%d'),
             'expires': expires,
             'max_connections': max_connections,
             'active': True
-        }
-        self.users.append(user_data)
-        self.save_users()
+        })
+        self.check_reload()
+        return added
     
     def delete_user(self, username):
-        self.users = [u for u in self.users if u['username'] != username]
-        self.save_users()
+        deleted = self.store.delete_user(username)
+        self.check_reload()
+        return deleted
+    
+    def hash_plaintext_passwords(self):
+        count = 0
+        for user, _ in list(self.index.values()):
+            if not is_password_hash(user['password']):
+                self.store.update_user(user['username'], password=hash_password(user['password']))
+                count += 1
+        self.check_reload()
+        return count
     
     def update_user(self, username, **kwargs):
-        for user in self.users:
-            if user['username'] == username:
-                user.update(kwargs)
+        updated = self.store.update_user(username, **kwargs)
+        self.check_reload()
+        return updated
+
+class Housekeeper(threading.Thread):
+    # Runs periodic maintenance tasks away from the accept and relay paths
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.tasks = []
+        self.running = True
+        self.wakeup = threading.Event()
+
+    def add_task(self, interval, func):
+        self.tasks.append([interval, time.monotonic() + interval, func])
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            next_due = now + 1
+            for task in self.tasks:
+                interval, due, func = task
+                if now >= due:
+                    try:
+                        func()
+                    except Exception as e:
+                        logging.error(f"❌ {Colors.RED}Maintenance task {func.__name__} failed: {e}{Colors.RESET}")
+                    due = task[1] = now + interval
+                next_due = min(next_due, due)
+            self.wakeup.wait(max(0, next_due - time.monotonic()))
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+def read_tcp_info(sock):
+    # Offsets follow struct tcp_info in linux/tcp.h; kernels before 4.9
+    # return a shorter struct without the delivery rate
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_LENGTH)
+    except (AttributeError, OSError):
+        return None
+    if len(data) < 104:
+        return None
+    rtt, rttvar, _, cwnd = struct.unpack_from('<4I', data, 68)
+    return {
+        'rtt_ms': rtt / 1000,
+        'rttvar_ms': rttvar / 1000,
+        'cwnd': cwnd,
+        'retrans': struct.unpack_from('<I', data, 100)[0],
+        'delivery_rate': struct.unpack_from('<Q', data, 160)[0] if len(data) >= 168 else None
+    }
+
+def summarize_tcp_info(samples):
+    if not samples:
+        return {'tunnels': 0}
+    rates = [s['delivery_rate'] for s in samples if s['delivery_rate'] is not None]
+    return {
+        'tunnels': len(samples),
+        'avg_rtt_ms': round(sum(s['rtt_ms'] for s in samples) / len(samples), 2),
+        'max_rtt_ms': max(s['rtt_ms'] for s in samples),
+        'avg_cwnd': round(sum(s['cwnd'] for s in samples) / len(samples), 1),
+        'retrans': sum(s['retrans'] for s in samples),
+        'avg_delivery_rate': int(sum(rates) / len(rates)) if rates else None
+    }
+
+class Histogram:
+    # Fixed-bucket histogram; observe() is a bisect and two additions
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f'{self.name}_sum {total}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+handshake_histogram = Histogram(f'{METRICS_NAMESPACE}_handshake_seconds',
+                                'Time from accept until the tunnel is established', HANDSHAKE_BUCKETS)
+connect_histogram = Histogram(f'{METRICS_NAMESPACE}_upstream_connect_seconds',
+                              'Time to resolve and connect to the target', CONNECT_BUCKETS)
+duration_histogram = Histogram(f'{METRICS_NAMESPACE}_tunnel_duration_seconds',
+                               'Lifetime of established tunnels', DURATION_BUCKETS)
+size_histogram = Histogram(f'{METRICS_NAMESPACE}_tunnel_bytes',
+                           'Bytes relayed per tunnel in both directions', SIZE_BUCKETS)
+
+class MetricsServer(threading.Thread):
+    # Serves /metrics in the Prometheus text format. Binding is retried, so a
+    # process started by a handoff picks the port up once the old one drains.
+    def __init__(self, host, port, render):
+        threading.Thread.__init__(self, daemon=True)
+        self.host = host
+        self.port = port
+        self.render = render
+        self.running = True
+        self.wakeup = threading.Event()
+
+    def run(self):
+        render = self.render
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = None
+        while self.running and httpd is None:
+            try:
+                httpd = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+            except OSError as e:
+                logging.debug(f"Metrics port {self.port} not available yet: {e}")
+                self.wakeup.wait(1)
+        if httpd is None:
+            return
+
+        httpd.daemon_threads = True
+        httpd.timeout = 0.5
+        logging.info(f"📈 {Colors.CYAN}Metrics available on http://{self.host}:{self.port}/metrics{Colors.RESET}")
+        try:
+            while self.running:
+                httpd.handle_request()
+        finally:
+            httpd.server_close()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+
+class Profiler:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.active = None
+
+    def capture(self, seconds=PROFILE_DURATION):
+        seconds = float(seconds)
+        if not seconds > 0:
+            raise ValueError("capture length must be positive")
+        seconds = min(seconds, PROFILE_MAX_DURATION)
+        with self.lock:
+            if self.active and self.active.is_alive():
+                return {'error': 'a capture is already running'}
+            os.makedirs(self.directory, exist_ok=True)
+            prefix = os.path.join(self.directory, datetime.now().strftime('%Y%m%d-%H%M%S'))
+            self.dump_threads(f'{prefix}-threads.txt')
+            self.active = threading.Thread(target=self.sample, args=(prefix, seconds),
+                                           name='profiler', daemon=True)
+            self.active.start()
+        logging.info(f"🔬 {Colors.CYAN}Profiling for {seconds:g}s into {prefix}-*{Colors.RESET}")
+        return {
+            'seconds': seconds,
+            'threads': f'{prefix}-threads.txt',
+            'profile': f'{prefix}-profile.txt',
+            'folded': f'{prefix}-profile.folded',
+            'memory': f'{prefix}-memory.txt'
+        }
+
+    def dump_threads(self, path):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with open(path, 'w') as f:
+            for ident, frame in sys._current_frames().items():
+                f.write(f'Thread {names.get(ident, ident)} ({ident}):\n')
+                f.writelines(traceback.format_stack(frame))
+                f.write('\n')
+
+    def sample(self, prefix, seconds):
+        # Wall-clock sampler over every thread, so blocked threads show
+        # where they wait as well as where CPU goes
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+        baseline = tracemalloc.take_snapshot()
+        own = threading.get_ident()
+        stacks = Counter()
+        leaves = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    if stack:
+                        leaves[stack[0]] += 1
+                        stacks[(names.get(ident, 'thread'), tuple(reversed(stack)))] += 1
+                samples += 1
+                time.sleep(PROFILE_SAMPLE_INTERVAL)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        describe = lambda code: f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        # Thread names are folded into the first frame so pooled workers group together
+        with open(f'{prefix}-profile.folded', 'w') as f:
+            for (name, stack), count in stacks.most_common():
+                f.write(';'.join([name.rstrip('0123456789-_')] + [describe(code) for code in stack]) + f' {count}\n')
+        with open(f'{prefix}-profile.txt', 'w') as f:
+            f.write(f'{samples} samples over {seconds:g}s, innermost frames:\n')
+            total = sum(leaves.values()) or 1
+            for code, count in leaves.most_common(PROFILE_TOP):
+                f.write(f'{count * 100 / total:6.2f}% {count:8d}  {describe(code)}\n')
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        diff = snapshot.filter_traces(ignore).compare_to(baseline.filter_traces(ignore), 'lineno')
+        with open(f'{prefix}-memory.txt', 'w') as f:
+            f.write(f'Allocation changes over {seconds:g}s:\n')
+            for stat in diff[:PROFILE_TOP]:
+                f.write(f'{stat}\n')
+        logging.info(f"🔬 {Colors.GREEN}Profile written to {prefix}-*{Colors.RESET}")
+
+class PrefixNode:
+    __slots__ = ('key', 'length', 'action', 'children')
+
+    def __init__(self, key, length, action=None):
+        self.key = key
+        self.length = length
+        self.action = action
+        self.children = [None, None]
+
+class PrefixTree:
+    # Path-compressed binary radix tree with longest-prefix matching.
+    # Inserts and lookups walk at most `width` bits regardless of entry count.
+    def __init__(self, width):
+        self.width = width
+        self.root = PrefixNode(0, 0)
+
+    def insert(self, key, length, action):
+        width = self.width
+        node = self.root
+        while True:
+            if node.length == length:
+                node.action = action
+                return
+            bit = (key >> (width - 1 - node.length)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = PrefixNode(key, length, action)
+                return
+
+            common = width - (child.key ^ key).bit_length()
+            if common >= min(child.length, length):
+                if child.length <= length:
+                    node = child
+                    continue
+                # New prefix covers the existing child
+                new = PrefixNode(key, length, action)
+                new.children[(child.key >> (width - 1 - length)) & 1] = child
+                node.children[bit] = new
+                return
+
+            # Prefixes diverge: add a branch node at the first differing bit
+            shift = width - common
+            branch = PrefixNode((key >> shift) << shift, common)
+            branch.children[(child.key >> (shift - 1)) & 1] = child
+            branch.children[(key >> (shift - 1)) & 1] = PrefixNode(key, length, action)
+            node.children[bit] = branch
+            return
+
+    def lookup(self, key):
+        width = self.width
+        node = self.root
+        found = node.action
+        while True:
+            node = node.children[(key >> (width - 1 - node.length)) & 1]
+            if node is None or (key ^ node.key) >> (width - node.length):
+                return found
+            if node.action is not None:
+                found = node.action
+            if node.length == width:
+                return found
+
+class CIDRFilter:
+    # Allow/deny lists checked right after accept(). The most specific
+    # matching prefix wins, so denying 0.0.0.0/0 and allowing a few ranges
+    # turns the lists into a strict allowlist.
+    def __init__(self, allow_file, deny_file):
+        self.allow_file = allow_file
+        self.deny_file = deny_file
+        self.signature = None
+        self.trees = (PrefixTree(32), PrefixTree(128))
+        self.entries = 0
+        self.reload()
+
+    def file_signature(self):
+        signature = []
+        for path in (self.allow_file, self.deny_file):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def reload(self):
+        signature = self.file_signature()
+        if signature == self.signature:
+            return False
+
+        v4, v6 = PrefixTree(32), PrefixTree(128)
+        entries = 0
+        # Deny first so that an identical allow entry takes precedence
+        for path, action in ((self.deny_file, False), (self.allow_file, True)):
+            try:
+                f = open(path, 'r')
+            except OSError:
+                continue
+            with f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if not line:
+                        continue
+                    try:
+                        net = ipaddress.ip_network(line, strict=False)
+                    except ValueError:
+                        logging.warning(f"⚠️ {Colors.YELLOW}Ignoring invalid CIDR '{line}' in {path}{Colors.RESET}")
+                        continue
+                    tree = v4 if net.version == 4 else v6
+                    tree.insert(int(net.network_address), net.prefixlen, action)
+                    entries += 1
+
+        # Swap in the new trees in one assignment so lookups never see a partial list
+        self.trees = (v4, v6)
+        self.entries = entries
+        self.signature = signature
+        logging.info(f"🛡️ {Colors.CYAN}Loaded {entries} CIDR rules{Colors.RESET}")
+        return True
+
+    def allowed(self, ip):
+        if not self.entries:
+            return True
+        v4, v6 = self.trees
+        try:
+            if ':' in ip:
+                key = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+                if key >> 32 == 0xffff:
+                    action = v4.lookup(key & 0xffffffff)
+                else:
+                    action = v6.lookup(key)
+            else:
+                action = v4.lookup(int.from_bytes(socket.inet_aton(ip), 'big'))
+        except OSError:
+            return True
+        return action is not False
+
+class AuthThrottle:
+    # Failed logins per key ("ip:<addr>" or "user:<name>") as exponentially
+    # decaying scores. Crossing the threshold bans the key; each repeat ban
+    # doubles in length. The table is capped at max_entries; active bans are
+    # never evicted to make room, so flooding it with new keys cannot lift them.
+    def __init__(self, threshold, half_life, ban_time, ban_max, max_entries):
+        self.threshold = threshold
+        self.half_life = half_life
+        self.ban_time = ban_time
+        self.ban_max = ban_max
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> [score, updated, banned_until, ban_count]
+        self.lock = threading.Lock()
+
+    def is_banned(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[2] > time.time()
+
+    def decayed(self, entry, now):
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def make_room(self, now):
+        # Called with the lock held and the table full. Drops stale keys,
+        # then the lowest-scoring unbanned eighth of the table, so the scan
+        # runs once per many new keys. False when every key is an active ban.
+        self.drop_stale(now)
+        if len(self.entries) < self.max_entries:
+            return True
+        candidates = [(self.decayed(entry, now), key) for key, entry in self.entries.items() if entry[2] <= now]
+        for _, key in heapq.nsmallest(max(1, self.max_entries // 8), candidates):
+            del self.entries[key]
+        return bool(candidates)
+
+    def record_failure(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.max_entries and not self.make_room(now):
+                    return 0
+                entry = self.entries[key] = [0.0, now, 0.0, 0]
+            else:
+                self.entries.move_to_end(key)
+
+            entry[0] = self.decayed(entry, now) + 1
+            entry[1] = now
+            if entry[0] >= self.threshold and entry[2] <= now:
+                entry[3] += 1
+                duration = min(self.ban_time * 2 ** (entry[3] - 1), self.ban_max)
+                entry[0] = 0.0
+                entry[2] = now + duration
+                return duration
+        return 0
+
+    def record_success(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] <= time.time():
+                del self.entries[key]
+
+    def unban(self, key):
+        with self.lock:
+            return {'unbanned': self.entries.pop(key, None) is not None}
+
+    def purge(self):
+        with self.lock:
+            self.drop_stale(time.time())
+
+    def drop_stale(self, now):
+        # Drop keys whose score has decayed away and whose ban has expired;
+        # called with the lock held
+        stale = [key for key, entry in self.entries.items()
+                 if entry[2] <= now and self.decayed(entry, now) < 0.05]
+        for key in stale:
+            del self.entries[key]
+
+    def get_bans(self):
+        now = time.time()
+        with self.lock:
+            bans = [{
+                'key': key,
+                'until': datetime.fromtimestamp(banned_until).strftime('%Y-%m-%d %H:%M:%S'),
+                'remaining': int(banned_until - now),
+                'ban_count': ban_count
+            } for key, (_, _, banned_until, ban_count) in self.entries.items() if banned_until > now]
+        bans.sort(key=lambda ban: ban['remaining'], reverse=True)
+        return {'tracked': len(self.entries), 'bans': bans}
+
+class ControlServer(threading.Thread):
+    # Admin commands over a UNIX socket: one request line in, one JSON reply out
+    def __init__(self, path):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.commands = {}
+        self.running = False
+        self.inode = None
+
+    def register(self, name, func):
+        self.commands[name] = func
+
+    def run(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.soc.bind(self.path)
+            self.inode = os.stat(self.path).st_ino
+            os.chmod(self.path, 0o600)
+            self.soc.listen(8)
+            self.soc.settimeout(2)
+        except OSError as e:
+            logging.warning(f"⚠️ {Colors.YELLOW}Control socket unavailable ({self.path}): {e}{Colors.RESET}")
+            return
+
+        self.running = True
+        while self.running:
+            try:
+                client, _ = self.soc.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with client:
+                try:
+                    client.settimeout(5)
+                    request = client.recv(4096).decode('utf-8').split()
+                    client.sendall(json.dumps(self.dispatch(request), default=str).encode('utf-8') + b'\n')
+                except OSError:
+                    pass
+
+    def dispatch(self, request):
+        if not request:
+            return {'error': 'empty command', 'commands': sorted(self.commands)}
+        func = self.commands.get(request[0])
+        if func is None:
+            return {'error': f'unknown command {request[0]}', 'commands': sorted(self.commands)}
+        try:
+            return func(*request[1:])
+        except Exception as e:
+            return {'error': str(e)}
+
+    def close(self):
+        self.running = False
+        try:
+            self.soc.close()
+            # A replacement process may already have bound a new socket here
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except (AttributeError, OSError):
+            pass
+
+def send_control_command(path, command):
+    soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    soc.settimeout(30)
+    try:
+        soc.connect(path)
+        soc.sendall(command.encode('utf-8') + b'\n')
+        reply = b''
+        while True:
+            data = soc.recv(65536)
+            if not data:
                 break
-        self.save_users()
+            reply += data
+    finally:
+        soc.close()
+    return json.loads(reply.decode('utf-8'))
+
+class LiveMetrics:
+    # Seqlock-protected snapshot in a shared file. The single writer makes
+    # the sequence odd, rewrites the body and makes it even again; readers
+    # retry when the sequence is odd or changed while they copied.
+    def __init__(self, path, max_users):
+        self.path = path
+        self.max_users = max_users
+        self.size = LIVE_HEADER.size + LIVE_COUNTER_BLOCK.size + LIVE_USER.size * max_users
+        self.map = None
+        self.inode = None
+        self.seq = 0
+        self.started = time.time()
+
+    def open(self):
+        # Build the file aside and rename it into place, so a process taking
+        # over after a handoff never shares a mapping with the old one
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f'{self.path}.{os.getpid()}'
+            fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, self.size)
+                self.map = mmap.mmap(fd, self.size)
+                self.inode = os.fstat(fd).st_ino
+            finally:
+                os.close(fd)
+            LIVE_HEADER.pack_into(self.map, 0, LIVE_MAGIC, LIVE_VERSION, 0, os.getpid(), 0, self.started, 0)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.map = None
+            logging.warning(f"⚠️ {Colors.YELLOW}Live metrics unavailable ({self.path}): {e}{Colors.RESET}")
+
+    def publish(self, counters, users):
+        if self.map is None:
+            return
+        users = sorted(users.items(), key=lambda item: item[1][1] + item[1][2], reverse=True)[:self.max_users]
+        body = bytearray(LIVE_COUNTER_BLOCK.size + LIVE_USER.size * len(users))
+        LIVE_COUNTER_BLOCK.pack_into(body, 0, *(counters.get(name, 0) for name in LIVE_COUNTERS))
+        offset = LIVE_COUNTER_BLOCK.size
+        for username, (sessions, download_bytes, upload_bytes) in users:
+            LIVE_USER.pack_into(body, offset, username.encode('utf-8')[:32], sessions, 0,
+                                download_bytes, upload_bytes)
+            offset += LIVE_USER.size
+
+        self.seq += 1
+        struct.pack_into('<I', self.map, LIVE_SEQ_OFFSET, self.seq & 0xffffffff)
+        start = LIVE_HEADER.size
+        self.map[start:start + len(body)] = body
+        LIVE_HEADER.pack_into(self.map, 0, LIVE_MAGIC, LIVE_VERSION, self.seq & 0xffffffff,
+                              os.getpid(), len(users), self.started, time.time())
+        self.seq += 1
+        struct.pack_into('<I', self.map, LIVE_SEQ_OFFSET, self.seq & 0xffffffff)
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.close()
+        self.map = None
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+class RelayTunnel:
+    __slots__ = ('conn', 'client', 'target', 'to_client', 'to_target',
+                 'client_events', 'target_events', 'last_activity',
+                 'buflen', 'idle_limit', 'paused_until', 'eof', 'shut')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.client = conn.client
+        self.target = conn.target
+        self.to_client = bytearray()
+        self.to_target = bytearray()
+        self.client_events = 0
+        self.target_events = 0
+        self.last_activity = time.monotonic()
+        self.buflen = conn.config.buflen
+        # Same idle limit as doCONNECT: TIMEOUT rounds of a 3 second select
+        self.idle_limit = conn.config.timeout * 3
+        # Monotonic time until which a throttled tunnel is not read
+        self.paused_until = 0
+        # Sockets that sent EOF, and sockets whose write side we shut down
+        # once everything queued for them was delivered
+        self.eof = set()
+        self.shut = set()
+
+class RelayWorker(threading.Thread):
+    # Relays many tunnels from one thread with a selector (epoll on Linux).
+    # Pool-mode replacement for the per-connection doCONNECT loop.
+    def __init__(self, index):
+        threading.Thread.__init__(self, name=f'relay-{index}', daemon=True)
+        self.index = index
+        self.selector = selectors.DefaultSelector()
+        self.incoming = deque()
+        self.tunnels = set()
+        self.paused = set()
+        self.bytes_relayed = 0
+        self.running = True
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+
+    def attach(self, conn):
+        self.incoming.append(conn)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def load(self):
+        return len(self.tunnels) + len(self.incoming)
+
+    def run(self):
+        next_sweep = time.monotonic() + 3
+        while self.running:
+            timeout = 1
+            if self.paused:
+                timeout = min(max(min(t.paused_until for t in self.paused) - time.monotonic(), 0), 1)
+            for key, events in self.selector.select(timeout):
+                tunnel = key.data
+                if tunnel is None:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                elif tunnel.conn is not None:
+                    try:
+                        self.service(tunnel, key.fileobj, events)
+                    except OSError:
+                        self.finish(tunnel, 'relay_error')
+
+            while self.incoming:
+                self.add(self.incoming.popleft())
+
+            now = time.monotonic()
+            if self.paused:
+                for tunnel in [t for t in self.paused if t.paused_until <= now]:
+                    self.paused.discard(tunnel)
+                    tunnel.paused_until = 0
+                    self.update(tunnel)
+            if now >= next_sweep:
+                next_sweep = now + 3
+                for tunnel in [t for t in self.tunnels if now - t.last_activity >= t.idle_limit]:
+                    self.finish(tunnel, 'idle_timeout')
+
+        while self.incoming:
+            self.add(self.incoming.popleft())
+        for tunnel in list(self.tunnels):
+            self.finish(tunnel, 'shutdown')
+
+    def add(self, conn):
+        conn.client.setblocking(False)
+        conn.target.setblocking(False)
+        tunnel = RelayTunnel(conn)
+        self.tunnels.add(tunnel)
+        self.update(tunnel)
+
+    def service(self, tunnel, sock, events):
+        conn = tunnel.conn
+        if sock is tunnel.client:
+            source, dest, inbound, outbound = tunnel.client, tunnel.target, tunnel.to_target, tunnel.to_client
+        else:
+            source, dest, inbound, outbound = tunnel.target, tunnel.client, tunnel.to_client, tunnel.to_target
+
+        if events & selectors.EVENT_WRITE and outbound:
+            try:
+                del outbound[:sock.send(outbound)]
+            except (BlockingIOError, InterruptedError):
+                pass
+            if not outbound and dest in tunnel.eof:
+                self.half_close(tunnel, sock)
+
+        if events & selectors.EVENT_READ:
+            try:
+                data = source.recv(tunnel.buflen)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            if data == b'':
+                # Pass the EOF on once the bytes queued for the peer are out
+                conn.set_close_reason('client_closed' if source is tunnel.client else 'target_closed')
+                tunnel.eof.add(source)
+                if not inbound:
+                    self.half_close(tunnel, dest)
+                data = None
+            if data:
+                size = len(data)
+                if source is tunnel.client:
+                    conn.upload_bytes += size
+                else:
+                    conn.download_bytes += size
+                self.bytes_relayed += size
+                if not inbound:
+                    try:
+                        data = data[dest.send(data):]
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                inbound += data
+                if conn.quota_limited:
+                    delay = conn.charge_quota(size)
+                    if delay is None:
+                        self.finish(tunnel, 'quota_exceeded')
+                        return
+                    if delay:
+                        # Both sides stop being read until the pause is over
+                        tunnel.paused_until = time.monotonic() + delay
+                        self.paused.add(tunnel)
+
+        if len(tunnel.shut) == 2:
+            self.finish(tunnel, conn.close_reason)
+            return
+        tunnel.last_activity = time.monotonic()
+        self.update(tunnel)
+
+    def half_close(self, tunnel, sock):
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        tunnel.shut.add(sock)
+
+    def update(self, tunnel):
+        # Stop reading a side while the opposite direction still has a full
+        # buffer queued, so a slow peer applies backpressure instead of memory
+        read, write = selectors.EVENT_READ, selectors.EVENT_WRITE
+        readable = not tunnel.paused_until
+        client_read = readable and tunnel.client not in tunnel.eof and len(tunnel.to_target) < tunnel.buflen
+        target_read = readable and tunnel.target not in tunnel.eof and len(tunnel.to_client) < tunnel.buflen
+        client_events = (read if client_read else 0) | (write if tunnel.to_client else 0)
+        target_events = (read if target_read else 0) | (write if tunnel.to_target else 0)
+        tunnel.client_events = self.register(tunnel, tunnel.client, tunnel.client_events, client_events)
+        tunnel.target_events = self.register(tunnel, tunnel.target, tunnel.target_events, target_events)
+
+    def register(self, tunnel, sock, current, events):
+        if events != current:
+            if not current:
+                self.selector.register(sock, events, tunnel)
+            elif not events:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, events, tunnel)
+        return events
+
+    def finish(self, tunnel, reason):
+        self.tunnels.discard(tunnel)
+        self.paused.discard(tunnel)
+        for sock, events in ((tunnel.client, tunnel.client_events), (tunnel.target, tunnel.target_events)):
+            if events:
+                try:
+                    self.selector.unregister(sock)
+                except (KeyError, ValueError):
+                    pass
+        conn, tunnel.conn = tunnel.conn, None
+        conn.set_close_reason(reason)
+        conn.finish()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+class RelayPool:
+    def __init__(self, size):
+        self.workers = [RelayWorker(i) for i in range(max(1, size))]
+        for worker in self.workers:
+            worker.start()
+
+    def attach(self, conn):
+        min(self.workers, key=RelayWorker.load).attach(conn)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join(5)
+
+    def get_stats(self):
+        return [{'worker': w.index, 'tunnels': w.load(), 'bytes': w.bytes_relayed} for w in self.workers]
+
+class ConnectionEvent:
+    __slots__ = ('time', 'type', 'conn_id', 'client', 'target', 'username', 'duration')
+
+    def __init__(self, event_type, conn, duration=None):
+        self.time = time.time()
+        self.type = event_type
+        self.conn_id = conn.conn_id
+        self.client = conn.client_addr
+        self.target = conn.target_info
+        self.username = conn.username
+        self.duration = duration
+
+    def as_dict(self):
+        event = {
+            'time': datetime.fromtimestamp(self.time).strftime('%H:%M:%S'),
+            'type': self.type,
+            'conn_id': self.conn_id,
+            'client': self.client,
+            'target': self.target,
+            'username': self.username
+        }
+        if self.duration is not None:
+            event['duration'] = self.duration
+        return event
+
+class SlowTraceStore:
+    # Min-heap of the slowest handshakes, so the fastest kept entry is the
+    # one replaced; faster handshakes are rejected without taking the lock
+    def __init__(self, size):
+        self.size = size
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def add(self, total_ms, trace):
+        if len(self.heap) >= self.size and total_ms <= self.heap[0][0]:
+            return
+        item = (total_ms, next(self.counter), trace)
+        with self.lock:
+            if len(self.heap) < self.size:
+                heapq.heappush(self.heap, item)
+            elif total_ms > self.heap[0][0]:
+                heapq.heapreplace(self.heap, item)
+
+    def get(self, count=None):
+        with self.lock:
+            items = sorted(self.heap, reverse=True)
+        traces = [trace for _, _, trace in items]
+        return traces[:int(count)] if count else traces
+
+class TunnelConfig(namedtuple('TunnelConfig', ['generation'] + [field for field, _ in CONFIG_KEYS.values()])):
+    # Immutable settings snapshot. Reloads build a new one and swap the
+    # reference; a connection keeps the snapshot it was accepted with.
+    __slots__ = ()
+
+def load_config(path, generation=1):
+    # Built-in defaults, then the config file, then command line options
+    values = {field: globals()[key] for key, (field, _) in CONFIG_KEYS.items()}
+    if os.path.exists(path):
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, sep, value = line.partition('=')
+                key = key.strip()
+                if not sep or key not in CONFIG_KEYS:
+                    logging.warning(f"⚠️ {Colors.YELLOW}{path}:{lineno}: ignoring unknown setting '{key}'{Colors.RESET}")
+                    continue
+                field, cast = CONFIG_KEYS[key]
+                try:
+                    values[field] = cast(value.strip().strip('"\''))
+                except ValueError:
+                    raise ValueError(f"{path}:{lineno}: invalid value for {key}")
+    values.update(CLI_OVERRIDES)
+
+    if not 0 < values['listening_port'] < 65536:
+        raise ValueError(f"invalid LISTENING_PORT {values['listening_port']}")
+    for key in ('BUFLEN', 'TIMEOUT', 'HANDSHAKE_TIMEOUT', 'MAX_HEADER_SIZE', 'QUOTA_THROTTLE_RATE'):
+        if values[CONFIG_KEYS[key][0]] <= 0:
+            raise ValueError(f"{key} must be positive")
+    if not 0 <= values['log_sample_rate'] <= 1:
+        raise ValueError("LOG_SAMPLE_RATE must be between 0 and 1")
+    if not 0 <= values['trace_sample_rate'] <= 1:
+        raise ValueError("TRACE_SAMPLE_RATE must be between 0 and 1")
+    if values['session_limit_policy'] not in ('reject', 'evict'):
+        raise ValueError("SESSION_LIMIT_POLICY must be 'reject' or 'evict'")
+    if values['quota_action'] not in ('disconnect', 'throttle'):
+        raise ValueError("QUOTA_ACTION must be 'disconnect' or 'throttle'")
+    return TunnelConfig(generation=generation, **values)
+
+def sd_notify(message):
+    # Minimal client for the systemd notify protocol; a no-op outside systemd
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return
+    if path.startswith('@'):
+        path = '\0' + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as soc:
+            soc.connect(path)
+            soc.sendall(message.encode('utf-8'))
+    except OSError:
+        pass
+
+def inherit_listener():
+    # systemd socket activation passes the listening socket as fd 3
+    if os.environ.get('LISTEN_PID') == str(os.getpid()) and int(os.environ.get('LISTEN_FDS', '0')) >= 1:
+        for key in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(key, None)
+        return socket.socket(fileno=3), None
+
+    # A running instance handing over its socket with SCM_RIGHTS
+    path = os.environ.pop('GX_HANDOFF_SOCKET', None)
+    if not path:
+        return None
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        channel.settimeout(HANDOFF_TIMEOUT)
+        channel.connect(path)
+        _, fds, _, _ = socket.recv_fds(channel, 16, 1)
+        if not fds:
+            raise OSError('no socket received')
+    except OSError as e:
+        channel.close()
+        logging.error(f"❌ {Colors.RED}Listening socket handoff failed: {e}{Colors.RESET}")
+        return None
+    return socket.socket(fileno=fds[0]), channel
 
 class Server(threading.Thread):
-    def __init__(self, host, port):
+    def __init__(self, config):
         threading.Thread.__init__(self)
         self.running = False
-        self.host = host
-        self.port = port
-        self.threads = []
+        self.config = config
+        self.host = config.listening_addr
+        self.port = config.listening_port
+        self.reload_lock = threading.Lock()
+        self.pending_soc = None
+        self.last_reload_ms = 0
+        self.conns = {}
+        self.conn_ids = itertools.count(1)
         self.threadsLock = threading.Lock()
         self.logLock = threading.Lock()
-        self.connection_events = []
-        self.user_manager = UserManager(USER_DB)
+        self.connection_events = deque(maxlen=EVENT_RING_SIZE)
+        self.slow_traces = SlowTraceStore(SLOW_TRACE_SIZE)
+        self.profiler = Profiler(PROFILE_DIR)
+        self.handoff_channel = None
+        self.draining = False
+        self.drain_deadline = 0
+        self.ip_filter = CIDRFilter(CIDR_ALLOW_FILE, CIDR_DENY_FILE)
+        self.housekeeper = Housekeeper()
+        self.housekeeper.add_task(CIDR_RELOAD_INTERVAL, self.ip_filter.reload)
+        self.tcp_summary = {'tunnels': 0}
+        self.tcp_by_user = {}
+        if TCP_INFO_INTERVAL > 0:
+            self.housekeeper.add_task(TCP_INFO_INTERVAL, self.sample_tcp_info)
+        self.metrics_server = None
+        self.auth_throttle = AuthThrottle(AUTH_FAIL_THRESHOLD, AUTH_FAIL_HALF_LIFE,
+                                          AUTH_BAN_TIME, AUTH_BAN_MAX, AUTH_TRACKER_SIZE)
+        self.housekeeper.add_task(60, self.auth_throttle.purge)
+        self.control = ControlServer(CONTROL_SOCKET)
+        self.control.register('stats', self.get_stats)
+        self.control.register('bans', self.auth_throttle.get_bans)
+        self.control.register('unban', self.auth_throttle.unban)
+        self.control.register('connections', self.get_connections)
+        self.control.register('events', self.get_recent_events)
+        self.control.register('slow', self.slow_traces.get)
+        self.control.register('profile', self.profiler.capture)
+        self.control.register('tcp', self.get_tcp_info)
+        self.control.register('upgrade', self.handoff)
+        self.control.register('reload', self.reload_config)
+        self.relay_pool = None
+        self.handshake_pool = None
+        self.handshake_slots = threading.Semaphore(HANDSHAKE_WORKERS + HANDSHAKE_BACKLOG)
+        self.user_manager = UserManager(USER_DB, LEGACY_USER_DB)
+        self.sessions = SessionRegistry()
+        self.expiry = ExpiryScheduler(self.user_manager, self.sessions)
+        self.user_manager.on_change = self.expiry.users_changed
+        self.control.register('sessions', self.get_sessions)
+        self.housekeeper.add_task(USER_RELOAD_INTERVAL, self.user_manager.check_reload)
+        self.housekeeper.add_task(3600, self.user_manager.store.prune_changes)
         self.stats_manager = StatisticsManager(STATS_DB)
+        self.quotas = QuotaManager(self.user_manager, STATS_DB)
+        self.control.register('quota', self.quotas.get_usage)
+        self.housekeeper.add_task(STATS_MAINTENANCE_INTERVAL, self.stats_manager.request_maintenance)
+        self.live_metrics = LiveMetrics(LIVE_METRICS_FILE, LIVE_METRICS_USERS)
+        self.housekeeper.add_task(LIVE_METRICS_INTERVAL, self.publish_live_metrics)
+        # Serialises checkpoints against finish() so no bytes are counted twice
+        self.usage_lock = threading.Lock()
+        if STATS_CHECKPOINT_INTERVAL > 0:
+            self.housekeeper.add_task(STATS_CHECKPOINT_INTERVAL, self.checkpoint_usage)
 
     def run(self):
-        self.soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.soc.settimeout(2)
-        intport = int(self.port)
-        
+        inherited = inherit_listener()
         try:
-            self.soc.bind((self.host, intport))
-            self.soc.listen(0)
+            if inherited:
+                self.soc, self.handoff_channel = inherited
+                self.soc.settimeout(2)
+                logging.info(f"♻️ {Colors.CYAN}Inherited listening socket {self.soc.getsockname()}{Colors.RESET}")
+                if self.soc.getsockname()[1] != self.port:
+                    # The config changed the port before this restart
+                    self.pending_soc = self.open_listener(self.host, self.port)
+            else:
+                self.soc = self.open_listener(self.host, self.port)
             self.running = True
+            self.stats_manager.start_writer()
+            self.live_metrics.open()
+            self.expiry.start()
+            self.housekeeper.start()
+            if METRICS_PORT:
+                self.metrics_server = MetricsServer(METRICS_ADDR, METRICS_PORT, self.render_metrics)
+                self.metrics_server.start()
+            self.control.start()
+            if EXEC_MODE == 'pool':
+                self.relay_pool = RelayPool(RELAY_WORKERS)
+                self.handshake_pool = ThreadPoolExecutor(HANDSHAKE_WORKERS, thread_name_prefix='handshake')
+                logging.info(f"⚙️ {Colors.CYAN}Worker pool mode: {RELAY_WORKERS} relay workers, {HANDSHAKE_WORKERS} handshake workers{Colors.RESET}")
 
             logging.info(f"🚀 {Colors.GREEN}GX Tunnel started on {self.host}:{self.port}{Colors.RESET}")
             logging.info(f"📊 {Colors.CYAN}Real-time logging: Active{Colors.RESET}")
             logging.info(f"👥 {Colors.YELLOW}User authentication: Enabled{Colors.RESET}")
 
+            self.announce_ready()
+
             while self.running:
+                if self.pending_soc:
+                    self.swap_listener()
                 try:
                     c, addr = self.soc.accept()
                     c.setblocking(1)
-                    
-                    # Log new connection attempt
                     client_ip = addr[0]
-                    logging.info(f"🔗 {Colors.BLUE}New connection from {client_ip}{Colors.RESET}")
-                    
                 except socket.timeout:
                     continue
 
+                if not self.ip_filter.allowed(client_ip):
+                    with stats_lock:
+                        connection_stats['blocked_connections'] += 1
+                    c.close()
+                    continue
+
+                if self.auth_throttle.is_banned(f'ip:{client_ip}'):
+                    with stats_lock:
+                        connection_stats['banned_connections'] += 1
+                    c.close()
+                    continue
+
+                if self.handshake_pool and not self.handshake_slots.acquire(blocking=False):
+                    with stats_lock:
+                        connection_stats['handshake_overflows'] += 1
+                    c.close()
+                    continue
+
                 conn = ConnectionHandler(c, self, addr)
-                conn.start()
                 self.addConn(conn)
+                if self.handshake_pool:
+                    self.handshake_pool.submit(self.run_handshake, conn)
+                else:
+                    conn.start()
                 
         except Exception as e:
             logging.error(f"❌ {Colors.RED}Server error: {e}{Colors.RESET}")
         finally:
             self.running = False
+            if self.draining:
+                self.wait_drained()
+            self.housekeeper.stop()
+            self.expiry.stop()
+            if self.metrics_server:
+                self.metrics_server.close()
+            self.control.close()
+            self.live_metrics.close()
             self.soc.close()
+            if self.pending_soc:
+                self.pending_soc.close()
+            if self.handshake_pool:
+                self.handshake_pool.shutdown(wait=False)
+            if self.relay_pool:
+                self.relay_pool.stop()
+            # Tunnels closing after this point write synchronously
+            self.stats_manager.stop_writer()
             logging.info(f"🛑 {Colors.YELLOW}Server stopped{Colors.RESET}")
 
+    def run_handshake(self, conn):
+        # Pool mode: the slot is held until the tunnel is handed to a relay
+        # worker or the handshake fails
+        try:
+            conn.run()
+        finally:
+            self.handshake_slots.release()
+
+    def open_listener(self, host, port):
+        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            soc.bind((host, int(port)))
+            soc.listen(LISTEN_BACKLOG)
+        except OSError:
+            soc.close()
+            raise
+        soc.settimeout(2)
+        return soc
+
+    def swap_listener(self):
+        # Called from the accept loop so the socket is never replaced under accept()
+        with self.reload_lock:
+            old, self.soc, self.pending_soc = self.soc, self.pending_soc, None
+        old.close()
+        logging.info(f"🔀 {Colors.CYAN}Now listening on {self.host}:{self.port}{Colors.RESET}")
+
+    def reload_config(self):
+        # Swap in a new config snapshot. Open tunnels keep the one they were
+        # accepted with; new connections use the new one.
+        with self.reload_lock:
+            started = time.perf_counter()
+            try:
+                config = load_config(CONFIG_FILE, self.config.generation + 1)
+            except (OSError, ValueError) as e:
+                logging.error(f"❌ {Colors.RED}Config reload failed, keeping generation {self.config.generation}: {e}{Colors.RESET}")
+                return {'error': str(e)}
+
+            if (config.listening_addr, config.listening_port) != (self.host, self.port):
+                try:
+                    soc = self.open_listener(config.listening_addr, config.listening_port)
+                except OSError as e:
+                    logging.error(f"❌ {Colors.RED}Cannot listen on {config.listening_addr}:{config.listening_port}, reload aborted: {e}{Colors.RESET}")
+                    return {'error': str(e)}
+                if self.pending_soc:
+                    self.pending_soc.close()
+                self.pending_soc = soc
+
+            self.config = config
+            self.host, self.port = config.listening_addr, config.listening_port
+            self.user_manager.load_users()
+            self.ip_filter.reload()
+            self.last_reload_ms = (time.perf_counter() - started) * 1000
+
+        logging.info(f"🔄 {Colors.GREEN}Configuration generation {config.generation} loaded in {self.last_reload_ms:.1f}ms{Colors.RESET}")
+        return {'generation': config.generation, 'reload_ms': round(self.last_reload_ms, 2)}
+
+    def announce_ready(self):
+        if self.handoff_channel:
+            try:
+                self.handoff_channel.sendall(b'READY')
+            except OSError:
+                pass
+            self.handoff_channel.close()
+            self.handoff_channel = None
+        sd_notify('READY=1')
+
+    def handoff(self):
+        # Start a replacement process, pass it the listening socket, then drain
+        if self.draining or not self.running:
+            return {'error': 'server is not accepting connections'}
+
+        os.makedirs(os.path.dirname(HANDOFF_SOCKET), exist_ok=True)
+        if os.path.exists(HANDOFF_SOCKET):
+            os.unlink(HANDOFF_SOCKET)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        child = None
+        try:
+            listener.bind(HANDOFF_SOCKET)
+            os.chmod(HANDOFF_SOCKET, 0o600)
+            listener.listen(1)
+            listener.settimeout(HANDOFF_TIMEOUT)
+            env = dict(os.environ, GX_HANDOFF_SOCKET=HANDOFF_SOCKET)
+            child = subprocess.Popen([sys.executable] + sys.argv, env=env)
+            channel, _ = listener.accept()
+            with channel:
+                channel.settimeout(HANDOFF_TIMEOUT)
+                socket.send_fds(channel, [b'LISTEN'], [self.soc.fileno()])
+                if channel.recv(16) != b'READY':
+                    raise OSError('replacement process did not become ready')
+        except OSError as e:
+            logging.error(f"❌ {Colors.RED}Graceful restart failed, keeping current process: {e}{Colors.RESET}")
+            if child and child.poll() is None:
+                child.terminate()
+            return {'error': str(e)}
+        finally:
+            listener.close()
+            try:
+                os.unlink(HANDOFF_SOCKET)
+            except OSError:
+                pass
+
+        sd_notify(f'MAINPID={child.pid}')
+        logging.info(f"♻️ {Colors.GREEN}Handed listening socket to PID {child.pid}{Colors.RESET}")
+        self.drain()
+        return {'handoff_pid': child.pid, 'draining': len(self.conns)}
+
+    def drain(self):
+        # Stop accepting; existing tunnels keep running until DRAIN_TIMEOUT
+        self.drain_deadline = time.time() + DRAIN_TIMEOUT
+        self.draining = True
+        self.running = False
+        # Let the new process take over the metrics port
+        if self.metrics_server:
+            self.metrics_server.close()
+        logging.info(f"🌊 {Colors.YELLOW}Draining {len(self.conns)} tunnels (deadline {DRAIN_TIMEOUT}s){Colors.RESET}")
+
+    def wait_drained(self):
+        while self.conns and time.time() < self.drain_deadline:
+            time.sleep(1)
+        if self.conns:
+            logging.warning(f"⚠️ {Colors.YELLOW}Drain deadline reached, closing {len(self.conns)} tunnels{Colors.RESET}")
+            self.close()
+            deadline = time.time() + 5
+            while self.conns and time.time() < deadline:
+                time.sleep(0.1)
+        logging.info(f"✅ {Colors.GREEN}Drain complete{Colors.RESET}")
+
     def printLog(self, log):
         logging.info(log)
 
     def addConn(self, conn):
-        try:
-            self.threadsLock.acquire()
-            if self.running:
-                self.threads.append(conn)
+        with self.threadsLock:
+            # Sockets accepted just before a drain started are still tracked
+            if self.running or self.draining:
+                self.conns[conn.conn_id] = conn
                 connection_stats['total_connections'] += 1
-                connection_stats['active_connections'] = len(self.threads)
-                
-                # Log connection event
-                event = {
-                    'time': datetime.now().strftime('%H:%M:%S'),
-                    'client': conn.log.split(' ')[1],
-                    'target': conn.log.split('CONNECT ')[1] if 'CONNECT' in conn.log else 'Unknown',
-                    'type': 'NEW'
-                }
-                self.connection_events.append(event)
-                
-        finally:
-            self.threadsLock.release()
+                connection_stats['active_connections'] = len(self.conns)
+                self.connection_events.append(ConnectionEvent('NEW', conn))
 
     def removeConn(self, conn):
-        try:
-            self.threadsLock.acquire()
-            if conn in self.threads:
-                self.threads.remove(conn)
-                connection_stats['active_connections'] = len(self.threads)
-                
-                # Log disconnection event
-                event = {
-                    'time': datetime.now().strftime('%H:%M:%S'),
-                    'client': conn.log.split(' ')[1],
-                    'target': conn.log.split('CONNECT ')[1] if 'CONNECT' in conn.log else 'Unknown',
-                    'type': 'CLOSE',
-                    'duration': getattr(conn, 'connection_duration', 0)
-                }
-                self.connection_events.append(event)
-                
-        finally:
-            self.threadsLock.release()
+        with self.threadsLock:
+            if self.conns.pop(conn.conn_id, None) is not None:
+                connection_stats['active_connections'] = len(self.conns)
+                self.connection_events.append(ConnectionEvent('CLOSE', conn, conn.connection_duration))
 
     def close(self):
         try:
             self.running = False
             self.threadsLock.acquire()
-            threads = list(self.threads)
-            for c in threads:
-                c.close()
+            conns = list(self.conns.values())
+            for c in conns:
+                c.terminate()
         finally:
             self.threadsLock.release()
 
+    def publish_live_metrics(self):
+        with self.threadsLock:
+            conns = list(self.conns.values())
+        users = {}
+        active_download = active_upload = 0
+        for conn in conns:
+            active_download += conn.download_bytes
+            active_upload += conn.upload_bytes
+            if conn.username:
+                entry = users.setdefault(conn.username, [0, 0, 0])
+                entry[0] += 1
+                entry[1] += conn.download_bytes
+                entry[2] += conn.upload_bytes
+        counters = dict(connection_stats)
+        counters.update(active_connections=len(conns),
+                        active_download_bytes=active_download,
+                        active_upload_bytes=active_upload)
+        self.live_metrics.publish(counters, users)
+
+    def checkpoint_usage(self):
+        # Count the bytes live tunnels moved since the last checkpoint so a
+        # long session shows up in the totals before it closes, and a crash
+        # loses at most one interval of it
+        now = int(time.time())
+        with self.threadsLock:
+            conns = list(self.conns.values())
+        records = []
+        with self.usage_lock:
+            for conn in conns:
+                if not conn.username or conn.usage_closed:
+                    continue
+                download_bytes, upload_bytes = conn.download_bytes, conn.upload_bytes
+                download_delta = download_bytes - conn.checkpointed_download
+                upload_delta = upload_bytes - conn.checkpointed_upload
+                if not download_delta and not upload_delta:
+                    continue
+                conn.checkpointed_download = download_bytes
+                conn.checkpointed_upload = upload_bytes
+                start = int(conn.start_time)
+                records.append((conn.username, conn.client_ip, start, now, now - start,
+                                download_bytes, upload_bytes, download_delta, upload_delta, False))
+        self.stats_manager.checkpoint_usage(records)
+
+    def render_metrics(self):
+        ns = METRICS_NAMESPACE
+        lines = []
+        for name, kind, help_text, value in (
+            ('connections_total', 'counter', 'Accepted connections', connection_stats['total_connections']),
+            ('active_connections', 'gauge', 'Open connections', len(self.conns)),
+            ('handshaking', 'gauge', 'Connections still sending request headers', connection_stats['handshaking']),
+            ('auth_failures_total', 'counter', 'Rejected credentials', connection_stats['auth_failures']),
+            ('upstream_errors_total', 'counter', 'Failed target connections', connection_stats['connect_failures']),
+            ('handshake_timeouts_total', 'counter', 'Handshakes that timed out', connection_stats['handshake_timeouts']),
+            ('oversized_headers_total', 'counter', 'Handshakes over MAX_HEADER_SIZE', connection_stats['oversized_headers']),
+            ('blocked_connections_total', 'counter', 'Connections refused by the CIDR filter', connection_stats['blocked_connections']),
+            ('banned_connections_total', 'counter', 'Connections refused by an auth ban', connection_stats['banned_connections']),
+            ('handshake_overflows_total', 'counter', 'Connections refused with the handshake backlog full', connection_stats['handshake_overflows']),
+        ):
+            lines += [f'# HELP {ns}_{name} {help_text}', f'# TYPE {ns}_{name} {kind}', f'{ns}_{name} {value}']
+        lines += [f'# HELP {ns}_bytes_total Bytes relayed by closed tunnels',
+                  f'# TYPE {ns}_bytes_total counter',
+                  f'{ns}_bytes_total{{direction="down"}} {connection_stats["download_bytes"]}',
+                  f'{ns}_bytes_total{{direction="up"}} {connection_stats["upload_bytes"]}']
+        for histogram in (handshake_histogram, connect_histogram, duration_histogram, size_histogram):
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+    def sample_tcp_info(self):
+        # One getsockopt per established tunnel; the latest sample is kept
+        # on the handler and summarised here overall and per user
+        with self.threadsLock:
+            conns = [c for c in self.conns.values() if c.established_time and not c.clientClosed]
+        sampled = []
+        for conn in conns:
+            info = read_tcp_info(conn.client)
+            if info:
+                info['max_rtt_ms'] = max(info['rtt_ms'], conn.tcp_info['max_rtt_ms'] if conn.tcp_info else 0)
+                conn.tcp_info = info
+                sampled.append(conn)
+        self.tcp_summary = summarize_tcp_info([conn.tcp_info for conn in sampled])
+        by_user = {}
+        for conn in sampled:
+            if conn.username:
+                by_user.setdefault(conn.username, []).append(conn.tcp_info)
+        self.tcp_by_user = {username: summarize_tcp_info(samples) for username, samples in by_user.items()}
+
+    def get_tcp_info(self, username=None):
+        if username:
+            return self.tcp_by_user.get(username, {'tunnels': 0})
+        return {'overall': self.tcp_summary, 'users': self.tcp_by_user}
+
     def get_stats(self):
         current_time = time.time()
         uptime = current_time - connection_stats['start_time']
+        writer = self.stats_manager.writer
         
         return {
-            'active_connections': len(self.threads),
+            'active_connections': len(self.conns),
             'total_connections': connection_stats['total_connections'],
+            'blocked_connections': connection_stats['blocked_connections'],
+            'handshaking': connection_stats['handshaking'],
+            'handshakes': connection_stats['handshakes'],
+            'handshake_timeouts': connection_stats['handshake_timeouts'],
+            'oversized_headers': connection_stats['oversized_headers'],
+            'connect_failures': connection_stats['connect_failures'],
+            'cidr_rules': self.ip_filter.entries,
+            'banned_connections': connection_stats['banned_connections'],
+            'handshake_overflows': connection_stats['handshake_overflows'],
+            'auth_failures': connection_stats['auth_failures'],
             'listening_port': self.port,
+            'state': 'draining' if self.draining else 'running',
+            'config_generation': self.config.generation,
+            'last_reload_ms': round(self.last_reload_ms, 2),
+            'drain_remaining': max(0, int(self.drain_deadline - current_time)) if self.draining else 0,
             'server_uptime': uptime,
-            'connections_per_minute': connection_stats['total_connections'] / (uptime / 60) if uptime > 0 else 0
+            'connections_per_minute': connection_stats['total_connections'] / (uptime / 60) if uptime > 0 else 0,
+            'exec_mode': EXEC_MODE,
+            'relay_workers': self.relay_pool.get_stats() if self.relay_pool else [],
+            'stats_writer': writer.get_stats() if writer else None,
+            'auth_cache': self.user_manager.verifier.get_stats(),
+            'sessions': self.sessions.get_stats(self.user_manager.session_limit),
+            'quotas': self.quotas.get_stats(),
+            'tcp': self.tcp_summary
         }
     
-    def get_recent_events(self, count=10):
-        return self.connection_events[-count:]
+    def get_sessions(self, username=None):
+        occupancy = self.sessions.occupancy(self.user_manager.session_limit)
+        if username:
+            return occupancy.get(username, {'sessions': 0, 'limit': self.user_manager.session_limit(username)})
+        return occupancy
+
+    def get_connections(self, username=None):
+        with self.threadsLock:
+            conns = list(self.conns.values())
+        now = time.time()
+        return [{
+            'conn_id': c.conn_id,
+            'client': c.client_addr,
+            'username': c.username,
+            'target': c.target_info,
+            'started': datetime.fromtimestamp(c.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': round(now - c.start_time, 1),
+            'download_bytes': c.download_bytes,
+            'upload_bytes': c.upload_bytes,
+            'tcp': c.tcp_info
+        } for c in conns if username is None or c.username == username]
+
+    def get_recent_events(self, count=10, event_type=None):
+        count = int(count)
+        if event_type is None:
+            events = list(itertools.islice(reversed(self.connection_events), count))
+        else:
+            events = list(itertools.islice((e for e in reversed(self.connection_events) if e.type == event_type), count))
+        return [e.as_dict() for e in reversed(events)]
+
+class HandshakeError(Exception):
+    pass
 
 class ConnectionHandler(threading.Thread):
     def __init__(self, socClient, server, addr):
@@ -403,13 +2683,35 @@ class ConnectionHandler(threading.Thread):
         self.client = socClient
         self.client_buffer = b''
         self.server = server
-        self.log = f"Connection: {addr[0]}:{addr[1]}"
+        self.config = server.config
+        self.conn_id = next(server.conn_ids)
+        self.client_addr = f"{addr[0]}:{addr[1]}"
+        self.target_info = 'Unknown'
+        self.log = f"Connection: {self.client_addr}"
         self.start_time = time.time()
+        self.handshake_deadline = time.monotonic() + self.config.handshake_timeout
+        self.established_time = None
         self.connection_duration = 0
+        self.close_reason = None
+        # Per-event info lines are logged for a sample of connections
+        self.verbose = random.random() < self.config.log_sample_rate
+        # Monotonic end time of each handshake phase, starting at accept
+        self.trace = [('accepted', time.monotonic())]
+        self.trace_logged = random.random() < self.config.trace_sample_rate
+        self.tcp_info = None
         self.username = None
         self.client_ip = addr[0]
         self.download_bytes = 0
         self.upload_bytes = 0
+        # Byte counts already written by Server.checkpoint_usage
+        self.checkpointed_download = 0
+        self.checkpointed_upload = 0
+        self.usage_closed = False
+        # Bytes not yet charged to the user's quota, see charge_quota()
+        self.quota_limited = False
+        self.quota_pending = 0
+        self.throttled = False
+        self.relayed = False
 
     def close(self):
         try:
@@ -430,9 +2732,80 @@ class ConnectionHandler(threading.Thread):
         finally:
             self.targetClosed = True
 
+    def terminate(self):
+        # Wake whichever thread owns this connection; that thread does the close
+        self.set_close_reason('terminated')
+        for sock in (self.client, getattr(self, 'target', None)):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+    def set_close_reason(self, reason):
+        # First reason wins; a terminate() surfaces later as a socket error
+        if self.close_reason is None:
+            self.close_reason = reason
+
+    def record_metrics(self):
+        with stats_lock:
+            connection_stats['download_bytes'] += self.download_bytes
+            connection_stats['upload_bytes'] += self.upload_bytes
+        if self.established_time:
+            duration_histogram.observe(time.time() - self.established_time)
+            size_histogram.observe(self.download_bytes + self.upload_bytes)
+
+    def mark(self, phase):
+        self.trace.append((phase, time.monotonic()))
+
+    def finish_trace(self):
+        # Each phase is the time since the previous mark: queued (waiting for
+        # a thread), headers, auth, resolve, connect and response (the 101)
+        phases = {}
+        started = previous = self.trace[0][1]
+        for phase, at in self.trace[1:]:
+            phases[phase] = round((at - previous) * 1000, 3)
+            previous = at
+        total_ms = round((previous - started) * 1000, 3)
+        self.server.slow_traces.add(total_ms, {
+            'id': self.conn_id,
+            'time': datetime.fromtimestamp(self.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+            'client': self.client_addr,
+            'user': self.username,
+            'target': self.target_info,
+            'total_ms': total_ms,
+            'phases': phases
+        })
+        if self.trace_logged:
+            breakdown = ' '.join(f'{phase}={ms}ms' for phase, ms in phases.items())
+            logging.info(f"🧭 {Colors.BLUE}Trace {self.conn_id}: {total_ms}ms - {breakdown}{Colors.RESET}")
+
+    def log_access(self):
+        # A last TCP_INFO sample, so short tunnels get one too
+        tcp_info = read_tcp_info(self.client) if self.established_time and not self.clientClosed else None
+        tcp_info = tcp_info or self.tcp_info
+        access_log.info('', extra={'access': {
+            'ts': round(time.time(), 3),
+            'id': self.conn_id,
+            'client': self.client_addr,
+            'user': self.username,
+            'target': self.target_info,
+            'start': round(self.start_time, 3),
+            'duration': round(self.connection_duration, 3),
+            'handshake_ms': round((self.established_time - self.start_time) * 1000, 1) if self.established_time else None,
+            'up': self.upload_bytes,
+            'down': self.download_bytes,
+            'reason': self.close_reason or 'closed',
+            'rtt_ms': tcp_info['rtt_ms'] if tcp_info else None,
+            'retrans': tcp_info['retrans'] if tcp_info else None,
+        }})
+
     def run(self):
+        if self.verbose:
+            logging.info(f"🔗 {Colors.BLUE}New connection from {self.client_addr}{Colors.RESET}")
+        self.mark('queued')
         try:
-            self.client_buffer = self.client.recv(BUFLEN)
+            self.client_buffer = self.read_handshake()
+            self.mark('headers')
 
             # Extract credentials from headers
             username_header = self.findHeader(self.client_buffer, b'X-Username')
@@ -442,64 +2815,197 @@ class ConnectionHandler(threading.Thread):
                 username = username_header.decode('utf-8')
                 password = password_header.decode('utf-8')
                 
+                throttle = self.server.auth_throttle
+                if throttle.is_banned(f'user:{username}'):
+                    self.set_close_reason('banned')
+                    self.client.send(b'HTTP/1.1 429 Too Many Requests\r\n\r\n')
+                    logging.warning(f"🚫 {Colors.RED}Rejected banned user {username} from {self.client_ip}{Colors.RESET}")
+                    return
+
                 # Validate user
                 valid, message = self.server.user_manager.validate_user(username, password)
                 if not valid:
+                    self.set_close_reason('auth_failed')
                     self.client.send(b'HTTP/1.1 401 Unauthorized\r\n\r\n' + message.encode())
-                    logging.warning(f"🔒 {Colors.RED}Authentication failed for {username}: {message}{Colors.RESET}")
+                    logging.warning(f"🔒 {Colors.RED}Authentication failed for {username} from {self.client_ip}: {message}{Colors.RESET}")
+                    self.record_auth_failure(username)
                     return
                 
-                self.username = username
+                throttle.record_success(f'user:{username}')
                 
-                # Track user connection
-                if username not in user_connections:
-                    user_connections[username] = 0
-                user_connections[username] += 1
+                # A user already at a quota is refused, or admitted throttled
+                quotas = self.server.quotas
+                if quotas.limits(username):
+                    self.quota_limited = True
+                    # Seeds the counters here so relaying never waits on the database
+                    quotas.preload(username)
+                    if not quotas.check(username):
+                        if self.config.quota_action == 'disconnect':
+                            quotas.note_exceeded()
+                            self.set_close_reason('quota_exceeded')
+                            self.client.send(b'HTTP/1.1 429 Too Many Requests\r\n\r\nData quota exceeded')
+                            logging.warning(f"📉 {Colors.YELLOW}Rejected {username} from {self.client_ip}: data quota exceeded{Colors.RESET}")
+                            return
+                        self.throttled = True
                 
-                logging.info(f"✅ {Colors.GREEN}User {username} authenticated successfully ({user_connections[username]} active connections){Colors.RESET}")
+                # Claim a session slot; over the limit is not an auth failure
+                limit = self.server.user_manager.session_limit(username)
+                reserved, evicted = self.server.sessions.reserve(username, self, limit, self.config.session_limit_policy)
+                if not reserved:
+                    self.set_close_reason('session_limit')
+                    self.client.send(b'HTTP/1.1 429 Too Many Requests\r\n\r\n' + f"Maximum connections ({limit}) reached".encode())
+                    logging.warning(f"🚦 {Colors.YELLOW}Rejected {username} from {self.client_ip}: {limit} sessions already open{Colors.RESET}")
+                    return
+                self.username = username
+                # Re-checked after reserving, in case a reload raced the login
+                self.server.expiry.enforce(username)
+                if evicted:
+                    evicted.set_close_reason('evicted')
+                    evicted.terminate()
+                    logging.info(f"🚦 {Colors.YELLOW}Closed oldest session #{evicted.conn_id} of {username} to admit {self.client_ip}{Colors.RESET}")
+                
+                if self.verbose:
+                    logging.info(f"✅ {Colors.GREEN}User {username} authenticated successfully ({self.server.sessions.count(username)} active connections){Colors.RESET}")
             else:
+                self.set_close_reason('no_credentials')
                 self.client.send(b'HTTP/1.1 401 Credentials Required\r\n\r\n')
                 logging.warning(f"⚠️ {Colors.YELLOW}No credentials provided from {self.log}{Colors.RESET}")
+                self.record_auth_failure(None)
                 return
+            self.mark('auth')
 
             # Extract target host
             hostPort = self.findHeader(self.client_buffer, b'X-Real-Host')
             if hostPort == b'':
                 host_header = self.findHeader(self.client_buffer, b'Host')
-                hostPort = host_header if host_header else DEFAULT_HOST.encode('utf-8')
+                hostPort = host_header if host_header else self.config.default_host.encode('utf-8')
 
             if hostPort != b'':
                 self.method_CONNECT(hostPort)
             else:
                 self.client.send(b'HTTP/1.1 400 NoTargetHost!\r\n\r\n')
 
+        except HandshakeError as e:
+            reason = str(e)
+            if reason == 'timeout':
+                with stats_lock:
+                    connection_stats['handshake_timeouts'] += 1
+            elif reason == 'oversized':
+                with stats_lock:
+                    connection_stats['oversized_headers'] += 1
+                try:
+                    self.client.send(b'HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n')
+                except OSError:
+                    pass
+            self.log += f' - handshake {reason}'
+            self.set_close_reason(f'handshake_{reason}')
+            logging.warning(f"⏱️ {Colors.YELLOW}Dropped during handshake: {self.log}{Colors.RESET}")
         except Exception as e:
             self.log += f' - error: {str(e)}'
+            self.set_close_reason('error')
             logging.error(f"💥 {Colors.RED}Connection error: {self.log}{Colors.RESET}")
         finally:
-            self.connection_duration = time.time() - self.start_time
+            # Relayed tunnels are finished by their relay worker
+            if not self.relayed:
+                self.finish()
+
+    def finish(self):
+        self.connection_duration = time.time() - self.start_time
+
+        # Update statistics
+        if self.username:
+            self.server.sessions.release(self.username, self)
+            if self.quota_pending:
+                self.server.quotas.charge(self.username, self.quota_pending)
+                self.quota_pending = 0
             
-            # Update statistics
-            if self.username:
-                # Remove from active connections
-                if self.username in user_connections:
-                    user_connections[self.username] = max(0, user_connections[self.username] - 1)
-                
-                # Log statistics
-                self.server.stats_manager.log_connection(
-                    self.username, 
-                    self.client_ip, 
-                    int(self.connection_duration),
-                    self.download_bytes,
-                    self.upload_bytes
-                )
-                
-                logging.info(f"🔌 {Colors.CYAN}Connection closed: {self.username} from {self.log} - Duration: {self.connection_duration:.2f}s - Data: ↓{self.download_bytes} ↑{self.upload_bytes} bytes{Colors.RESET}")
-            else:
-                logging.info(f"🔌 {Colors.CYAN}Connection closed: {self.log} - Duration: {self.connection_duration:.2f}s{Colors.RESET}")
+            # Log statistics; checkpoints have already counted part of the bytes
+            with self.server.usage_lock:
+                self.usage_closed = True
+                download_delta = self.download_bytes - self.checkpointed_download
+                upload_delta = self.upload_bytes - self.checkpointed_upload
+            self.server.stats_manager.log_connection(
+                self.username, 
+                self.client_ip, 
+                int(self.connection_duration),
+                self.download_bytes,
+                self.upload_bytes,
+                download_delta,
+                upload_delta
+            )
             
-            self.close()
-            self.server.removeConn(self)
+            if self.verbose:
+                logging.info(f"🔌 {Colors.CYAN}Connection closed: {self.username} from {self.log} - Duration: {self.connection_duration:.2f}s - Data: ↓{self.download_bytes} ↑{self.upload_bytes} bytes{Colors.RESET}")
+        elif self.verbose:
+            logging.info(f"🔌 {Colors.CYAN}Connection closed: {self.log} - Duration: {self.connection_duration:.2f}s{Colors.RESET}")
+        
+        self.log_access()
+        self.record_metrics()
+        self.close()
+        self.server.removeConn(self)
+
+    def charge_quota(self, nbytes):
+        # Called by the relay loops for quota users. The shared counters are
+        # only touched every QUOTA_CHECK_BYTES; returns the seconds to pause
+        # reading while throttled, or None when the tunnel must close.
+        self.quota_pending += nbytes
+        if self.quota_pending >= QUOTA_CHECK_BYTES:
+            within = self.server.quotas.charge(self.username, self.quota_pending)
+            self.quota_pending = 0
+            if within:
+                self.throttled = False
+            elif self.config.quota_action == 'disconnect':
+                self.server.quotas.note_exceeded()
+                self.set_close_reason('quota_exceeded')
+                logging.warning(f"📉 {Colors.YELLOW}Closed tunnel of {self.username}: data quota exceeded{Colors.RESET}")
+                return None
+            elif not self.throttled:
+                self.server.quotas.note_exceeded()
+                self.throttled = True
+                logging.warning(f"📉 {Colors.YELLOW}Throttling {self.username} to {self.config.quota_throttle_rate} bytes/s: data quota exceeded{Colors.RESET}")
+        return nbytes / self.config.quota_throttle_rate if self.throttled else 0
+
+    def record_auth_failure(self, username):
+        with stats_lock:
+            connection_stats['auth_failures'] += 1
+        keys = [f'ip:{self.client_ip}']
+        if username:
+            keys.append(f'user:{username}')
+        for key in keys:
+            duration = self.server.auth_throttle.record_failure(key)
+            if duration:
+                logging.warning(f"🚫 {Colors.RED}Temporarily banned {key} for {duration}s{Colors.RESET}")
+
+    def read_handshake(self):
+        # Read up to the end of the request headers within HANDSHAKE_TIMEOUT and
+        # MAX_HEADER_SIZE, so idle or trickling clients cannot pin a thread
+        with stats_lock:
+            connection_stats['handshaking'] += 1
+        try:
+            buffer = b''
+            while b'\r\n\r\n' not in buffer:
+                buffer += self.recv_before_deadline()
+                if len(buffer) > self.config.max_header_size:
+                    raise HandshakeError('oversized')
+            return buffer
+        finally:
+            with stats_lock:
+                connection_stats['handshaking'] -= 1
+
+    def recv_before_deadline(self):
+        remaining = self.handshake_deadline - time.monotonic()
+        if remaining <= 0:
+            raise HandshakeError('timeout')
+        self.client.settimeout(remaining)
+        try:
+            data = self.client.recv(self.config.buflen)
+        except socket.timeout:
+            raise HandshakeError('timeout')
+        finally:
+            self.client.settimeout(None)
+        if not data:
+            raise HandshakeError('closed')
+        return data
 
     def findHeader(self, head, header):
         aux = head.find(header + b': ')
@@ -517,6 +3023,7 @@ class ConnectionHandler(threading.Thread):
         return head[:aux]
 
     def connect_target(self, host):
+        started = time.perf_counter()
         try:
             i = host.find(b':')
             if i != -1:
@@ -526,32 +3033,50 @@ class ConnectionHandler(threading.Thread):
                 port = 22  # Default to SSH port
 
             (soc_family, soc_type, proto, _, address) = socket.getaddrinfo(host.decode('utf-8'), port)[0]
+            self.mark('resolve')
 
             self.target = socket.socket(soc_family, soc_type, proto)
             self.targetClosed = False
             self.target.connect(address)
+            connect_histogram.observe(time.perf_counter() - started)
+            self.mark('connect')
             
-            logging.info(f"✅ {Colors.GREEN}Connected to target: {host.decode('utf-8')}:{port}{Colors.RESET}")
+            if self.verbose:
+                logging.info(f"✅ {Colors.GREEN}Connected to target: {host.decode('utf-8')}:{port}{Colors.RESET}")
             
         except Exception as e:
             logging.error(f"❌ {Colors.RED}Failed to connect to target {host.decode('utf-8')}: {e}{Colors.RESET}")
             raise
 
     def method_CONNECT(self, path):
-        target_info = path.decode('utf-8')
-        self.log += f' - CONNECT {target_info}'
+        self.target_info = path.decode('utf-8')
+        self.log += f' - CONNECT {self.target_info}'
         
-        if self.username:
-            logging.info(f"🚀 {Colors.GREEN}New tunnel established for {self.username}: {self.log}{Colors.RESET}")
-        else:
-            logging.info(f"🚀 {Colors.GREEN}New tunnel established: {self.log}{Colors.RESET}")
+        if self.verbose:
+            if self.username:
+                logging.info(f"🚀 {Colors.GREEN}New tunnel established for {self.username}: {self.log}{Colors.RESET}")
+            else:
+                logging.info(f"🚀 {Colors.GREEN}New tunnel established: {self.log}{Colors.RESET}")
 
         try:
             self.connect_target(path)
             self.client.sendall(RESPONSE.encode('utf-8'))
+            self.established_time = time.time()
+            self.mark('response')
+            handshake_histogram.observe(self.established_time - self.start_time)
+            self.finish_trace()
+            with stats_lock:
+                connection_stats['handshakes'] += 1
             self.client_buffer = b''
-            self.doCONNECT()
+            if self.server.relay_pool:
+                self.relayed = True
+                self.server.relay_pool.attach(self)
+            else:
+                self.doCONNECT()
         except Exception as e:
+            self.set_close_reason('connect_failed')
+            with stats_lock:
+                connection_stats['connect_failures'] += 1
             logging.error(f"💥 {Colors.RED}Tunnel setup failed: {e}{Colors.RESET}")
             self.client.send(b'HTTP/1.1 500 TunnelError\r\n\r\n')
 
@@ -564,28 +3089,40 @@ class ConnectionHandler(threading.Thread):
             count += 1
             (recv, _, err) = select.select(socs, [], socs, 3)
             if err:
+                self.set_close_reason('relay_error')
                 error = True
             if recv:
                 for in_ in recv:
                     try:
-                        data = in_.recv(BUFLEN)
+                        data = in_.recv(self.config.buflen)
                         if data:
+                            size = len(data)
                             # Track data transfer
                             if in_ is self.target:
-                                self.download_bytes += len(data)
+                                self.download_bytes += size
                                 self.client.send(data)
                             else:
-                                self.upload_bytes += len(data)
+                                self.upload_bytes += size
                                 while data:
                                     byte = self.target.send(data)
                                     data = data[byte:]
                             count = 0
+                            if self.quota_limited:
+                                delay = self.charge_quota(size)
+                                if delay is None:
+                                    error = True
+                                    break
+                                if delay:
+                                    time.sleep(delay)
                         else:
+                            self.set_close_reason('client_closed' if in_ is self.client else 'target_closed')
                             break
                     except:
+                        self.set_close_reason('relay_error')
                         error = True
                         break
-            if count == TIMEOUT:
+            if count == self.config.timeout:
+                self.set_close_reason('idle_timeout')
                 error = True
             if error:
                 break
@@ -605,6 +3142,14 @@ def print_usage():
 {Colors.YELLOW}Options:{Colors.RESET}
   {Colors.WHITE}-b, --bind    Bind address (default: 0.0.0.0){Colors.RESET}
   {Colors.WHITE}-p, --port    Listening port (default: 8080){Colors.RESET}
+  {Colors.WHITE}-m, --mode    Execution mode: thread (default) or pool{Colors.RESET}
+  {Colors.WHITE}-w, --workers Relay workers in pool mode (default: CPU count){Colors.RESET}
+  {Colors.WHITE}--no-color    Plain console output (automatic under systemd){Colors.RESET}
+  {Colors.WHITE}--metrics-port <port>  Serve Prometheus metrics on 127.0.0.1:<port>/metrics{Colors.RESET}
+  {Colors.WHITE}-c, --control Send a command to the running tunnel (stats, bans, unban <key>, slow [n], profile [seconds], tcp [user], sessions [user], quota [user], reload, upgrade){Colors.RESET}
+  {Colors.WHITE}--live        Print live counters from the shared metrics file{Colors.RESET}
+  {Colors.WHITE}--hash-password  Print a password hash for the user store (password on stdin){Colors.RESET}
+  {Colors.WHITE}--hash-users  Replace plaintext passwords in the user store with hashes{Colors.RESET}
   {Colors.WHITE}-h, --help    Show this help message{Colors.RESET}
 
 {Colors.YELLOW}Features:{Colors.RESET}
@@ -616,11 +3161,13 @@ def print_usage():
     ''')
 
 def parse_args(argv):
-    global LISTENING_ADDR
-    global LISTENING_PORT
+    global EXEC_MODE
+    global RELAY_WORKERS
+    global COLOR_OUTPUT
+    global METRICS_PORT
     
     try:
-        opts, args = getopt.getopt(argv,"hb:p:",["bind=","port="])
+        opts, args = getopt.getopt(argv,"hb:p:c:m:w:",["bind=","port=","control=","mode=","workers=","no-color","metrics-port=","live","hash-password","hash-users"])
     except getopt.GetoptError:
         print_usage()
         sys.exit(2)
@@ -629,9 +3176,46 @@ def parse_args(argv):
             print_usage()
             sys.exit()
         elif opt in ("-b", "--bind"):
-            LISTENING_ADDR = arg
+            CLI_OVERRIDES['listening_addr'] = arg
         elif opt in ("-p", "--port"):
-            LISTENING_PORT = int(arg)
+            CLI_OVERRIDES['listening_port'] = int(arg)
+        elif opt in ("-m", "--mode"):
+            if arg not in ('thread', 'pool'):
+                print_usage()
+                sys.exit(2)
+            EXEC_MODE = arg
+        elif opt in ("-w", "--workers"):
+            RELAY_WORKERS = int(arg)
+        elif opt == "--no-color":
+            COLOR_OUTPUT = 'never'
+        elif opt == "--metrics-port":
+            METRICS_PORT = int(arg)
+        elif opt in ("-c", "--control"):
+            try:
+                print(json.dumps(send_control_command(CONTROL_SOCKET, arg), indent=2))
+            except OSError as e:
+                print(f"{Colors.RED}❌ Cannot reach GX Tunnel control socket: {e}{Colors.RESET}")
+                sys.exit(1)
+            sys.exit()
+        elif opt == "--hash-password":
+            # Read from stdin so the password stays out of the process list
+            password = getpass.getpass('Password: ') if sys.stdin.isatty() else sys.stdin.readline().rstrip('\n')
+            if not password:
+                print(f"{Colors.RED}❌ Empty password{Colors.RESET}")
+                sys.exit(1)
+            print(hash_password(password))
+            sys.exit()
+        elif opt == "--hash-users":
+            manager = UserManager(USER_DB, LEGACY_USER_DB)
+            print(f"{Colors.GREEN}✅ Hashed {manager.hash_plaintext_passwords()} plaintext passwords in {USER_DB}{Colors.RESET}")
+            sys.exit()
+        elif opt == "--live":
+            try:
+                print(json.dumps(read_live_metrics(LIVE_METRICS_FILE), indent=2))
+            except (OSError, ValueError) as e:
+                print(f"{Colors.RED}❌ Cannot read live metrics: {e}{Colors.RESET}")
+                sys.exit(1)
+            sys.exit()
 
 def show_banner():
     banner = f'''
@@ -654,11 +3238,23 @@ def display_stats(server):
     
     print(f"\n{Colors.CYAN}{Colors.BOLD}📊 REAL-TIME STATISTICS:{Colors.RESET}")
     print(f"{Colors.WHITE}╔═══════════════════════════════════════╗{Colors.RESET}")
+    if stats['state'] == 'draining':
+        print(f"{Colors.YELLOW}🌊 Draining: {stats['active_connections']} tunnels left, {stats['drain_remaining']}s until forced close{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.GREEN}🟢 Active Connections: {Colors.CYAN}{stats['active_connections']:>15}{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.YELLOW}📈 Total Connections: {Colors.CYAN}{stats['total_connections']:>15}{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.BLUE}⏱️  Server Uptime: {Colors.CYAN}{stats['server_uptime']:>18.1f}s{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}║ {Colors.MAGENTA}🚀 Connections/Min: {Colors.CYAN}{stats['connections_per_minute']:>16.1f}{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.RED}🚫 Blocked by CIDR: {Colors.CYAN}{stats['blocked_connections']:>16}{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.YELLOW}🤝 In Handshake: {Colors.CYAN}{stats['handshaking']:>19}{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.RED}⏱️  Handshake Drops: {Colors.CYAN}{stats['handshake_timeouts'] + stats['oversized_headers']:>15}{Colors.WHITE} ║{Colors.RESET}")
+    if stats['tcp']['tunnels']:
+        print(f"{Colors.WHITE}║ {Colors.BLUE}📶 Avg Client RTT: {Colors.CYAN}{stats['tcp']['avg_rtt_ms']:>15.1f}ms{Colors.WHITE} ║{Colors.RESET}")
+    print(f"{Colors.WHITE}║ {Colors.RED}🔒 Auth Failures: {Colors.CYAN}{stats['auth_failures']:>18}{Colors.WHITE} ║{Colors.RESET}")
     print(f"{Colors.WHITE}╚═══════════════════════════════════════╝{Colors.RESET}")
+
+    if stats['relay_workers']:
+        loads = '/'.join(str(w['tunnels']) for w in stats['relay_workers'])
+        print(f"{Colors.CYAN}⚙️  Relay workers ({len(stats['relay_workers'])}): {Colors.WHITE}{loads} tunnels{Colors.RESET}")
     
     if recent_events:
         print(f"\n{Colors.YELLOW}{Colors.BOLD}🕒 RECENT ACTIVITY:{Colors.RESET}")
@@ -675,19 +3271,38 @@ def main(host=LISTENING_ADDR, port=LISTENING_PORT):
     # Show banner
     show_banner()
     
-    print(f"{Colors.YELLOW}📍 {Colors.WHITE}Listening on: {Colors.CYAN}{LISTENING_ADDR}:{LISTENING_PORT}{Colors.RESET}")
+    try:
+        config = load_config(CONFIG_FILE)
+    except (OSError, ValueError) as e:
+        print(f"{Colors.RED}❌ Invalid configuration: {e}{Colors.RESET}")
+        sys.exit(1)
+
+    print(f"{Colors.YELLOW}📍 {Colors.WHITE}Listening on: {Colors.CYAN}{config.listening_addr}:{config.listening_port}{Colors.RESET}")
     print(f"{Colors.YELLOW}👥 {Colors.WHITE}User authentication: {Colors.GREEN}Enabled{Colors.RESET}")
     print(f"{Colors.YELLOW}📊 {Colors.WHITE}Logging to: {Colors.CYAN}{LOG_DIR}/websocket.log{Colors.RESET}")
     print(f"{Colors.YELLOW}🚀 {Colors.WHITE}Starting server...{Colors.RESET}\n")
     
-    server = Server(LISTENING_ADDR, LISTENING_PORT)
+    server = Server(config)
     server.start()
+
+    # Config reload: new settings apply to new connections
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=server.reload_config, daemon=True).start())
+
+    # Graceful restart (systemctl reload): hand over the socket and drain
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=server.handoff, daemon=True).start())
+
+    # Diagnostics: thread dump, sampling profile and allocation diff
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=server.profiler.capture, daemon=True).start())
+
+    # systemctl stop/restart: shut down as on Ctrl+C, so queued stats rows,
+    # log and access records are flushed before the process exits
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     
     last_stat_display = 0
     stat_interval = 10  # seconds
     
     try:
-        while True:
+        while server.is_alive():
             time.sleep(2)
             
             # Display stats every stat_interval seconds
@@ -701,6 +3316,8 @@ def main(host=LISTENING_ADDR, port=LISTENING_PORT):
                 logging.info(f"📈 Stats - Active: {stats['active_connections']}, Total: {stats['total_connections']}, Rate: {stats['connections_per_minute']:.1f}/min")
                 
     except KeyboardInterrupt:
+        # A repeated SIGTERM must not cut the flush short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         print(f'\n\n{Colors.YELLOW}🛑 Stopping server...{Colors.RESET}')
         server.close()
         server.join()
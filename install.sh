@@ -4,6 +4,8 @@
 PYTHON_SCRIPT_URL="https://raw.githubusercontent.com/xcybermanx/AGN-SSH/main/agn_websocket.py"
 AGN_MANAGER_SCRIPT_URL="https://raw.githubusercontent.com/xcybermanx/AGN-SSH/main/agnws_manager.sh"
 WEBGUI_SCRIPT_URL="https://raw.githubusercontent.com/xcybermanx/AGN-SSH/main/webgui.py"
+USER_STORE_SCRIPT_URL="https://raw.githubusercontent.com/xcybermanx/AGN-SSH/main/gx_userstore.py"
+LIVE_METRICS_SCRIPT_URL="https://raw.githubusercontent.com/xcybermanx/AGN-SSH/main/gx_livemetrics.py"
 INSTALL_DIR="/opt/gx_tunnel"
 SYSTEMD_SERVICE_FILE="/etc/systemd/system/gx-tunnel.service"
 WEBGUI_SERVICE_FILE="/etc/systemd/system/gx-webgui.service"
@@ -11,7 +13,8 @@ PYTHON_BIN=$(command -v python3)
 AGN_MANAGER_SCRIPT="gx_manager.sh"
 AGN_MANAGER_PATH="$INSTALL_DIR/$AGN_MANAGER_SCRIPT"
 AGN_MANAGER_LINK="/usr/local/bin/gxtunnel"
-USER_DB="$INSTALL_DIR/users.json"
+USER_DB="$INSTALL_DIR/users.db"
+TUNNEL_CONFIG="$INSTALL_DIR/tunnel.conf"
 LOG_DIR="/var/log/gx_tunnel"
 
 # Function to install required packages
@@ -27,6 +30,10 @@ install_required_packages() {
 download_gx_websocket() {
     echo "Downloading Python proxy script..."
     wget -O "$INSTALL_DIR/gx_websocket.py" "$PYTHON_SCRIPT_URL"
+    # Shared user store module, imported by the tunnel and the web GUI
+    wget -O "$INSTALL_DIR/gx_userstore.py" "$USER_STORE_SCRIPT_URL"
+    # Live metrics layout, shared the same way
+    wget -O "$INSTALL_DIR/gx_livemetrics.py" "$LIVE_METRICS_SCRIPT_URL"
 }
 
 # Function to download manager script
@@ -47,25 +54,33 @@ download_webgui() {
 
 # Function to initialize user database
 initialize_user_db() {
-    if [ ! -f "$USER_DB" ]; then
-        echo "Initializing user database..."
-        cat > "$USER_DB" <<EOF
-{
-    "users": [],
-    "settings": {
-        "max_users": 100,
-        "default_expiry_days": 30,
-        "max_connections_per_user": 3
-    },
-    "statistics": {
-        "total_connections": 0,
-        "total_download": 0,
-        "total_upload": 0
-    }
+    # Creates users.db; users.json from an older install is imported once
+    echo "Initializing user database..."
+    GX_USER_STORE="$USER_DB" "$PYTHON_BIN" "$INSTALL_DIR/gx_userstore.py" export >/dev/null
+    chmod 600 "$USER_DB"
 }
+
+# Function to create the runtime config file (reloaded on SIGHUP)
+initialize_tunnel_config() {
+    if [ ! -f "$TUNNEL_CONFIG" ]; then
+        echo "Creating tunnel configuration..."
+        cat > "$TUNNEL_CONFIG" <<EOF
+# GX Tunnel settings. Apply with: systemctl kill -s HUP --kill-who=main gx-tunnel
+#LISTENING_ADDR=0.0.0.0
+#LISTENING_PORT=8080
+#BUFLEN=16384
+#TIMEOUT=60
+#DEFAULT_HOST=127.0.0.1:22
+#HANDSHAKE_TIMEOUT=10
+#MAX_HEADER_SIZE=8192
+#LOG_SAMPLE_RATE=1.0
+#TRACE_SAMPLE_RATE=0.0
+#SESSION_LIMIT_POLICY=reject
+#QUOTA_ACTION=disconnect
+#QUOTA_THROTTLE_RATE=32768
 EOF
     fi
-    chmod 600 "$USER_DB"
+    chmod 600 "$TUNNEL_CONFIG"
 }
 
 # Function to setup fail2ban
@@ -119,7 +134,10 @@ Description=GX Tunnel WebSocket SSH Service
 After=network.target
 
 [Service]
+Type=notify
+NotifyAccess=all
 ExecStart=$PYTHON_BIN $INSTALL_DIR/gx_websocket.py
+ExecReload=/bin/kill -USR2 \$MAINPID
 Restart=always
 User=root
 Group=root
@@ -237,6 +255,7 @@ main() {
 
     # Initialize user database
     initialize_user_db
+    initialize_tunnel_config
 
     # Setup fail2ban
     setup_fail2ban
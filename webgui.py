@@ -1,65 +1,185 @@
 #!/usr/bin/python3
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response
 from flask_cors import CORS
 import json
+import csv
+import io
+import re
+import pwd
 import sqlite3
 import subprocess
 import psutil
 import os
-from datetime import datetime, timedelta
+import base64
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from gx_userstore import UserStore, USER_FIELDS
+from gx_livemetrics import LIVE_METRICS_FILE, read_live_metrics
 
 app = Flask(__name__)
 app.secret_key = 'gx_tunnel_secret_key_2024'
 CORS(app)
 
 # Configuration
-USER_DB = "/opt/gx_tunnel/users.json"
+USER_DB = "/opt/gx_tunnel/users.db"
+LEGACY_USER_DB = "/opt/gx_tunnel/users.json"  # imported into USER_DB on first use
 STATS_DB = "/opt/gx_tunnel/statistics.db"
 CONFIG_FILE = "/opt/gx_tunnel/gx_config.conf"
 
+# Tunnel user passwords are stored as PBKDF2 hashes (same format as gx_websocket.py)
+PASSWORD_HASH_ITERATIONS = 200000
+
+# Bulk import: every row is validated before any account is created.
+# Rows need a plaintext password, which the system account is created with;
+# exports leave passwords out, so add a password column to re-import one.
+MAX_IMPORT_ROWS = 5000
+IMPORT_JOB_HISTORY = 20  # finished import jobs kept for polling
+EXPORT_FIELDS = tuple(field for field in USER_FIELDS if field != 'password')
+USERNAME_PATTERN = re.compile(r'^[a-z_][a-z0-9_-]{0,31}$')
+
 # Admin credentials
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
 
+def hash_password(password, iterations=PASSWORD_HASH_ITERATIONS):
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+def parse_count(value, default, name, minimum=0):
+    if value is None or str(value).strip() == '':
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a whole number")
+    if number < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return number
+
+def parse_import_row(row):
+    # One CSV/JSON import row -> user record with its plaintext password
+    if not isinstance(row, dict):
+        raise ValueError("Row must be an object")
+    username = str(row.get('username') or '').strip()
+    password = str(row.get('password') or '')
+    if not USERNAME_PATTERN.match(username):
+        raise ValueError("Username can only contain lowercase letters, numbers, hyphens and underscores")
+    if not password:
+        raise ValueError("Password is required")
+    if password.startswith('pbkdf2_sha256$'):
+        raise ValueError("A plaintext password is required to create the system account")
+    if any(c in password for c in ':\r\n'):
+        raise ValueError("Password cannot contain ':' or line breaks")
+    expires = str(row.get('expires') or '').strip() or None
+    if expires:
+        try:
+            datetime.strptime(expires, '%Y-%m-%d')
+        except ValueError:
+            raise ValueError("Expiry must be a YYYY-MM-DD date")
+    return {
+        'username': username,
+        'password': password,
+        'created': datetime.now().strftime('%Y-%m-%d'),
+        'expires': expires,
+        'max_connections': parse_count(row.get('max_connections'), 3, 'max_connections', 1),
+        'active': str(row.get('active', True)).strip().lower() not in ('false', '0', 'no'),
+        'quota_daily': parse_count(row.get('quota_daily'), None, 'quota_daily'),
+        'quota_monthly': parse_count(row.get('quota_monthly'), None, 'quota_monthly'),
+        'quota_total': parse_count(row.get('quota_total'), None, 'quota_total')
+    }
+
+def system_user_exists(username):
+    try:
+        pwd.getpwnam(username)
+        return True
+    except KeyError:
+        return False
+
+def create_system_users(accounts):
+    # One newusers run for the whole batch, which also sets the passwords.
+    # Returns the names that exist afterwards and newusers' error output.
+    lines = ''.join(f"{name}:{password}::::/home/{name}:/usr/sbin/nologin\n" for name, password in accounts)
+    try:
+        result = subprocess.run(['newusers'], input=lines, text=True, capture_output=True)
+        errors = result.stderr.strip()
+    except OSError as e:
+        errors = str(e)
+    return {name for name, _ in accounts if system_user_exists(name)}, errors
+
+def read_import_rows():
+    # JSON body ({"users": [...]} or a list), CSV body, or an uploaded file
+    upload = request.files.get('file')
+    if upload:
+        text, is_csv = upload.read().decode('utf-8-sig'), upload.filename.lower().endswith('.csv')
+    elif request.is_json:
+        data = request.get_json()
+        return data.get('users', []) if isinstance(data, dict) else data
+    else:
+        text, is_csv = request.get_data(as_text=True), 'csv' in (request.content_type or '')
+    if is_csv:
+        return list(csv.DictReader(io.StringIO(text)))
+    data = json.loads(text)
+    return data.get('users', []) if isinstance(data, dict) else data
+
+# Imports run one at a time on a background thread; the client polls the job
+import_jobs = OrderedDict()
+import_jobs_lock = threading.Lock()
+import_executor = ThreadPoolExecutor(1, thread_name_prefix='import')
+
+def run_import_job(job, rows):
+    def progress(stage, done=0, total=0):
+        job.update(stage=stage, done=done, total=total)
+    job['state'] = 'running'
+    try:
+        results = get_user_manager().add_users(rows, progress)
+        created = sum(1 for result in results if result['status'] == 'created')
+        job.update(success=created == len(results), created=created,
+                   failed=len(results) - created, results=results)
+    except Exception as e:
+        job.update(success=False, message=f'Import failed: {e}')
+    job.update(state='finished', stage='finished', finished=time.time())
+
+def start_import_job(rows):
+    job = {'id': os.urandom(8).hex(), 'state': 'queued', 'rows': len(rows),
+           'stage': 'queued', 'done': 0, 'total': len(rows), 'started': time.time()}
+    with import_jobs_lock:
+        import_jobs[job['id']] = job
+        finished = [job_id for job_id, entry in import_jobs.items() if entry['state'] == 'finished']
+        for job_id in finished[:max(0, len(finished) - IMPORT_JOB_HISTORY)]:
+            del import_jobs[job_id]
+    import_executor.submit(run_import_job, job, rows)
+    return job
+
 class UserManager:
+    # Thin wrapper over the shared user store; each change is a single-row
+    # transaction that the running tunnel picks up by itself
     def __init__(self, db_path):
-        self.db_path = db_path
+        self.store = UserStore(db_path, LEGACY_USER_DB)
     
     def load_users(self):
         try:
-            with open(self.db_path, 'r') as f:
-                data = json.load(f)
-                return data.get('users', []), data.get('settings', {})
-        except:
+            users, settings, _ = self.store.load()
+            return users, settings
+        except sqlite3.Error:
             return [], {}
     
-    def save_users(self, users, settings):
-        data = {
-            'users': users,
-            'settings': settings
-        }
-        with open(self.db_path, 'w') as f:
-            json.dump(data, f, indent=2)
-    
     def add_user(self, username, password, expires=None, max_connections=3):
-        users, settings = self.load_users()
-        
-        # Check if user exists
-        for user in users:
-            if user['username'] == username:
-                return False, "User already exists"
-        
         user_data = {
             'username': username,
-            'password': password,
+            'password': hash_password(password),
             'created': datetime.now().strftime('%Y-%m-%d'),
             'expires': expires,
             'max_connections': max_connections,
             'active': True
         }
         
-        users.append(user_data)
-        self.save_users(users, settings)
+        if not self.store.add_user(user_data):
+            return False, "User already exists"
         
         # Create system user
         try:
@@ -70,10 +190,74 @@ class UserManager:
         
         return True, "User created successfully"
     
+    def add_users(self, rows, progress=None):
+        # Bulk import with one result per row. Rows are validated first, then
+        # passwords hashed in parallel (pbkdf2_hmac releases the GIL), system
+        # accounts created by one newusers run and the store written in one
+        # transaction. progress(stage, done, total) is told how far it got.
+        progress = progress or (lambda stage, done=0, total=0: None)
+        progress('validating', 0, len(rows))
+        existing = {user['username'] for user in self.load_users()[0]}
+        seen = set()
+        results, pending = [], []
+        for number, row in enumerate(rows, 1):
+            result = {'row': number, 'username': str(row.get('username') or '') if isinstance(row, dict) else ''}
+            results.append(result)
+            try:
+                user = parse_import_row(row)
+            except ValueError as e:
+                result.update(status='error', message=str(e))
+                continue
+            username = user['username']
+            if username in seen:
+                result.update(status='error', message="Duplicate username in import")
+            elif username in existing:
+                result.update(status='error', message="User already exists")
+            elif system_user_exists(username):
+                result.update(status='error', message="System account already exists")
+            else:
+                pending.append((result, user))
+            seen.add(username)
+        if not pending:
+            return results
+        
+        passwords = [user['password'] for _, user in pending]
+        hashes = []
+        with ThreadPoolExecutor(os.cpu_count() or 2) as pool:
+            for password_hash in pool.map(hash_password, passwords):
+                hashes.append(password_hash)
+                progress('hashing', len(hashes), len(passwords))
+        progress('creating accounts', 0, len(pending))
+        created, errors = create_system_users([(user['username'], user['password']) for _, user in pending])
+        
+        records = []
+        for (result, user), password_hash in zip(pending, hashes):
+            if user['username'] in created:
+                records.append(dict(user, password=password_hash))
+            else:
+                result.update(status='error', message=f"Failed to create system user: {errors or 'newusers failed'}")
+        progress('saving', 0, len(records))
+        try:
+            clashes = set(self.store.add_users(records))
+        except sqlite3.Error as e:
+            clashes = {user['username'] for user in records}
+            for result, _ in pending:
+                if 'status' not in result:
+                    result.update(status='error', message=f"Failed to save user: {e}")
+        for result, user in pending:
+            if 'status' in result:
+                continue
+            if user['username'] in clashes:
+                result.update(status='error', message="User already exists")
+            else:
+                result.update(status='created', message="User created successfully")
+        # Accounts whose store row was not written are removed again
+        for username in clashes:
+            subprocess.run(['userdel', '-r', username], capture_output=True)
+        return results
+    
     def delete_user(self, username):
-        users, settings = self.load_users()
-        users = [u for u in users if u['username'] != username]
-        self.save_users(users, settings)
+        self.store.delete_user(username)
         
         # Delete system user
         try:
@@ -83,6 +267,24 @@ class UserManager:
         
         return True, "User deleted successfully"
 
+# One store for every request: opening users.db checks the schema, and the
+# store itself keeps no per-request state
+shared_user_manager = None
+shared_user_manager_lock = threading.Lock()
+
+def get_user_manager():
+    global shared_user_manager
+    with shared_user_manager_lock:
+        if shared_user_manager is None:
+            shared_user_manager = UserManager(USER_DB)
+        return shared_user_manager
+
+def epoch_to_iso(value):
+    # statistics.db stores integer epoch seconds (UTC)
+    if isinstance(value, int):
+        return datetime.fromtimestamp(value, timezone.utc).isoformat()
+    return value
+
 class StatisticsManager:
     def __init__(self, db_path):
         self.db_path = db_path
@@ -104,7 +306,7 @@ class StatisticsManager:
                 'connections': result[0],
                 'download_bytes': result[1],
                 'upload_bytes': result[2],
-                'last_connection': result[3]
+                'last_connection': epoch_to_iso(result[3]) or 'Never'
             }
         return None
     
@@ -136,7 +338,7 @@ class StatisticsManager:
             connections.append({
                 'username': row[0],
                 'client_ip': row[1],
-                'start_time': row[2],
+                'start_time': epoch_to_iso(row[2]),
                 'duration': row[3],
                 'download_bytes': row[4],
                 'upload_bytes': row[5]
@@ -222,12 +424,15 @@ def get_users():
     if 'admin' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    user_manager = UserManager(USER_DB)
+    user_manager = get_user_manager()
     users, settings = user_manager.load_users()
     stats_manager = StatisticsManager(STATS_DB)
     
     # Add statistics to users
     for user in users:
+        if user['password'].startswith('pbkdf2_sha256$'):
+            user['password'] = '(hashed)'
+
         user_stats = stats_manager.get_user_stats(user['username'])
         if user_stats:
             user.update(user_stats)
@@ -266,7 +471,7 @@ def add_user():
     if not username or not password:
         return jsonify({'success': False, 'message': 'Username and password are required'})
     
-    user_manager = UserManager(USER_DB)
+    user_manager = get_user_manager()
     success, message = user_manager.add_user(username, password, expires, max_connections)
     
     return jsonify({'success': success, 'message': message})
@@ -282,11 +487,66 @@ def delete_user():
     if not username:
         return jsonify({'success': False, 'message': 'Username is required'})
     
-    user_manager = UserManager(USER_DB)
+    user_manager = get_user_manager()
     success, message = user_manager.delete_user(username)
     
     return jsonify({'success': success, 'message': message})
 
+@app.route('/api/users/import', methods=['POST'])
+def import_users():
+    if 'admin' not in session:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    
+    try:
+        rows = read_import_rows()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'message': f'Cannot parse import: {e}'}), 400
+    if not isinstance(rows, list):
+        return jsonify({'success': False, 'message': 'Expected a list of users'}), 400
+    if len(rows) > MAX_IMPORT_ROWS:
+        return jsonify({'success': False, 'message': f'At most {MAX_IMPORT_ROWS} users per import'}), 400
+    
+    # Hashing thousands of passwords takes minutes, so the import runs in
+    # the background and the client polls the job for per-row results
+    job = start_import_job(rows)
+    return jsonify({
+        'success': True,
+        'job': job['id'],
+        'status_url': url_for('import_status', job_id=job['id'])
+    }), 202
+
+@app.route('/api/users/import/<job_id>')
+def import_status(job_id):
+    if 'admin' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    with import_jobs_lock:
+        job = import_jobs.get(job_id)
+        job = dict(job) if job else None
+    if job is None:
+        return jsonify({'error': 'Unknown import job'}), 404
+    return jsonify(job)
+
+@app.route('/api/users/export')
+def export_users():
+    if 'admin' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    user_manager = get_user_manager()
+    users, settings = user_manager.load_users()
+    # Password hashes never leave the server
+    users = [{field: user[field] for field in EXPORT_FIELDS} for user in users]
+    
+    if request.args.get('format') == 'csv':
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(users)
+        return Response(output.getvalue(), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=gx_users.csv'})
+    
+    return jsonify({'users': users, 'settings': settings})
+
 @app.route('/api/stats')
 def get_stats():
     if 'admin' not in session:
@@ -317,13 +577,27 @@ def get_stats():
         }
     })
 
+@app.route('/api/live')
+def get_live_stats():
+    if 'admin' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        metrics = read_live_metrics(LIVE_METRICS_FILE)
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Live metrics unavailable: {e}'}), 503
+    
+    metrics['age'] = round(time.time() - metrics['updated'], 2)
+    return jsonify(metrics)
+
 @app.route('/api/services/restart', methods=['POST'])
 def restart_services():
     if 'admin' not in session:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
     
     try:
-        subprocess.run(['systemctl', 'restart', 'gx-tunnel'], check=True)
+        # Graceful: the tunnel hands over its socket and drains open tunnels
+        subprocess.run(['systemctl', 'reload-or-restart', 'gx-tunnel'], check=True)
         subprocess.run(['systemctl', 'restart', 'gx-webgui'], check=True)
         return jsonify({'success': True, 'message': 'Services restarted successfully'})
     except subprocess.CalledProcessError as e: